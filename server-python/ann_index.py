@@ -0,0 +1,460 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# --- Configuration ---
+# Trained index file; when it exists load_vector_db wraps the store with AnnCollection
+ANN_INDEX_PATH = os.getenv("IPLENS_ANN_INDEX_PATH", "./ann_index.npz")
+# Inverted lists probed per query unless the request overrides it
+DEFAULT_NPROBE = int(os.getenv("IPLENS_ANN_NPROBE", "16"))
+# Candidates re-ranked with exact distances (at least n_results)
+RERANK_CANDIDATES = int(os.getenv("IPLENS_ANN_RERANK", "100"))
+# Writes save the index at most this often (seconds), so a crash loses little; 0 saves after every write
+SAVE_INTERVAL_SECONDS = float(os.getenv("IPLENS_ANN_SAVE_INTERVAL", "60"))
+# On load, an index missing more than this share of the store is retrained instead of patched
+RETRAIN_MISSING_RATIO = float(os.getenv("IPLENS_ANN_RETRAIN_RATIO", "0.5"))
+# Vectors sampled when the index is retrained on load (as for `ann_index.py train`)
+RETRAIN_SAMPLE_SIZE = 100000
+KMEANS_ITERATIONS = 20
+# Rows per distance computation during training and encoding
+ASSIGN_CHUNK_ROWS = 16384
+
+
+# --- (1) Training helpers ---
+
+def _squared_distances(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return (np.einsum("ij,ij->i", x, x)[:, None] - 2.0 * (x @ centroids.T)
+            + np.einsum("ij,ij->i", centroids, centroids)[None, :])
+
+
+def _assign(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), ASSIGN_CHUNK_ROWS):
+        labels[start:start + ASSIGN_CHUNK_ROWS] = np.argmin(
+            _squared_distances(x[start:start + ASSIGN_CHUNK_ROWS], centroids), axis=1)
+    return labels
+
+
+def kmeans(x: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """Plain Lloyd's k-means. Empty clusters are re-seeded with random points."""
+    rng = np.random.RandomState(seed)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+# --- (2) IVF-PQ Index ---
+
+class IVFPQIndex:
+    """
+    Inverted-file index with product-quantized residuals (IVF-PQ).
+
+    Vectors are assigned to one of `nlist` coarse centroids; the residual is split into
+    `m` sub-vectors, each stored as a one-byte code, so a 512-d float32 vector (2048 bytes)
+    takes `m` bytes (m=64 -> 32x smaller, m=128 -> 16x). Search probes the `nprobe`
+    closest lists and ranks their entries with asymmetric distance tables.
+    """
+
+    def __init__(self, dim: int, nlist: int = 1024, m: int = 64):
+        if dim % m != 0:
+            raise ValueError(f"Dimension {dim} is not divisible by m={m}")
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.dsub = dim // m
+        self.coarse: Optional[np.ndarray] = None
+        self.codebooks: Optional[np.ndarray] = None  # (m, ksub, dsub)
+
+        self.ids: List[str] = []
+        self._id_to_int: Dict[str, int] = {}
+        self.deleted: set = set()
+        self.list_ids: List[np.ndarray] = []
+        self.list_codes: List[np.ndarray] = []
+        self._lock = threading.RLock()
+
+    @property
+    def is_trained(self) -> bool:
+        return self.coarse is not None
+
+    def __len__(self) -> int:
+        return len(self.ids) - len(self.deleted)
+
+    def train(self, sample: np.ndarray, iterations: int = KMEANS_ITERATIONS):
+        sample = np.asarray(sample, dtype=np.float32)
+        self.nlist = min(self.nlist, len(sample))
+        print(f"--- Training IVF-PQ: {len(sample)} vectors, nlist={self.nlist}, m={self.m} ---")
+        self.coarse = kmeans(sample, self.nlist, iterations)
+        residuals = sample - self.coarse[_assign(sample, self.coarse)]
+        ksub = min(256, len(sample))
+        self.codebooks = np.stack([
+            kmeans(residuals[:, j * self.dsub:(j + 1) * self.dsub], ksub, iterations, seed=j)
+            for j in range(self.m)
+        ])
+        self.list_ids = [np.zeros(0, dtype=np.int64) for _ in range(self.nlist)]
+        self.list_codes = [np.zeros((0, self.m), dtype=np.uint8) for _ in range(self.nlist)]
+
+    def _encode(self, residuals: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(residuals), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _assign(residuals[:, j * self.dsub:(j + 1) * self.dsub], self.codebooks[j])
+        return codes
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray):
+        """Encodes and appends vectors; ids already in the index are re-encoded under a new entry."""
+        if not self.is_trained:
+            raise RuntimeError("The IVF-PQ index must be trained before vectors are added.")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            self.remove([item_id for item_id in ids if item_id in self._id_to_int])
+            int_ids = np.arange(len(self.ids), len(self.ids) + len(ids), dtype=np.int64)
+            for item_id, int_id in zip(ids, int_ids):
+                self.ids.append(item_id)
+                self._id_to_int[item_id] = int(int_id)
+
+            lists = _assign(vectors, self.coarse)
+            codes = self._encode(vectors - self.coarse[lists])
+            order = np.argsort(lists, kind="stable")
+            boundaries = np.flatnonzero(np.diff(lists[order])) + 1
+            for group in np.split(order, boundaries):
+                if len(group) == 0:
+                    continue
+                list_no = lists[group[0]]
+                self.list_ids[list_no] = np.concatenate([self.list_ids[list_no], int_ids[group]])
+                self.list_codes[list_no] = np.concatenate([self.list_codes[list_no], codes[group]])
+
+    def remove(self, ids: Sequence[str]):
+        """Tombstones ids; their codes are skipped during search."""
+        with self._lock:
+            for item_id in ids:
+                int_id = self._id_to_int.pop(item_id, None)
+                if int_id is not None:
+                    self.deleted.add(int_id)
+
+    def search(self, query: np.ndarray, n_candidates: int, nprobe: int = DEFAULT_NPROBE) -> List[str]:
+        """Returns the ids of the `n_candidates` best approximate matches for one query."""
+        query = np.asarray(query, dtype=np.float32)
+        # Writers replace list arrays and tombstone ids from other threads: take a consistent
+        # snapshot under the lock and score outside it (self.ids is append-only)
+        with self._lock:
+            coarse, codebooks = self.coarse, self.codebooks
+            list_ids, list_codes = list(self.list_ids), list(self.list_codes)
+            deleted = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+        nprobe = max(1, min(nprobe, len(coarse)))
+        coarse_dist = _squared_distances(query[None, :], coarse)[0]
+        probe = np.argpartition(coarse_dist, nprobe - 1)[:nprobe]
+
+        candidate_ids, candidate_dist = [], []
+        for list_no in probe:
+            codes = list_codes[list_no]
+            if len(codes) == 0:
+                continue
+            residual = (query - coarse[list_no]).reshape(self.m, 1, self.dsub)
+            # Distance of each query sub-vector to every codeword: (m, ksub)
+            table = np.sum((codebooks - residual) ** 2, axis=2)
+            candidate_dist.append(table[np.arange(self.m)[None, :], codes].sum(axis=1))
+            candidate_ids.append(list_ids[list_no])
+        if not candidate_ids:
+            return []
+
+        int_ids = np.concatenate(candidate_ids)
+        dist = np.concatenate(candidate_dist)
+        if len(deleted):
+            alive = ~np.isin(int_ids, deleted)
+            int_ids, dist = int_ids[alive], dist[alive]
+        if len(dist) > n_candidates:
+            keep = np.argpartition(dist, n_candidates - 1)[:n_candidates]
+            int_ids, dist = int_ids[keep], dist[keep]
+        return [self.ids[i] for i in int_ids[np.argsort(dist)]]
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            codes = sum(c.nbytes for c in self.list_codes) + sum(i.nbytes for i in self.list_ids)
+        return codes + self.coarse.nbytes + self.codebooks.nbytes if self.is_trained else 0
+
+    # --- Persistence ---
+
+    def save(self, path: str):
+        with self._lock:
+            sizes = np.array([len(ids) for ids in self.list_ids], dtype=np.int64)
+            directory = os.path.dirname(os.path.abspath(path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npz")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    config=np.array([self.dim, self.nlist, self.m], dtype=np.int64),
+                    coarse=self.coarse,
+                    codebooks=self.codebooks,
+                    ids=np.array(self.ids, dtype=object),
+                    deleted=np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted)),
+                    list_sizes=sizes,
+                    list_ids=np.concatenate(self.list_ids) if self.list_ids else np.zeros(0, dtype=np.int64),
+                    list_codes=np.concatenate(self.list_codes) if self.list_codes else np.zeros((0, self.m), dtype=np.uint8),
+                )
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFPQIndex":
+        data = np.load(path, allow_pickle=True)
+        dim, nlist, m = (int(v) for v in data["config"])
+        index = cls(dim, nlist, m)
+        index.coarse = data["coarse"]
+        index.codebooks = data["codebooks"]
+        index.ids = list(data["ids"])
+        index.deleted = set(int(v) for v in data["deleted"])
+        index._id_to_int = {item_id: i for i, item_id in enumerate(index.ids) if i not in index.deleted}
+        offsets = np.concatenate([[0], np.cumsum(data["list_sizes"])])
+        index.list_ids = [data["list_ids"][offsets[i]:offsets[i + 1]] for i in range(nlist)]
+        index.list_codes = [data["list_codes"][offsets[i]:offsets[i + 1]] for i in range(nlist)]
+        return index
+
+
+# --- (3) Collection Wrapper ---
+
+class AnnCollection:
+    """
+    Wraps a vector store (Chroma collection or MmapVectorIndex) with an IVF-PQ index.
+
+    Unfiltered queries take candidates from the compressed index and re-rank them
+    exactly against the full vectors held by the base store, so returned distances are
+    exact. Filtered queries and every other call go straight to the base store.
+
+    Writes go to the base store first, and the index is saved at most every
+    `save_interval` seconds after them; reconcile() brings an index left behind by a
+    crash back in line with the store.
+    """
+
+    def __init__(self, base, index: IVFPQIndex, index_path: Optional[str] = None,
+                 default_nprobe: int = DEFAULT_NPROBE, rerank_candidates: int = RERANK_CANDIDATES,
+                 save_interval: float = SAVE_INTERVAL_SECONDS):
+        self.base = base
+        self.index = index
+        self.index_path = index_path
+        self.default_nprobe = default_nprobe
+        self.rerank_candidates = rerank_candidates
+        self.save_interval = save_interval
+        self.name = getattr(base, "name", "ip_vector_collection")
+        self._save_lock = threading.Lock()
+        self._last_saved = time.monotonic()
+
+    def __getattr__(self, attr):
+        return getattr(self.base, attr)
+
+    def add(self, ids, embeddings, **kwargs):
+        self.base.add(ids=ids, embeddings=embeddings, **kwargs)
+        self.index.add(ids, np.asarray(embeddings, dtype=np.float32))
+        self._save_if_due()
+
+    def upsert(self, ids, embeddings, **kwargs):
+        self.base.upsert(ids=ids, embeddings=embeddings, **kwargs)
+        self.index.add(ids, np.asarray(embeddings, dtype=np.float32))
+        self._save_if_due()
+
+    def delete(self, ids=None, where=None, **kwargs):
+        if ids is None:
+            ids = self.base.get(where=where, include=[])["ids"]
+        self.base.delete(ids=ids, **kwargs)
+        self.index.remove(ids)
+        self._save_if_due()
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Sequence[str] = ("metadatas", "documents", "distances"), nprobe: Optional[int] = None,
+              **kwargs) -> Dict[str, Any]:
+        if where:
+            return self.base.query(query_embeddings=query_embeddings, n_results=n_results, where=where,
+                                   include=include, **kwargs)
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        n_candidates = max(n_results, self.rerank_candidates)
+
+        result: Dict[str, Any] = {key: [] for key in ("ids", "distances", "metadatas", "documents", "embeddings")}
+        for query in queries:
+            ids, distances, rows = self._rerank(query, self.index.search(query, n_candidates, nprobe or self.default_nprobe),
+                                                n_results, include)
+            result["ids"].append(ids)
+            result["distances"].append(distances)
+            for key in ("metadatas", "documents", "embeddings"):
+                result[key].append([row[key] for row in rows] if key in include else None)
+
+        for key in ("distances", "metadatas", "documents", "embeddings"):
+            if key not in include:
+                result[key] = None
+        result["included"] = list(include)
+        return result
+
+    def _rerank(self, query: np.ndarray, candidate_ids: List[str], n_results: int,
+                include: Sequence[str]) -> Tuple[List[str], List[float], List[Dict[str, Any]]]:
+        """Exact squared-L2 re-ranking of the candidates with the full-precision vectors."""
+        if not candidate_ids:
+            return [], [], []
+        fetch = ["embeddings"] + [key for key in ("metadatas", "documents") if key in include]
+        stored = self.base.get(ids=candidate_ids, include=fetch)
+        vectors = np.asarray(stored["embeddings"], dtype=np.float32)
+        distances = np.sum((vectors - query[None, :]) ** 2, axis=1)
+        order = np.argsort(distances)[:n_results]
+
+        rows = [{
+            "metadatas": stored["metadatas"][i] if stored.get("metadatas") is not None else None,
+            "documents": stored["documents"][i] if stored.get("documents") is not None else None,
+            "embeddings": vectors[i],
+        } for i in order]
+        return [stored["ids"][i] for i in order], [float(distances[i]) for i in order], rows
+
+    def save(self):
+        if self.index_path:
+            with self._save_lock:
+                self.index.save(self.index_path)
+                self._last_saved = time.monotonic()
+
+    def _save_if_due(self):
+        if self.index_path and time.monotonic() - self._last_saved >= self.save_interval:
+            self.save()
+
+    def reconcile(self, batch_size: int = 5000, retrain_ratio: float = RETRAIN_MISSING_RATIO) -> Dict[str, int]:
+        """
+        Compares the index with the base store (blocking; run before serving). When their
+        counts differ, ids missing from the index are encoded from the stored vectors and
+        ids no longer stored are removed; if more than `retrain_ratio` of the store is
+        missing, the index is retrained on it instead. Saves the index when it changed.
+        """
+        total = self.base.count()
+        if total == len(self.index):
+            return {"missing": 0, "stale": 0, "retrained": 0}
+
+        stored_ids = []
+        for start in range(0, total, batch_size):
+            stored_ids.extend(self.base.get(limit=batch_size, offset=start, include=[])["ids"])
+        stored = set(stored_ids)
+        with self.index._lock:
+            indexed = set(self.index._id_to_int)
+        missing = [item_id for item_id in stored_ids if item_id not in indexed]
+        stale = [item_id for item_id in indexed if item_id not in stored]
+
+        retrained = bool(total) and len(missing) > retrain_ratio * total
+        if retrained:
+            print(f"IVF-PQ index is missing {len(missing)} of {total} vectors; retraining it.")
+            self.index = build_index(self.base, nlist=self.index.nlist, m=self.index.m,
+                                     sample_size=RETRAIN_SAMPLE_SIZE, batch_size=batch_size)
+        else:
+            self.index.remove(stale)
+            for start in range(0, len(missing), batch_size):
+                batch = self.base.get(ids=missing[start:start + batch_size], include=["embeddings"])
+                self.index.add(batch["ids"], np.asarray(batch["embeddings"], dtype=np.float32))
+            print(f"IVF-PQ index reconciled with the store: encoded {len(missing)} missing, removed {len(stale)} stale vectors.")
+        if missing or stale:
+            self.save()
+        return {"missing": len(missing), "stale": len(stale), "retrained": int(retrained)}
+
+
+# --- (4) Offline Tools ---
+
+def _sample_vectors(collection, sample_size: int, batch_size: int = 5000, seed: int = 0) -> Tuple[List[str], np.ndarray]:
+    """Reads a random sample of (ids, vectors) from the store in contiguous batches."""
+    total = collection.count()
+    rng = np.random.RandomState(seed)
+    starts = np.arange(0, total, batch_size)
+    rng.shuffle(starts)
+    ids, vectors = [], []
+    for start in starts:
+        batch = collection.get(limit=batch_size, offset=int(start), include=["embeddings"])
+        ids.extend(batch["ids"])
+        vectors.append(np.asarray(batch["embeddings"], dtype=np.float32))
+        if len(ids) >= sample_size:
+            break
+    vectors = np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+    keep = rng.permutation(len(ids))[:sample_size]
+    return [ids[i] for i in keep], vectors[keep]
+
+
+def build_index(collection, nlist: int, m: int, sample_size: int, batch_size: int = 5000) -> IVFPQIndex:
+    """Trains on a sample of the collection, then encodes every vector in it."""
+    _, sample = _sample_vectors(collection, sample_size)
+    if len(sample) == 0:
+        raise ValueError("The collection is empty; nothing to train on.")
+    index = IVFPQIndex(sample.shape[1], nlist=nlist, m=m)
+    index.train(sample)
+
+    total = collection.count()
+    for start in range(0, total, batch_size):
+        batch = collection.get(limit=batch_size, offset=start, include=["embeddings"])
+        index.add(batch["ids"], np.asarray(batch["embeddings"], dtype=np.float32))
+        print(f"Encoded {min(start + batch_size, total)}/{total} vectors")
+    return index
+
+
+def evaluate(collection, index: IVFPQIndex, num_queries: int, k: int, nprobes: List[int]) -> List[Dict[str, Any]]:
+    """
+    Recall@k against exact search, and latency, for each nprobe. Queries are vectors
+    sampled from the collection itself (their own id is excluded from both rankings).
+    """
+    query_ids, queries = _sample_vectors(collection, num_queries, seed=1)
+    exact = collection.query(query_embeddings=queries, n_results=k + 1, include=["distances"])
+    truth = [[i for i in ids if i != qid][:k] for qid, ids in zip(query_ids, exact["ids"])]
+
+    wrapper = AnnCollection(collection, index)
+    results = []
+    for nprobe in nprobes:
+        latencies, recalls = [], []
+        for qid, query, expected in zip(query_ids, queries, truth):
+            started = time.perf_counter()
+            found = wrapper.query(query[None, :], n_results=k + 1, include=["distances"], nprobe=nprobe)["ids"][0]
+            latencies.append(time.perf_counter() - started)
+            found = [i for i in found if i != qid][:k]
+            recalls.append(len(set(found) & set(expected)) / max(1, len(expected)))
+        results.append({
+            "nprobe": nprobe,
+            f"recall@{k}": float(np.mean(recalls)),
+            "latency_ms_p50": float(np.percentile(latencies, 50) * 1000.0),
+            "latency_ms_p95": float(np.percentile(latencies, 95) * 1000.0),
+        })
+        print(f"nprobe={nprobe:<4} recall@{k}={results[-1][f'recall@{k}']:.3f} "
+              f"p50={results[-1]['latency_ms_p50']:.2f}ms p95={results[-1]['latency_ms_p95']:.2f}ms")
+    return results
+
+
+if __name__ == "__main__":
+    from model_tools import ACTIVE_INDEX, ann_index_path, load_vector_db
+
+    parser = argparse.ArgumentParser(description="Train and evaluate the IVF-PQ index over the vector store.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train = sub.add_parser("train", help="Train on a sample of the collection and encode all of it.")
+    train.add_argument("--nlist", type=int, default=1024)
+    train.add_argument("--m", type=int, default=64, help="Bytes per vector (must divide the dimension).")
+    train.add_argument("--sample", type=int, default=100000)
+    evaluate_parser = sub.add_parser("eval", help="Recall@k vs. latency for several nprobe values.")
+    evaluate_parser.add_argument("--queries", type=int, default=200)
+    evaluate_parser.add_argument("--k", type=int, default=10)
+    evaluate_parser.add_argument("--nprobe", default="1,4,16,64")
+    evaluate_parser.add_argument("--json", help="Also write the results to this file.")
+    for p in (train, evaluate_parser):
+        p.add_argument("--path", default=ann_index_path(ACTIVE_INDEX), help="Default: the active collection's index file.")
+    args = parser.parse_args()
+
+    # The plain store is loaded here; the ANN wrapper is built explicitly below
+    base = load_vector_db(use_ann=False)
+    if args.command == "train":
+        ann = build_index(base, nlist=args.nlist, m=args.m, sample_size=args.sample)
+        ann.save(args.path)
+        print(f"Saved {len(ann)} vectors to {args.path} ({ann.memory_bytes() / 1e6:.1f} MB of codes and codebooks).")
+    else:
+        results = evaluate(base, IVFPQIndex.load(args.path), args.queries, args.k,
+                           [int(v) for v in args.nprobe.split(",")])
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
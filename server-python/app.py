@@ -1,27 +1,67 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse # FIXED: JSONResponse imported from fastapi.responses
+from fastapi.responses import JSONResponse, PlainTextResponse # FIXED: JSONResponse imported from fastapi.responses
 from pydantic import BaseModel
-from io import BytesIO
 from PIL import Image
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import base64
+import hashlib
+import json
 import os
 import shutil
+import time
+import numpy as np
 
 # --- REQUIRED IMPORTS FROM MODEL_TOOLS.PY ---
-from model_tools import load_ip_model, generate_ip_vector, add_vector_to_db, search_vector_db 
+from model_tools import (load_ip_model, load_vector_db, load_near_duplicate_index, decode_image, search_vector_db, search_vectors_db, search_vector_page,
+                         mean_query_vector, reciprocal_rank_fusion, similarity_from_distance,
+                         find_by_content_hash, find_existing_content_hashes, find_existing_ids, normalize_text_query, TEXT_SEARCH, ACTIVE_INDEX)
 # --------------------------------------------
+from batching import BatcherSaturated, MicroBatcher
+from ann_index import AnnCollection
+from image_decode import ImageRejected
+from phash_index import PHASH_MAX_DISTANCE, perceptual_hash_encoded
+from uploads import MAX_ARCHIVE_BYTES, RequestSizeLimitMiddleware, SpooledUpload, UploadSpool, hash_file, safe_filename
+from executor import InferenceExecutor, ExecutorSaturated, INFERENCE_MODE, RETRY_AFTER_SECONDS
+from embedding_cache import EmbeddingCache, content_hash
+from write_buffer import WriteBuffer
+from inference_backends import resident_memory_mb
+from metrics import (PROFILE_REQUESTS_AT_STARTUP, PROFILER, PROFILING_ENABLED, REGISTRY, Gauge, MetricsMiddleware,
+                     TimedJSONResponse, stage)
+from vector_encoding import VECTOR_RESPONSES, encode_vectors, negotiate_vector_format
 
 
 # --- (1) Setup ---
 
 # CRITICAL: Use an absolute path to ensure FastAPI finds the assets folder reliably.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-ASSETS_FOLDER = os.path.join(BASE_DIR, "story_protocol_assets")
+ASSETS_FOLDER = os.getenv("IPLENS_ASSETS_DIR", os.path.join(BASE_DIR, "story_protocol_assets"))
+# Uploads are streamed here first; a sibling of ASSETS_FOLDER (so saving is a rename)
+# that is not served under /assets
+UPLOAD_SPOOL_FOLDER = os.getenv("IPLENS_UPLOAD_SPOOL_DIR", os.path.join(BASE_DIR, ".upload_spool"))
 
-app = FastAPI(title="IP Lens Vector Generator & Search API")
+# Image files accepted on their own or inside an uploaded archive
+ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+ARCHIVE_CONTENT_TYPES = ["application/zip", "application/x-zip-compressed", "application/x-tar", "application/gzip", "application/x-gzip"]
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+# Images embedded per forward pass by the bulk endpoint
+INGEST_BATCH_SIZE = int(os.getenv("IPLENS_INGEST_BATCH_SIZE", "32"))
+# Most images a single /add-vectors, /generate-vectors or /search-vectors request may carry
+MAX_BULK_FILES = int(os.getenv("IPLENS_MAX_BULK_FILES", "1000"))
+# How /search-vectors may combine the per-query rankings
+FUSION_METHODS = ("none", "mean", "rrf")
+# Deepest rank /search-vector pages can reach (offset + n_results), and the largest n_results of /search-vectors
+MAX_SEARCH_WINDOW = int(os.getenv("IPLENS_MAX_SEARCH_WINDOW", "1000"))
+# Longest /search-text query accepted (CLIP truncates to 77 tokens anyway)
+MAX_TEXT_QUERY_CHARS = int(os.getenv("IPLENS_MAX_TEXT_QUERY_CHARS", "1000"))
+# Memory budget of the text query embedding cache (memory only, ~4k entries at 512-d)
+TEXT_CACHE_MEMORY_BYTES = int(os.getenv("IPLENS_TEXT_CACHE_MEMORY_BYTES", str(8 * 1024 * 1024)))
+
+# TimedJSONResponse records the time spent rendering response bodies as the "serialize" stage
+app = FastAPI(title="IP Lens Vector Generator & Search API", default_response_class=TimedJSONResponse)
 
 # Define which origins (frontends) are allowed to access your API
 origins = [
@@ -39,6 +79,9 @@ app.add_middleware(
     allow_methods=["*"], 
     allow_headers=["*"], 
 )
+app.add_middleware(RequestSizeLimitMiddleware)
+# Outermost, so rejected and failed requests are timed too
+app.add_middleware(MetricsMiddleware)
 
 # --- STATIC FILES SETUP: ---
 # 1. Ensure the directory exists
@@ -52,20 +95,186 @@ app.mount("/assets", StaticFiles(directory=ASSETS_FOLDER), name="assets")
 # --- END STATIC FILES SETUP ---
 
 
+# Load the model in the background so the process accepts connections (and /live) at once
+BACKGROUND_STARTUP = os.getenv("IPLENS_BACKGROUND_STARTUP", "1") == "1"
+# Run synthetic batches before reporting ready
+WARMUP = os.getenv("IPLENS_WARMUP", "1") == "1"
+
 # Global state
 MODEL: Dict[str, Any] = {}
+STARTUP_STATE: Dict[str, Any] = {"status": "starting", "error": None, "timings": {}}
+STARTUP_TASK: Optional[asyncio.Task] = None
 VECTOR_DIMENSION = 768 
 
+# Gathers concurrent embedding requests into a single forward pass
+BATCHER: MicroBatcher = None
+# Keeps decode, inference and database calls off the event loop
+EXECUTOR: InferenceExecutor = None
+# Content-addressed embeddings, so repeat uploads skip decode and inference
+CACHE: EmbeddingCache = None
+# Coalesces concurrent adds into batched upserts and keeps the running count
+WRITE_BUFFER: WriteBuffer = None
+# Gathers concurrent /search-text queries into one text tower forward pass
+TEXT_BATCHER: MicroBatcher = None
+# Embeddings of recent text queries, keyed by the hash of the normalized text
+TEXT_CACHE: EmbeddingCache = None
+
+
+# --- Scrape-time gauges over the components' own counters ---
+
+def _batcher_stats():
+    batchers = [BATCHER, TEXT_BATCHER, WRITE_BUFFER.batcher if WRITE_BUFFER is not None else None]
+    return [({"batcher": batcher.name}, batcher.queue_depth) for batcher in batchers if batcher is not None]
+
+def _executor_stats(key: str):
+    return lambda: [({"mode": EXECUTOR.mode}, EXECUTOR.stats()[key])] if EXECUTOR is not None else []
+
+def _cache_stats():
+    if CACHE is None:
+        return []
+    stats = CACHE.stats()
+    return [({"result": name}, stats[key]) for name, key in
+            (("memory_hit", "memory_hits"), ("disk_hit", "disk_hits"), ("miss", "misses"))]
+
+Gauge("iplens_batcher_queue_depth", "Items waiting for a batch.", ("batcher",)).set_function(_batcher_stats)
+Gauge("iplens_executor_pending", "Admitted requests in flight.", ("mode",)).set_function(_executor_stats("pending"))
+Gauge("iplens_executor_rejected", "Requests refused with 503 since startup.", ("mode",)).set_function(_executor_stats("rejected"))
+Gauge("iplens_cache_lookups", "Embedding cache lookups since startup, by result.", ("result",)).set_function(_cache_stats)
+Gauge("iplens_cache_hit_rate", "Share of embedding cache lookups that were hits.").set_function(
+    lambda: [({}, CACHE.stats()["hit_rate"])] if CACHE is not None else [])
+Gauge("iplens_cache_memory_bytes", "Bytes held by the in-memory embedding cache.").set_function(
+    lambda: [({}, CACHE.stats()["memory_bytes"])] if CACHE is not None else [])
+Gauge("iplens_process_resident_memory_bytes", "Resident set size of the API process.").set_function(
+    lambda: [({}, resident_memory_mb() * 1024 * 1024)])
+
+
+async def _warm_up():
+    """
+    Runs synthetic batches (a single image and a full batch) through the inference
+    path so the first real requests do not pay for lazy initialization, allocator
+    growth or, in process mode, the workers loading the model.
+    """
+    image = Image.new("RGB", (256, 256), (127, 127, 127))
+    for batch_size in sorted({1, BATCHER.max_batch_size}):
+        await asyncio.gather(*[
+            EXECUTOR.run_inference(EXECUTOR.embedding_fn, [image] * batch_size)
+            for _ in range(EXECUTOR.inference_workers)
+        ])
+    if TEXT_BATCHER is not None:
+        await asyncio.gather(*[
+            EXECUTOR.run_inference(EXECUTOR.text_embedding_fn, ["a photo"])
+            for _ in range(EXECUTOR.inference_workers)
+        ])
+
+
+async def _load_application():
+    """
+    Loads the model and the stores, starts the executor and batcher and warms them up.
+    MODEL is assigned last: endpoints answer 503 until everything they use is ready.
+    """
+    global MODEL, BATCHER, EXECUTOR, CACHE, WRITE_BUFFER, TEXT_BATCHER, TEXT_CACHE
+    started = time.perf_counter()
+    STARTUP_STATE["status"] = "loading"
+    try:
+        loop = asyncio.get_running_loop()
+        if INFERENCE_MODE == "process":
+            # The worker processes load their own model (during the warm-up below);
+            # this process only needs the database and the hash index
+            executor = InferenceExecutor(mode="process")
+            stores = asyncio.gather(loop.run_in_executor(None, load_vector_db), loop.run_in_executor(None, load_near_duplicate_index))
+        else:
+            assets = await loop.run_in_executor(None, load_ip_model)
+            executor = InferenceExecutor(loaded_assets=assets, mode="thread")
+        executor.start()
+        STARTUP_STATE["timings"]["load_seconds"] = time.perf_counter() - started
+
+        EXECUTOR = executor
+        BATCHER = MicroBatcher(EXECUTOR.embedding_fn, runner=EXECUTOR.run_inference)
+        await BATCHER.start()
+        CACHE = EmbeddingCache(model_name=EXECUTOR.model_name, weights_name=EXECUTOR.weights_name)
+        if TEXT_SEARCH:
+            TEXT_BATCHER = MicroBatcher(EXECUTOR.text_embedding_fn, runner=EXECUTOR.run_inference, name="text")
+            await TEXT_BATCHER.start()
+            # The text tower always runs in fp32 on raw strings, whatever the image backend
+            TEXT_CACHE = EmbeddingCache(model_name=EXECUTOR.model_name, weights_name=EXECUTOR.weights_name,
+                                        backend="fp32", preprocess="text",
+                                        memory_budget_bytes=TEXT_CACHE_MEMORY_BYTES, cache_dir=None)
+
+        if WARMUP:
+            warm_started = time.perf_counter()
+            await _warm_up()
+            STARTUP_STATE["timings"]["warmup_seconds"] = time.perf_counter() - warm_started
+
+        if INFERENCE_MODE == "process":
+            vector_db, phash_index = await stores
+            assets = {"vector_db": vector_db, "phash_index": phash_index}
+        WRITE_BUFFER = WriteBuffer(assets["vector_db"], assets.get("phash_index"), runner=EXECUTOR.run_blocking)
+        await WRITE_BUFFER.start()
+        MODEL = assets
+
+        STARTUP_STATE["timings"]["total_seconds"] = time.perf_counter() - started
+        STARTUP_STATE["status"] = "ready"
+        print(f"--- Application startup complete in {STARTUP_STATE['timings']['total_seconds']:.1f}s. Ready for requests. ---")
+    except Exception as e:
+        STARTUP_STATE["status"] = "failed"
+        STARTUP_STATE["error"] = str(e)
+        print(f"FATAL ERROR: Application startup failed. Details: {e}")
+        if not BACKGROUND_STARTUP:
+            raise
+
 
 @app.on_event("startup")
 async def startup_event():
     """
     Loads the ML model and initializes the vector database upon server startup.
+    With background startup (the default) the server accepts connections at once:
+    /live answers immediately and /ready turns 200 when loading and warm-up are done.
     """
-    global MODEL
+    global STARTUP_TASK
     print("--- Starting Application Setup ---")
-    MODEL = load_ip_model()
-    print("--- Application startup complete. Ready for requests. ---")
+    if PROFILE_REQUESTS_AT_STARTUP:
+        PROFILER.arm(PROFILE_REQUESTS_AT_STARTUP)
+    if BACKGROUND_STARTUP:
+        STARTUP_TASK = asyncio.create_task(_load_application())
+    else:
+        await _load_application()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Writes out buffered adds, stops the embedding batcher and the executor pools, and
+    persists the ANN index so vectors added while running are not re-encoded on the next start.
+    """
+    if STARTUP_TASK is not None and not STARTUP_TASK.done():
+        STARTUP_TASK.cancel()
+    if WRITE_BUFFER is not None:
+        await WRITE_BUFFER.stop()
+    if BATCHER is not None:
+        await BATCHER.stop()
+    if TEXT_BATCHER is not None:
+        await TEXT_BATCHER.stop()
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown()
+    if MODEL and isinstance(MODEL.get("vector_db"), AnnCollection):
+        MODEL["vector_db"].save()
+
+
+@app.exception_handler(ImageRejected)
+async def image_rejected_handler(request, exc: ImageRejected):
+    """Uploads over the byte or pixel limits are refused before they are decoded."""
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+
+@app.exception_handler(ExecutorSaturated)
+@app.exception_handler(BatcherSaturated)
+async def executor_saturated_handler(request, exc: Exception):
+    """Rejects work with a 503 instead of queueing it when the server (or a batcher queue) is at capacity."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server is at capacity, please retry shortly."},
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
 
 
 # --- (2) Pydantic Response Models ---
@@ -74,19 +283,72 @@ class VectorResponse(BaseModel):
     vector: list[float]
     status: str = "success"
 
+class BulkVector(BaseModel):
+    id: str
+    vector: list[float]
+
+class BulkAddError(BaseModel):
+    filename: str
+    detail: str
+
+class BulkVectorResponse(BaseModel):
+    vectors: list[BulkVector]
+    errors: list[BulkAddError]
+    status: str = "success"
+
 class AddResponse(BaseModel):
     id: str
     new_total_count: int
     status: str = "added"
     
+class BulkAddDuplicate(BaseModel):
+    id: str
+    duplicate_of: str
+
+class BulkAddResponse(BaseModel):
+    added: list[str]
+    duplicates: list[BulkAddDuplicate]
+    skipped: list[str]
+    errors: list[BulkAddError]
+    new_total_count: int
+    status: str = "success"
+    
 class SearchResponseItem(BaseModel):
     id: str
+    # Squared L2 distance between the query and stored vectors
     distance: float
     metadata: dict
+    # Differing perceptual hash bits (of 64), only for near-duplicate matches
+    hamming_distance: Optional[int] = None
+    # Cosine similarity (1 - distance / 2)
+    similarity: Optional[float] = None
 
 class SearchResponse(BaseModel):
     query_filename: str
     results: list[SearchResponseItem]
+    # "vector" for a CLIP search, "near-duplicate" when perceptual hash matches lead the results
+    match_type: str = "vector"
+    # Pass back as `cursor` for the next page; None on the last page
+    next_cursor: Optional[str] = None
+    status: str = "success"
+
+class TextSearchResponse(BaseModel):
+    query: str
+    results: list[SearchResponseItem]
+    next_cursor: Optional[str] = None
+    status: str = "success"
+
+class FusedResultItem(BaseModel):
+    id: str
+    score: float
+    distance: float
+    metadata: dict
+
+class MultiSearchResponse(BaseModel):
+    queries: list[SearchResponse]
+    fusion: str
+    fused: Optional[list[FusedResultItem]] = None
+    errors: list[BulkAddError]
     status: str = "success"
 
 
@@ -98,27 +360,143 @@ async def root():
     return {"message": "IP Lens API is running and ready to process images."}
 
 
+@app.get("/live")
+async def liveness():
+    """Liveness probe: the process is up and serving HTTP, whether or not the model is loaded."""
+    return {"status": "alive"}
+
+
+@app.get("/ready")
+async def readiness():
+    """Readiness probe: 200 once the model, stores and warm-up are done, 503 before (or on failure)."""
+    status_code = 200 if STARTUP_STATE["status"] == "ready" else 503
+    return JSONResponse(status_code=status_code, content=STARTUP_STATE)
+
+
+@app.get("/stats")
+async def get_stats():
+    """Returns the active index and batching, executor, embedding cache, text search and write buffer metrics."""
+    return {
+        "index": ACTIVE_INDEX.to_dict(),
+        "batching": BATCHER.stats() if BATCHER is not None else None,
+        "writes": {**WRITE_BUFFER.stats(), "batching": WRITE_BUFFER.batcher.stats()} if WRITE_BUFFER is not None else None,
+        "executor": EXECUTOR.stats() if EXECUTOR is not None else None,
+        "cache": CACHE.stats() if CACHE is not None else None,
+        "text": {**TEXT_CACHE.stats(), "batching": TEXT_BATCHER.stats()} if TEXT_BATCHER is not None else None,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Prometheus text exposition: per-route latency, per-stage timings (upload, cache,
+    decode, preprocess, inference, phash, db_*, serialize), batch sizes, queue waits,
+    queue depths, cache hits and process RSS.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/profile")
+async def profile_status():
+    """State of the sampling profiler and the path of the last profile written."""
+    return {"enabled": PROFILING_ENABLED, **PROFILER.status()}
+
+
+@app.post("/debug/profile")
+async def start_profile(requests: int = 100):
+    """
+    Samples every thread's stack until `requests` more requests have finished, then
+    writes a collapsed-stack profile (flamegraph.pl / speedscope) to the profile folder.
+    Only available when IPLENS_PROFILING=1.
+    """
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled. Set IPLENS_PROFILING=1 to enable it.")
+    if requests <= 0:
+        raise HTTPException(status_code=400, detail="requests must be positive.")
+    if PROFILER.armed:
+        raise HTTPException(status_code=409, detail="A profile is already being recorded.")
+    PROFILER.arm(requests)
+    return PROFILER.status()
+
+
+async def _embed_contents(source, image_hash: str):
+    """
+    Returns the vector for an upload (bytes or spooled file path), from the embedding
+    cache when possible and from a batched forward pass otherwise.
+    """
+    with stage("cache"):
+        ip_vector = await EXECUTOR.run_blocking(CACHE.get, image_hash)
+    if ip_vector is None:
+        with stage("decode"):
+            image = await EXECUTOR.run_blocking(decode_image, source)
+        # Queue wait, preprocessing and the forward pass of the shared batch
+        with stage("embed"):
+            ip_vector = await BATCHER.submit(image)
+        with stage("cache"):
+            await EXECUTOR.run_blocking(CACHE.put, image_hash, ip_vector)
+    return ip_vector
+
+
+async def _perceptual_hash(source) -> Optional[int]:
+    """Perceptual hash of an upload (bytes or spooled file path), or None when it cannot be hashed."""
+    try:
+        with stage("phash"):
+            return await EXECUTOR.run_blocking(perceptual_hash_encoded, source)
+    except Exception as e:
+        print(f"WARNING: Could not compute perceptual hash: {e}")
+        return None
+
+
+async def _spool_upload(spool: UploadSpool, file: UploadFile, filename: Optional[str] = None) -> SpooledUpload:
+    """Streams one uploaded image into the request's spool, hashing it on the way."""
+    with stage("upload"):
+        return await EXECUTOR.run_blocking(spool.add_file, file.file, filename or file.filename)
+
+
+def _existing_asset(filename: str, image_hash: str) -> Optional[bool]:
+    """None when ASSETS_FOLDER has no file of that name, otherwise whether it holds the same bytes."""
+    path = os.path.join(ASSETS_FOLDER, filename)
+    if not os.path.isfile(path):
+        return None
+    return hash_file(path) == image_hash
+
+
+def _discard_asset(path: str):
+    """Removes an asset file moved in by this request whose row was not written (its bytes are indexed under another name)."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
 # Endpoint 1: Generate Vector (for quick checks)
-@app.post("/generate-vector", response_model=VectorResponse)
-async def create_upload_file(file: UploadFile = File(...)):
+@app.post("/generate-vector", response_model=VectorResponse, responses=VECTOR_RESPONSES)
+async def create_upload_file(file: UploadFile = File(...), output: Optional[str] = Query(None, alias="format"),
+                             dtype: str = "float32", accept: Optional[str] = Header(None)):
     """
-    Receives an image and returns only the 768-dimensional feature vector.
+    Receives an image and returns only its feature vector (512 floats for ViT-B-16).
+    The encoding follows ?format= (json, base64, raw, msgpack) or the Accept header;
+    the binary encodings are little-endian `dtype` (float32 or float16).
     """
     if file.content_type not in ["image/jpeg", "image/png", "image/webp"]:
         raise HTTPException(status_code=400, detail="Invalid file type.")
+    fmt = negotiate_vector_format(accept, output, dtype)
+
+    if not MODEL or EXECUTOR is None:
+        raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
 
     try:
-        contents = await file.read()
-        image = Image.open(BytesIO(contents))
-        
-        if not MODEL:
-             raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
-        
-        # CORE LOGIC: Generate the Vector
-        ip_vector = generate_ip_vector(loaded_assets=MODEL, image=image) 
+        async with EXECUTOR.admission():
+            with UploadSpool(UPLOAD_SPOOL_FOLDER) as spool:
+                upload = await _spool_upload(spool, file)
+
+                # CORE LOGIC: Generate the Vector
+                ip_vector = await _embed_contents(upload.path, upload.content_hash)
         
-        return VectorResponse(vector=ip_vector.tolist())
+        return encode_vectors(ip_vector[None, :], fmt, dtype, single=True)
 
+    except (HTTPException, ExecutorSaturated, BatcherSaturated, ImageRejected):
+        raise
     except Exception as e:
         print(f"Error during vector generation: {e}")
         raise HTTPException(status_code=500, detail="Internal server error during vector processing.")
@@ -133,80 +511,453 @@ async def add_image_vector(file: UploadFile = File(...)):
     if file.content_type not in ["image/jpeg", "image/png", "image/webp"]:
         raise HTTPException(status_code=400, detail="Invalid file type.")
 
+    if not MODEL or EXECUTOR is None:
+        raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+
+    # Only the base name is used, so the asset cannot be written outside ASSETS_FOLDER
+    file_name_id = safe_filename(file.filename)
+    if file_name_id is None:
+        raise HTTPException(status_code=400, detail="Invalid filename.")
+
     try:
-        # Read file content and open as PIL Image
-        contents = await file.read()
-        image = Image.open(BytesIO(contents))
-        
-        if not MODEL:
-            raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+        async with EXECUTOR.admission():
+            file_path = os.path.join(ASSETS_FOLDER, file_name_id)
 
-        # --- NEW: Save file locally ---
-        file_name_id = file.filename 
-        file_path = os.path.join(ASSETS_FOLDER, file_name_id)
-        
-        # We check if the file already exists
-        if os.path.exists(file_path):
-             return JSONResponse(status_code=200, content={"message": f"File {file_name_id} already exists. Skipping save."})
-
-        # Save the file to disk so the frontend can retrieve it later via /assets
-        with open(file_path, "wb") as buffer:
-            buffer.write(contents)
-        # --- End NEW: Save file locally ---
-        
-        # Generate the Vector
-        ip_vector = generate_ip_vector(loaded_assets=MODEL, image=image)
-        
-        # Add to the Database
-        collection = MODEL.get("vector_db")
-        if not collection:
-            raise HTTPException(status_code=500, detail="Vector database not initialized.")
+            collection = MODEL.get("vector_db")
+            if not collection:
+                raise HTTPException(status_code=500, detail="Vector database not initialized.")
 
-        
-        new_count = add_vector_to_db(
-            collection=collection,
-            vector=ip_vector,
-            file_name=file_name_id,
-            # CRITICAL: Ensure 'filename' is in metadata so frontend knows what to request
-            metadata={"filename": file.filename, "upload_time": str(datetime.now())} 
-        )
+            # We check if the file is already indexed; a file that is only on disk gets indexed
+            with stage("db_lookup"):
+                indexed = await EXECUTOR.run_blocking(find_existing_ids, collection, [file_name_id])
+            if indexed:
+                 return JSONResponse(status_code=200, content={"message": f"File {file_name_id} already exists. Skipping save."})
+
+            with UploadSpool(UPLOAD_SPOOL_FOLDER) as spool:
+                # Stream the upload to disk; its content hash is computed on the way
+                upload = await _spool_upload(spool, file, file_name_id)
+
+                # The same bytes under a different filename are detected without a forward pass
+                with stage("db_lookup"):
+                    duplicate_id = await EXECUTOR.run_blocking(find_by_content_hash, collection, upload.content_hash)
+                if duplicate_id is not None:
+                    return AddResponse(id=duplicate_id, new_total_count=WRITE_BUFFER.count, status="duplicate")
+
+                # An unindexed file of that name is kept: indexed if it holds these bytes, refused otherwise
+                same_bytes = await EXECUTOR.run_blocking(_existing_asset, file_name_id, upload.content_hash)
+                if same_bytes is False:
+                    raise HTTPException(status_code=409, detail=f"A different file named {file_name_id} already exists.")
+
+                # Generate the Vector (decoded from the spooled file)
+                ip_vector = await _embed_contents(upload.path, upload.content_hash)
+                phash = await _perceptual_hash(upload.path)
+
+                # Save file locally: a rename of the spooled file, not a second write
+                if same_bytes is None:
+                    await EXECUTOR.run_blocking(upload.move_to, file_path)
+
+            # Add to the Database: batched with concurrent adds, returns once written
+            with stage("db_add"):
+                duplicate_of, new_count = await WRITE_BUFFER.add(
+                    file_name_id,
+                    ip_vector,
+                    # CRITICAL: Ensure 'filename' is in metadata so frontend knows what to request
+                    metadata={"filename": file_name_id, "upload_time": str(datetime.now())},
+                    content_hash=upload.content_hash,
+                    perceptual_hash=phash
+                )
+            if duplicate_of is not None:
+                # Identical bytes reached the same flush under another name: that name keeps the asset.
+                # Only a file this request moved into place is removed, never one that was there before
+                if duplicate_of != file_name_id and upload.moved:
+                    await EXECUTOR.run_blocking(_discard_asset, upload.path)
+                return AddResponse(id=duplicate_of, new_total_count=new_count, status="duplicate")
         
         return AddResponse(id=file_name_id, new_total_count=new_count)
 
+    except (HTTPException, ExecutorSaturated, BatcherSaturated, ImageRejected):
+        raise
     except Exception as e:
         print(f"Error during vector addition: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error during vector storage: {e}")
 
 
+def _is_archive(file: UploadFile) -> bool:
+    name = (file.filename or "").lower()
+    return file.content_type in ARCHIVE_CONTENT_TYPES or name.endswith(ARCHIVE_EXTENSIONS)
+
+
+async def _collect_entries(spool: UploadSpool, files: List[UploadFile]) -> Tuple[List[SpooledUpload], List[BulkAddError]]:
+    """
+    Streams plain image files and the images inside zip/tar archives into the spool.
+    Raises 413 when the request holds more than MAX_BULK_FILES images.
+    """
+    entries: List[SpooledUpload] = []
+    errors: List[BulkAddError] = []
+    for file in files:
+        if _is_archive(file):
+            with stage("upload"):
+                archive = await EXECUTOR.run_blocking(spool.add_file, file.file, file.filename, MAX_ARCHIVE_BYTES)
+            try:
+                with stage("upload"):
+                    entries.extend(await EXECUTOR.run_blocking(spool.extract_archive, archive, ALLOWED_EXTENSIONS))
+            except ImageRejected:
+                raise
+            except Exception as e:
+                errors.append(BulkAddError(filename=file.filename or "", detail=f"Unreadable archive: {e}"))
+            finally:
+                archive.discard()
+        elif file.content_type in ["image/jpeg", "image/png", "image/webp"]:
+            # Directories in the client's filename are dropped, as for archive members
+            filename = safe_filename(file.filename)
+            if filename is None:
+                errors.append(BulkAddError(filename=file.filename or "", detail="Invalid filename."))
+                continue
+            try:
+                entries.append(await _spool_upload(spool, file, filename))
+            except ImageRejected as e:
+                errors.append(BulkAddError(filename=file.filename or "", detail=str(e)))
+        else:
+            errors.append(BulkAddError(filename=file.filename or "", detail="Invalid file type."))
+
+        if len(entries) > MAX_BULK_FILES:
+            raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_FILES} images per request.")
+    return entries, errors
+
+
+async def _embed_many(sources: list, image_hashes: List[str]) -> list:
+    """
+    Embeds many uploads (bytes or spooled file paths) in INGEST_BATCH_SIZE forward passes,
+    reusing cached vectors. Only one batch of decoded images is held at a time.
+    Returns one vector per upload, or the exception raised while decoding it.
+    """
+    with stage("cache"):
+        results = await EXECUTOR.run_blocking(lambda: [CACHE.get(image_hash) for image_hash in image_hashes])
+    missing = [i for i, vector in enumerate(results) if vector is None]
+
+    for start in range(0, len(missing), INGEST_BATCH_SIZE):
+        chunk = missing[start:start + INGEST_BATCH_SIZE]
+        # Decode the batch in parallel on the blocking pool
+        with stage("decode"):
+            decoded = await asyncio.gather(
+                *[EXECUTOR.run_blocking(decode_image, sources[i]) for i in chunk],
+                return_exceptions=True
+            )
+        to_embed = []
+        for i, image in zip(chunk, decoded):
+            if isinstance(image, Exception):
+                results[i] = image
+            else:
+                to_embed.append((i, image))
+        if not to_embed:
+            continue
+
+        with stage("embed"):
+            vectors = await EXECUTOR.run_inference(EXECUTOR.embedding_fn, [image for _, image in to_embed])
+        with stage("cache"):
+            for (i, _), vector in zip(to_embed, vectors):
+                results[i] = vector
+                await EXECUTOR.run_blocking(CACHE.put, image_hashes[i], vector)
+
+    return results
+
+
+# Endpoint 1b: Generate Vectors (many images, no storage)
+@app.post("/generate-vectors", response_model=BulkVectorResponse, responses=VECTOR_RESPONSES)
+async def create_upload_files(files: List[UploadFile] = File(...), output: Optional[str] = Query(None, alias="format"),
+                              dtype: str = "float32", accept: Optional[str] = Header(None)):
+    """
+    Returns the vectors of many images (plain files and/or zip/tar archives) without storing
+    them, in the encodings of /generate-vector. The binary encodings hold one row per image in
+    upload order; rows of images that could not be decoded are NaN and listed in errors.
+    The raw encoding has no room for ids or errors: with archives, whose member order the
+    client may not know, ask for base64 or msgpack instead.
+    """
+    fmt = negotiate_vector_format(accept, output, dtype)
+    if not MODEL or EXECUTOR is None:
+        raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+
+    try:
+        async with EXECUTOR.admission():
+            with UploadSpool(UPLOAD_SPOOL_FOLDER) as spool:
+                entries, errors = await _collect_entries(spool, files)
+                vectors = await _embed_many([upload.path for upload in entries],
+                                            [upload.content_hash for upload in entries])
+
+        embedded = [vector for vector in vectors if not isinstance(vector, Exception)]
+        matrix = np.full((len(entries), len(embedded[0]) if embedded else 0), np.nan, dtype=np.float32)
+        for row, (upload, vector) in enumerate(zip(entries, vectors)):
+            if isinstance(vector, Exception):
+                errors.append(BulkAddError(filename=upload.filename, detail=f"Could not decode image: {vector}"))
+            else:
+                matrix[row] = vector
+        ids = [upload.filename for upload in entries]
+        if fmt == "json":
+            keep = [row for row, vector in enumerate(vectors) if not isinstance(vector, Exception)]
+            matrix, ids = matrix[keep], [ids[row] for row in keep]
+        return encode_vectors(matrix, fmt, dtype, ids=ids, extra={"errors": [error.model_dump() for error in errors]})
+
+    except (HTTPException, ExecutorSaturated, BatcherSaturated, ImageRejected):
+        raise
+    except Exception as e:
+        print(f"Error during bulk vector generation: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error during vector processing.")
+
+
+# Endpoint 2b: Add Vectors (bulk ingestion)
+@app.post("/add-vectors", response_model=BulkAddResponse)
+async def add_image_vectors(files: List[UploadFile] = File(...)):
+    """
+    Adds many images at once. Accepts several image files and/or zip/tar archives of images,
+    embeds them in batches and writes them to the vector database with a single add.
+    Files are saved under their base name; a name taken by different bytes in the assets
+    folder is reported in errors and the existing file is left alone.
+    """
+    if not MODEL or EXECUTOR is None:
+        raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+
+    collection = MODEL.get("vector_db")
+    if not collection:
+        raise HTTPException(status_code=500, detail="Vector database not initialized.")
+
+    try:
+        async with EXECUTOR.admission():
+            with UploadSpool(UPLOAD_SPOOL_FOLDER) as spool:
+                # 1. Stream plain files and archive members into the spool
+                entries, errors = await _collect_entries(spool, files)
+
+                # 2. Skip files that are already indexed, and repeated names or bytes within this request
+                #    (a file that is only in ASSETS_FOLDER, e.g. ingested from there, gets indexed)
+                with stage("db_lookup"):
+                    indexed = await EXECUTOR.run_blocking(find_existing_ids, collection,
+                                                          [upload.filename for upload in entries])
+                skipped: List[str] = []
+                duplicates: List[BulkAddDuplicate] = []
+                seen_names, seen_hashes = set(), {}
+                candidates: List[SpooledUpload] = []
+                for upload in entries:
+                    if upload.filename in seen_names or upload.filename in indexed:
+                        skipped.append(upload.filename)
+                    elif upload.content_hash in seen_hashes:
+                        duplicates.append(BulkAddDuplicate(id=upload.filename, duplicate_of=seen_hashes[upload.content_hash]))
+                    else:
+                        seen_hashes[upload.content_hash] = upload.filename
+                        candidates.append(upload)
+                    seen_names.add(upload.filename)
+
+                # 3. Drop bytes that are already indexed under another filename
+                with stage("db_lookup"):
+                    stored = await EXECUTOR.run_blocking(find_existing_content_hashes, collection,
+                                                         [upload.content_hash for upload in candidates])
+                unstored = []
+                for upload in candidates:
+                    if upload.content_hash in stored:
+                        duplicates.append(BulkAddDuplicate(id=upload.filename, duplicate_of=stored[upload.content_hash]))
+                    else:
+                        unstored.append(upload)
+
+                # An unindexed file of the same name in ASSETS_FOLDER is indexed when it holds
+                # these bytes and never replaced when it holds others
+                on_disk = await EXECUTOR.run_blocking(
+                    lambda: [_existing_asset(upload.filename, upload.content_hash) for upload in unstored]
+                )
+                new_entries, present = [], set()
+                for upload, same_bytes in zip(unstored, on_disk):
+                    if same_bytes is False:
+                        errors.append(BulkAddError(filename=upload.filename,
+                                                   detail=f"A different file named {upload.filename} already exists."))
+                        continue
+                    if same_bytes:
+                        present.add(upload.filename)
+                    new_entries.append(upload)
+
+                # 4. Embed in batches, decoding from the spooled files
+                vectors = await _embed_many([upload.path for upload in new_entries],
+                                            [upload.content_hash for upload in new_entries])
+                ready, ready_vectors = [], []
+                for upload, vector in zip(new_entries, vectors):
+                    if isinstance(vector, Exception):
+                        errors.append(BulkAddError(filename=upload.filename, detail=f"Could not decode image: {vector}"))
+                    else:
+                        ready.append(upload)
+                        ready_vectors.append(vector)
+
+                # 5. Move the originals into place and write every vector with one batched add
+                phashes = await asyncio.gather(*[_perceptual_hash(upload.path) for upload in ready])
+                await EXECUTOR.run_blocking(
+                    lambda: [upload.move_to(os.path.join(ASSETS_FOLDER, upload.filename))
+                             for upload in ready if upload.filename not in present]
+                )
+            upload_time = str(datetime.now())
+            with stage("db_add"):
+                written = await WRITE_BUFFER.add_many(
+                    [upload.filename for upload in ready],
+                    ready_vectors,
+                    metadatas=[{"filename": upload.filename, "upload_time": upload_time} for upload in ready],
+                    content_hashes=[upload.content_hash for upload in ready],
+                    perceptual_hashes=list(phashes)
+                )
+            added = []
+            for upload, (duplicate_of, _) in zip(ready, written):
+                if duplicate_of is None:
+                    added.append(upload.filename)
+                else:
+                    duplicates.append(BulkAddDuplicate(id=upload.filename, duplicate_of=duplicate_of))
+            # Assets whose bytes turned out to be stored under another name are not kept; only
+            # files this request moved into place are removed, never ones that were there before
+            orphans = [upload.path for upload, (duplicate_of, _) in zip(ready, written)
+                       if upload.moved and duplicate_of is not None and duplicate_of != upload.filename]
+            if orphans:
+                await EXECUTOR.run_blocking(lambda: [_discard_asset(path) for path in orphans])
+            new_count = WRITE_BUFFER.count
+
+        return BulkAddResponse(
+            added=added,
+            duplicates=duplicates,
+            skipped=skipped,
+            errors=errors,
+            new_total_count=new_count
+        )
+
+    except (HTTPException, ExecutorSaturated, BatcherSaturated, ImageRejected):
+        raise
+    except Exception as e:
+        print(f"Error during bulk vector addition: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error during bulk vector storage: {e}")
+
+
+def _parse_where(where: Optional[str]) -> Optional[dict]:
+    """Parses the `where` query parameter: a JSON metadata filter in Chroma syntax."""
+    if not where:
+        return None
+    try:
+        parsed = json.loads(where)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"where is not valid JSON: {e}")
+    if not isinstance(parsed, dict):
+        raise HTTPException(status_code=400, detail='where must be a JSON object, e.g. {"ipId": "0x..."}.')
+    return parsed or None
+
+
+def _query_fingerprint(content_hash: str, where: Optional[dict], min_similarity: Optional[float]) -> str:
+    """Identifies a search, so a cursor cannot be replayed against a different one."""
+    key = json.dumps([content_hash, where, min_similarity], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _encode_cursor(offset: int, fingerprint: str) -> str:
+    payload = json.dumps({"offset": offset, "query": fingerprint}).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, fingerprint: str) -> int:
+    """Returns the offset a cursor points at; 400 if it is malformed or from another search."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset, query = int(data["offset"]), data["query"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if query != fingerprint or offset < 0:
+        raise HTTPException(status_code=400, detail="The cursor belongs to a different search.")
+    return offset
+
+
+async def _near_duplicate_items(matches: List[Tuple[str, int]], query_vector: np.ndarray,
+                                where: Optional[dict] = None) -> List[SearchResponseItem]:
+    """
+    Search results for perceptual hash matches, closest hash first. distance and similarity
+    are computed from the stored vectors like any other result; the hash distance is in
+    hamming_distance. Matches no longer in the collection (or failing `where`) are dropped.
+    """
+    with stage("db_lookup"):
+        stored = await EXECUTOR.run_blocking(MODEL["vector_db"].get, ids=[item_id for item_id, _ in matches],
+                                             where=where, include=["metadatas", "embeddings"])
+    embeddings = stored.get("embeddings")
+    rows = dict(zip(stored.get("ids", []), zip(stored.get("metadatas") or [], [] if embeddings is None else embeddings)))
+    items = []
+    for item_id, bits in matches:
+        if item_id in rows:
+            metadata, embedding = rows[item_id]
+            distance = float(np.sum((np.asarray(embedding, dtype=np.float32) - query_vector) ** 2))
+            items.append(SearchResponseItem(id=item_id, distance=distance, metadata=metadata or {},
+                                            hamming_distance=bits, similarity=similarity_from_distance(distance)))
+    return items
+
+
 # Endpoint 3: Search Vector (the main goal!)
 @app.post("/search-vector", response_model=SearchResponse)
-async def search_for_similar_images(file: UploadFile = File(...), n_results: int = 5):
+async def search_for_similar_images(file: UploadFile = File(...), n_results: int = 5, nprobe: Optional[int] = None,
+                                    near_duplicates: bool = False, where: Optional[str] = None,
+                                    cursor: Optional[str] = None, min_similarity: Optional[float] = None):
     """
     Generates a vector for the input image and searches the database for N most similar vectors.
+    With an ANN index loaded, `nprobe` sets how many inverted lists are scanned
+    (higher = better recall, slower); it is ignored for exact search.
+    With `near_duplicates`, the first page also checks the perceptual hash index:
+    re-encodes, resizes and light crops of indexed assets lead the results (with their
+    Hamming distance) and the rest of the page comes from the vector ranking, which
+    next_cursor continues. It does not apply with `min_similarity`.
+
+    `where` is a JSON metadata filter (e.g. {"ipId": "0x..."} or
+    {"upload_time": {"$gte": "2025-01-01"}}) applied by the store before ranking.
+    Results below `min_similarity` (cosine, -1..1) are cut off. Pass a response's
+    `next_cursor` back as `cursor` (with the same image and filters) for the next page.
     """
     if file.content_type not in ["image/jpeg", "image/png", "image/webp"]:
         raise HTTPException(status_code=400, detail="Invalid file type.")
 
+    if n_results < 1:
+        raise HTTPException(status_code=400, detail="n_results must be at least 1.")
+    if min_similarity is not None and not -1.0 <= min_similarity <= 1.0:
+        raise HTTPException(status_code=400, detail="min_similarity must be between -1 and 1.")
+    where_filter = _parse_where(where)
+
+    if not MODEL or EXECUTOR is None:
+        raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+
     try:
-        contents = await file.read()
-        image = Image.open(BytesIO(contents))
-        
-        if not MODEL:
-            raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+        async with EXECUTOR.admission():
+            with UploadSpool(UPLOAD_SPOOL_FOLDER) as spool:
+                upload = await _spool_upload(spool, file)
+
+                fingerprint = _query_fingerprint(upload.content_hash, where_filter, min_similarity)
+                offset = _decode_cursor(cursor, fingerprint) if cursor else 0
+                if offset + n_results > MAX_SEARCH_WINDOW:
+                    raise HTTPException(status_code=400, detail=f"Results beyond rank {MAX_SEARCH_WINDOW} are not available.")
+
+                # 0. Near-duplicate lookup on the perceptual hash (first page only, and not with a
+                #    similarity threshold, which would cut the ranking the page is filled from)
+                matches = []
+                phash_index = MODEL.get("phash_index")
+                if near_duplicates and phash_index is not None and cursor is None and min_similarity is None:
+                    phash = await _perceptual_hash(upload.path)
+                    if phash is not None:
+                        with stage("phash"):
+                            matches = await EXECUTOR.run_blocking(phash_index.search, phash, PHASH_MAX_DISTANCE, n_results)
+
+                # 1. Generate the Query Vector
+                query_vector = await _embed_contents(upload.path, upload.content_hash)
             
-        # 1. Generate the Query Vector
-        query_vector = generate_ip_vector(loaded_assets=MODEL, image=image)
-        
-        # 2. Search the Database
-        collection = MODEL.get("vector_db")
-        if not collection:
-            raise HTTPException(status_code=500, detail="Vector database not initialized.")
-        
-        raw_results = search_vector_db(
-            collection=collection, 
-            query_vector=query_vector, 
-            n_results=n_results
-        )
+            # 2. Search the Database
+            collection = MODEL.get("vector_db")
+            if not collection:
+                raise HTTPException(status_code=500, detail="Vector database not initialized.")
+            
+            with stage("db_query"):
+                try:
+                    raw_results, has_more = await EXECUTOR.run_blocking(
+                        search_vector_page,
+                        collection=collection, 
+                        query_vector=query_vector, 
+                        n_results=n_results,
+                        offset=offset,
+                        where=where_filter,
+                        min_similarity=min_similarity,
+                        nprobe=nprobe
+                    )
+                except ValueError as e:
+                    # Filters the store cannot evaluate (unknown operators, bad field names)
+                    raise HTTPException(status_code=400, detail=f"Invalid where filter: {e}")
 
         # 3. Format the Results for the Frontend
         # ChromaDB results are nested lists, so we use indices [0]
@@ -219,14 +970,217 @@ async def search_for_similar_images(file: UploadFile = File(...), n_results: int
             formatted_results.append(SearchResponseItem(
                 id=ids[i],
                 distance=distances[i],
-                metadata=metadatas[i] or {}
+                metadata=metadatas[i] or {},
+                similarity=similarity_from_distance(distances[i])
             ))
-        
+
+        # 4. Near-duplicates lead the page, vector results fill it. The cursor moves past every
+        #    vector rank used or skipped (as a near-duplicate already shown); near-duplicates
+        #    ranked deeper than this page can show up again on a later one
+        pinned = await _near_duplicate_items(matches, query_vector, where_filter) if matches else []
+        consumed = len(ids)
+        if pinned:
+            pinned_ids = {item.id for item in pinned}
+            rest, consumed = [], 0
+            for item in formatted_results:
+                if item.id not in pinned_ids:
+                    if len(pinned) + len(rest) >= n_results:
+                        break
+                    rest.append(item)
+                consumed += 1
+            has_more = has_more or consumed < len(ids)
+            formatted_results = pinned + rest
+
         return SearchResponse(
             query_filename=file.filename,
-            results=formatted_results
+            results=formatted_results,
+            match_type="near-duplicate" if pinned else "vector",
+            next_cursor=_encode_cursor(offset + consumed, fingerprint) if has_more else None
         )
 
+    except (HTTPException, ExecutorSaturated, BatcherSaturated, ImageRejected):
+        raise
     except Exception as e:
         print(f"Error during vector search: {e}")
-        raise HTTPException(status_code=500, detail=f"Internal server error during vector search: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Internal server error during vector search: {e}")
+
+
+# Endpoint 3b: Search Vectors (many query images per request)
+@app.post("/search-vectors", response_model=MultiSearchResponse)
+async def search_for_many_images(files: List[UploadFile] = File(...), n_results: int = 5, fusion: str = "none",
+                                 nprobe: Optional[int] = None, where: Optional[str] = None):
+    """
+    Searches with many query images (plain files and/or zip/tar archives) at once.
+    The images are embedded in batches and looked up with a single multi-query call.
+    Every query gets its own results; `fusion` optionally adds one combined ranking:
+    "mean" searches with the averaged query vector, "rrf" merges the per-query
+    rankings with reciprocal rank fusion. `where` filters by metadata as in /search-vector.
+    """
+    if fusion not in FUSION_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown fusion '{fusion}'. Use one of {', '.join(FUSION_METHODS)}.")
+    if n_results < 1:
+        raise HTTPException(status_code=400, detail="n_results must be at least 1.")
+    if n_results > MAX_SEARCH_WINDOW:
+        raise HTTPException(status_code=400, detail=f"Results beyond rank {MAX_SEARCH_WINDOW} are not available.")
+    where_filter = _parse_where(where)
+
+    if not MODEL or EXECUTOR is None:
+        raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+
+    collection = MODEL.get("vector_db")
+    if not collection:
+        raise HTTPException(status_code=500, detail="Vector database not initialized.")
+
+    try:
+        async with EXECUTOR.admission():
+            # 1. Collect and embed the query images
+            with UploadSpool(UPLOAD_SPOOL_FOLDER) as spool:
+                entries, errors = await _collect_entries(spool, files)
+                vectors = await _embed_many([upload.path for upload in entries],
+                                            [upload.content_hash for upload in entries])
+
+            query_names, query_vectors = [], []
+            for upload, vector in zip(entries, vectors):
+                if isinstance(vector, Exception):
+                    errors.append(BulkAddError(filename=upload.filename, detail=f"Could not decode image: {vector}"))
+                else:
+                    query_names.append(upload.filename)
+                    query_vectors.append(vector)
+
+            if not query_vectors:
+                return MultiSearchResponse(queries=[], fusion=fusion, errors=errors)
+
+            # 2. One multi-query lookup (plus one more for the mean vector)
+            try:
+                with stage("db_query"):
+                    raw_results = await EXECUTOR.run_blocking(
+                        search_vectors_db, collection=collection, query_vectors=query_vectors,
+                        n_results=n_results, nprobe=nprobe, where=where_filter
+                    )
+                fused = None
+                if fusion == "mean":
+                    with stage("db_query"):
+                        mean_results = await EXECUTOR.run_blocking(
+                            search_vector_db, collection=collection, query_vector=mean_query_vector(query_vectors),
+                            n_results=n_results, nprobe=nprobe, where=where_filter
+                        )
+                    fused = [FusedResultItem(id=item_id, score=similarity_from_distance(distance), distance=distance,
+                                             metadata=metadata or {})
+                             for item_id, distance, metadata in zip(mean_results['ids'][0], mean_results['distances'][0],
+                                                                    mean_results['metadatas'][0])]
+                elif fusion == "rrf":
+                    fused = [FusedResultItem(**entry) for entry in reciprocal_rank_fusion(raw_results, n_results)]
+            except ValueError as e:
+                if not where_filter:
+                    raise
+                # Filters the store cannot evaluate (unknown operators, bad field names)
+                raise HTTPException(status_code=400, detail=f"Invalid where filter: {e}")
+
+        # 3. Per-query results, in upload order
+        queries = []
+        for file_name, ids, distances, metadatas in zip(query_names, raw_results['ids'],
+                                                        raw_results['distances'], raw_results['metadatas']):
+            queries.append(SearchResponse(
+                query_filename=file_name,
+                results=[SearchResponseItem(id=ids[i], distance=distances[i], metadata=metadatas[i] or {},
+                                            similarity=similarity_from_distance(distances[i]))
+                         for i in range(len(ids))]
+            ))
+
+        return MultiSearchResponse(queries=queries, fusion=fusion, fused=fused, errors=errors)
+
+    except (HTTPException, ExecutorSaturated, BatcherSaturated, ImageRejected):
+        raise
+    except Exception as e:
+        print(f"Error during multi-vector search: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error during multi-vector search: {e}")
+
+
+async def _embed_text(query: str) -> Tuple[str, Any]:
+    """
+    Returns (text hash, vector) for a normalized text query, from the text cache when
+    possible and from a batched text tower forward pass otherwise.
+    """
+    text_hash = content_hash(query.encode("utf-8"))
+    with stage("text_cache"):
+        query_vector = TEXT_CACHE.get(text_hash)
+    if query_vector is None:
+        # Queue wait, tokenization and the forward pass of the shared batch
+        with stage("embed"):
+            query_vector = await TEXT_BATCHER.submit(query)
+        TEXT_CACHE.put(text_hash, query_vector)
+    return text_hash, query_vector
+
+
+# Endpoint 3c: Search Text (text-to-image)
+@app.get("/search-text", response_model=TextSearchResponse)
+async def search_by_text(q: str, n_results: int = 5, nprobe: Optional[int] = None, where: Optional[str] = None,
+                         cursor: Optional[str] = None, min_similarity: Optional[float] = None):
+    """
+    Encodes a text query with the CLIP text tower and searches the image vectors with it.
+    `nprobe`, `where`, `cursor` and `min_similarity` work as on /search-vector; note that
+    text-to-image cosine similarities are much lower than image-to-image ones (roughly 0.2-0.35
+    for good matches), so thresholds tuned for image search do not carry over.
+    """
+    query = normalize_text_query(q)
+    if not query:
+        raise HTTPException(status_code=400, detail="q must not be empty.")
+    if len(query) > MAX_TEXT_QUERY_CHARS:
+        raise HTTPException(status_code=400, detail=f"q is longer than {MAX_TEXT_QUERY_CHARS} characters.")
+    if n_results < 1:
+        raise HTTPException(status_code=400, detail="n_results must be at least 1.")
+    if min_similarity is not None and not -1.0 <= min_similarity <= 1.0:
+        raise HTTPException(status_code=400, detail="min_similarity must be between -1 and 1.")
+    where_filter = _parse_where(where)
+
+    if not TEXT_SEARCH:
+        raise HTTPException(status_code=404, detail="Text search is disabled. Set IPLENS_TEXT_SEARCH=1 to enable it.")
+    if not MODEL or EXECUTOR is None or TEXT_BATCHER is None:
+        raise HTTPException(status_code=503, detail="Model is still loading or failed to load.")
+
+    try:
+        async with EXECUTOR.admission():
+            text_hash, query_vector = await _embed_text(query)
+
+            fingerprint = _query_fingerprint(f"text:{text_hash}", where_filter, min_similarity)
+            offset = _decode_cursor(cursor, fingerprint) if cursor else 0
+            if offset + n_results > MAX_SEARCH_WINDOW:
+                raise HTTPException(status_code=400, detail=f"Results beyond rank {MAX_SEARCH_WINDOW} are not available.")
+
+            collection = MODEL.get("vector_db")
+            if not collection:
+                raise HTTPException(status_code=500, detail="Vector database not initialized.")
+
+            with stage("db_query"):
+                try:
+                    raw_results, has_more = await EXECUTOR.run_blocking(
+                        search_vector_page,
+                        collection=collection,
+                        query_vector=query_vector,
+                        n_results=n_results,
+                        offset=offset,
+                        where=where_filter,
+                        min_similarity=min_similarity,
+                        nprobe=nprobe
+                    )
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=f"Invalid where filter: {e}")
+
+        ids = raw_results.get('ids', [[]])[0]
+        distances = raw_results.get('distances', [[]])[0]
+        metadatas = raw_results.get('metadatas', [[]])[0]
+        results = [SearchResponseItem(id=ids[i], distance=distances[i], metadata=metadatas[i] or {},
+                                      similarity=similarity_from_distance(distances[i]))
+                   for i in range(len(ids))]
+
+        return TextSearchResponse(
+            query=query,
+            results=results,
+            next_cursor=_encode_cursor(offset + len(ids), fingerprint) if has_more else None
+        )
+
+    except (HTTPException, ExecutorSaturated, BatcherSaturated):
+        raise
+    except Exception as e:
+        print(f"Error during text search: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error during text search: {e}")
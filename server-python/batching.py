@@ -0,0 +1,221 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from metrics import BATCH_SIZE, QUEUE_WAIT_SECONDS, add_stages, collect_stages
+
+# --- Configuration ---
+# Largest number of requests that are stacked into a single forward pass
+MAX_BATCH_SIZE = int(os.getenv("IPLENS_MAX_BATCH_SIZE", "16"))
+# How long the first request of a batch may wait for others to join it (milliseconds)
+MAX_BATCH_WAIT_MS = float(os.getenv("IPLENS_MAX_BATCH_WAIT_MS", "10"))
+# Items that may wait for a batch; further submissions are refused (or wait, if they ask to)
+MAX_QUEUE_SIZE = int(os.getenv("IPLENS_MAX_BATCH_QUEUE", "256"))
+# Number of recent queue-wait samples kept for the percentile metrics
+WAIT_SAMPLE_SIZE = 1024
+
+
+class BatcherSaturated(Exception):
+    """Raised when a batcher's queue already holds its maximum number of items."""
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent submissions into batches and runs `batch_fn` once per batch.
+
+    `batch_fn` receives a list of items and must return one result per item, in order.
+    It runs outside the event loop (through `runner`) so new requests keep queueing
+    while a batch is being processed. The stages it records are added to the
+    Server-Timing of every request in the batch.
+
+    The queue holds at most `max_queue_size` items, so bulk callers cannot grow it past
+    what admission control allows; stop() fails every item still queued or in a batch.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], Any],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_ms: float = MAX_BATCH_WAIT_MS,
+        runner: Optional[Callable[..., Any]] = None,
+        name: str = "embedding",
+        max_queue_size: int = MAX_QUEUE_SIZE,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.runner = runner
+        self.name = name
+        self.max_queue_size = max(self.max_batch_size, max_queue_size)
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Entries of the batch being collected or run, failed by stop() if it never finishes
+        self._in_flight: list = []
+
+        # Metrics
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._batch_sizes: Dict[int, int] = {}
+        self._waits = deque(maxlen=WAIT_SAMPLE_SIZE)
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+
+    # --- (1) Lifecycle ---
+
+    async def start(self):
+        """Creates the queue and the background batching task on the running loop."""
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._worker = asyncio.create_task(self._run())
+        print(f"--- {self.name} batcher started (max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait * 1000:.1f}) ---")
+
+    async def stop(self):
+        """Stops the background task and fails every request still queued or in the running batch."""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._worker = None
+            pending = self._in_flight
+            self._in_flight = []
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"{self.name} batcher stopped"))
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    # --- (2) Submission ---
+
+    async def submit(self, item: Any, wait_if_full: bool = False) -> Any:
+        """
+        Queues a single item and waits for its result from the batch it ends up in.
+        Raises BatcherSaturated when the queue is full, unless `wait_if_full` asks to
+        wait for room instead.
+        """
+        if self._worker is None:
+            raise RuntimeError(f"{self.name} batcher is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (item, future, time.perf_counter())
+        if wait_if_full:
+            await self._queue.put(entry)
+        else:
+            try:
+                self._queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                raise BatcherSaturated(f"{self.name} batcher already holds {self.max_queue_size} items")
+        result, stages = await future
+        add_stages(stages)
+        return result
+
+    # --- (3) Batching Loop ---
+
+    async def _collect_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        # Entries taken off the queue are failed by stop() if it cancels the collection
+        self._in_flight = batch
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already queued without waiting
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+
+            # Requests whose callers went away (e.g. client disconnects) are dropped
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                self._record_wait(started - enqueued)
+            self._record_batch(len(batch))
+
+            items = [item for item, _, _ in batch]
+            self._in_flight = batch
+            try:
+                if self.runner is not None:
+                    results, stages = await self.runner(collect_stages, self.batch_fn, items)
+                else:
+                    results, stages = await asyncio.get_running_loop().run_in_executor(None, collect_stages,
+                                                                                       self.batch_fn, items)
+            except Exception as e:
+                self._in_flight = []
+                self._errors += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # Cleared only once the batch has an outcome: a cancelled batch is left for stop()
+            self._in_flight = []
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result((result, stages))
+
+    # --- (4) Metrics ---
+
+    def _record_wait(self, wait: float):
+        self._waits.append(wait)
+        self._total_wait += wait
+        self._max_wait_seen = max(self._max_wait_seen, wait)
+        QUEUE_WAIT_SECONDS.observe(wait, batcher=self.name)
+
+    def _record_batch(self, size: int):
+        self._batches += 1
+        self._items += size
+        self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+        BATCH_SIZE.observe(size, batcher=self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns batch-size and queue-wait metrics for this batcher."""
+        waits_ms = np.array(self._waits, dtype=np.float64) * 1000.0
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queue_depth": self.queue_depth,
+            "max_queue_size": self.max_queue_size,
+            "batches": self._batches,
+            "items": self._items,
+            "errors": self._errors,
+            "avg_batch_size": (self._items / self._batches) if self._batches else 0.0,
+            "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+            "queue_wait_ms": {
+                "avg": (self._total_wait * 1000.0 / self._items) if self._items else 0.0,
+                "max": self._max_wait_seen * 1000.0,
+                "p50": float(np.percentile(waits_ms, 50)) if waits_ms.size else 0.0,
+                "p95": float(np.percentile(waits_ms, 95)) if waits_ms.size else 0.0,
+                "p99": float(np.percentile(waits_ms, 99)) if waits_ms.size else 0.0,
+            },
+        }
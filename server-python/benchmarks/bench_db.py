@@ -0,0 +1,130 @@
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import chromadb
+
+# The benchmarks import the server modules from the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import latency_summary, random_unit_vectors, write_results  # noqa: E402
+from model_tools import add_vector_to_db, search_vector_db  # noqa: E402
+from vector_index import INDEX_DTYPE, MmapVectorIndex  # noqa: E402
+from vector_service import LocalShards, ShardedCollection  # noqa: E402
+
+DEFAULT_SIZES = "10000,100000,1000000"
+STORES = ("chroma", "mmap", "sharded")
+# Rows per bulk add while growing the collection (Chroma's client caps batches near 5.4k)
+FILL_BATCH_SIZE = 5000
+
+
+def open_store(store: str, path: str, stack: contextlib.ExitStack, shards: int = 4):
+    """
+    An empty collection of the given kind in `path`, opened the same way as the server's.
+    "sharded" starts `shards` local mmap shard services (stopped when `stack` closes).
+    """
+    if store == "sharded":
+        local = stack.enter_context(LocalShards(shards, data_dir=path))
+        return ShardedCollection(local.urls)
+    if store == "mmap":
+        return MmapVectorIndex(path, name="ip_vector_collection", dtype=INDEX_DTYPE)
+    client = chromadb.PersistentClient(path=path)
+    return client.create_collection(name="ip_vector_collection", embedding_function=None)
+
+
+def fill(collection, start: int, stop: int, dim: int) -> float:
+    """Bulk-adds synthetic rows [start, stop) and returns the rows added per second."""
+    started = time.perf_counter()
+    for offset in range(start, stop, FILL_BATCH_SIZE):
+        end = min(offset + FILL_BATCH_SIZE, stop)
+        vectors = random_unit_vectors(end - offset, dim, seed=offset)
+        collection.add(
+            ids=[f"bench-{i}" for i in range(offset, end)],
+            embeddings=vectors.tolist(),
+            documents=[f"Vector for file: bench-{i}" for i in range(offset, end)],
+            metadatas=[{"filename": f"bench-{i}.jpg"} for i in range(offset, end)],
+        )
+    elapsed = time.perf_counter() - started
+    return (stop - start) / elapsed if elapsed else 0.0
+
+
+def run_store(store: str, sizes: List[int], dim: int, adds: int, queries: int, n_results: int,
+              shards: int = 4) -> List[Dict[str, Any]]:
+    """
+    Grows one collection through `sizes` and, at each size, times single add_vector_to_db
+    calls (with the count() it returns) and search_vector_db top-n queries.
+    The rows added by the add benchmark stay in the collection.
+    """
+    path = tempfile.mkdtemp(prefix=f"iplens-bench-{store}-")
+    results = []
+    try:
+        with contextlib.ExitStack() as stack:
+            results.extend(_run_sizes(open_store(store, path, stack, shards), store, sizes, dim, adds, queries, n_results))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return results
+
+
+def _run_sizes(collection, store: str, sizes: List[int], dim: int, adds: int, queries: int,
+               n_results: int) -> List[Dict[str, Any]]:
+    results = []
+    filled = 0
+    for size in sizes:
+        bulk_rate = fill(collection, filled, size, dim)
+        filled = size
+
+        add_vectors = random_unit_vectors(adds, dim, seed=10_000_000 + size)
+        add_timings = []
+        for i, vector in enumerate(add_vectors):
+            t0 = time.perf_counter()
+            add_vector_to_db(collection, vector, f"bench-add-{size}-{i}", {"filename": f"bench-add-{size}-{i}.jpg"})
+            add_timings.append(time.perf_counter() - t0)
+
+        query_vectors = random_unit_vectors(queries + 1, dim, seed=20_000_000 + size)
+        search_vector_db(collection, query_vectors[0], n_results)  # warm-up (page cache, index load)
+        search_timings = []
+        for vector in query_vectors[1:]:
+            t0 = time.perf_counter()
+            search_vector_db(collection, vector, n_results)
+            search_timings.append(time.perf_counter() - t0)
+
+        result = {
+            "store": store,
+            "size": size,
+            "dim": dim,
+            "bulk_add_rows_per_second": bulk_rate,
+            "add": latency_summary(add_timings),
+            "search": latency_summary(search_timings),
+        }
+        results.append(result)
+        print(f"{store:<7} {size:>9}  bulk {bulk_rate:>9.0f} rows/s  "
+              f"add p50 {result['add']['p50_ms']:>7.2f} ms p99 {result['add']['p99_ms']:>7.2f} ms  "
+              f"search p50 {result['search']['p50_ms']:>7.2f} ms p99 {result['search']['p99_ms']:>7.2f} ms")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="add_vector_to_db and search_vector_db latency on synthetic collections.")
+    parser.add_argument("--stores", default=",".join(STORES), help="Comma separated: chroma, mmap, sharded.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated collection sizes, grown in order.")
+    parser.add_argument("--dim", type=int, default=512, help="Vector dimension (ViT-B-16 produces 512).")
+    parser.add_argument("--adds", type=int, default=100, help="Single adds timed per size.")
+    parser.add_argument("--queries", type=int, default=100, help="Searches timed per size.")
+    parser.add_argument("--n-results", type=int, default=10)
+    parser.add_argument("--shards", type=int, default=4, help="Local shard services for the sharded store.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    sizes = sorted(int(v) for v in args.sizes.split(","))
+    results = []
+    for store in args.stores.split(","):
+        if store not in STORES:
+            parser.error(f"Unknown store '{store}'. Use one of {', '.join(STORES)}.")
+        results.extend(run_store(store, sizes, args.dim, args.adds, args.queries, args.n_results, args.shards))
+    if args.json:
+        write_results(args.json, "db", vars(args), results)
@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+from typing import Any, Dict, List
+
+import numpy as np
+import open_clip
+from PIL import Image
+
+# The benchmarks import the server modules from the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import make_image, write_results  # noqa: E402
+from image_decode import FastPreprocess, decode_image  # noqa: E402
+from inference_backends import resident_memory_mb  # noqa: E402
+
+DEFAULT_SIZES = "1024x768,3000x2000,6000x4000"
+
+
+def baseline_path(contents: bytes, preprocess):
+    """The previous path: full decode, then the torchvision transform chain."""
+    image = Image.open(BytesIO(contents))
+    image.load()
+    return preprocess(image)
+
+
+def fast_path(contents: bytes, preprocess: FastPreprocess):
+    return preprocess(decode_image(contents))
+
+
+def measure(fn, contents: bytes, preprocess, repeats: int) -> Dict[str, float]:
+    fn(contents, preprocess)  # warm-up
+    rss_before = resident_memory_mb()
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn(contents, preprocess)
+        timings.append(time.perf_counter() - started)
+    return {"ms": float(np.median(timings) * 1000.0), "rss_growth_mb": resident_memory_mb() - rss_before}
+
+
+def run(sizes: List[str], formats: List[str], repeats: int, model_name: str) -> List[Dict[str, Any]]:
+    # Random weights are enough: only the transforms are compared
+    model, _, openclip_preprocess = open_clip.create_model_and_transforms(model_name, pretrained=None)
+    fast_preprocess = FastPreprocess.from_config(model.visual.preprocess_cfg)
+    del model
+
+    results = []
+    for size in sizes:
+        width, height = (int(v) for v in size.split("x"))
+        for fmt in formats:
+            contents = make_image(width, height, fmt)
+            baseline = measure(baseline_path, contents, openclip_preprocess, repeats)
+            fast = measure(fast_path, contents, fast_preprocess, repeats)
+            diff = float((baseline_path(contents, openclip_preprocess) - fast_path(contents, fast_preprocess)).abs().mean())
+            results.append({
+                "size": size, "format": fmt, "bytes": len(contents),
+                "baseline_ms": baseline["ms"], "fast_ms": fast["ms"],
+                "speedup": baseline["ms"] / fast["ms"],
+                "mean_abs_tensor_diff": diff,
+            })
+            print(f"{size:>10} {fmt:<5} {len(contents) / 1e6:>6.1f} MB  baseline {baseline['ms']:>8.1f} ms  "
+                  f"fast {fast['ms']:>7.1f} ms  x{results[-1]['speedup']:.1f}  |diff| {diff:.4f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fast decode/preprocess path with the previous one.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated WIDTHxHEIGHT list.")
+    parser.add_argument("--formats", default="JPEG,PNG")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--model", default="ViT-B-16")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    results = run(args.sizes.split(","), args.formats.split(","), args.repeats, args.model)
+    if args.json:
+        write_results(args.json, "decode", vars(args), results)
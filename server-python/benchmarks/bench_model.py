@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+# The benchmarks import the server modules from the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import latency_summary, write_results  # noqa: E402
+from inference_backends import INFERENCE_BACKEND, resident_memory_mb  # noqa: E402
+from model_tools import MODEL_NAME, PRETRAINED_WEIGHTS, generate_ip_vectors, load_embedding_model  # noqa: E402
+
+DEFAULT_BATCH_SIZES = "1,2,4,8,16,32,64"
+
+
+def synthetic_images(count: int, size: int = 256, seed: int = 0) -> List[Image.Image]:
+    rng = np.random.RandomState(seed)
+    return [Image.fromarray((rng.rand(size, size, 3) * 255).astype(np.uint8)) for _ in range(count)]
+
+
+def run(model_name: str, weights_name: Optional[str], backend: str, batch_sizes: List[int],
+        thread_counts: List[int], repeats: int) -> List[Dict[str, Any]]:
+    """
+    Times generate_ip_vectors (preprocess + one forward pass) for every combination of
+    batch size and torch intra-op thread count, after one warm-up batch per combination.
+    """
+    torch.manual_seed(0)
+    started = time.perf_counter()
+    assets = load_embedding_model(model_name, weights_name, backend=backend, with_text=False)
+    print(f"Model loaded in {time.perf_counter() - started:.1f}s, RSS {resident_memory_mb():.0f} MB")
+    images = synthetic_images(max(batch_sizes))
+
+    results = []
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            batch = images[:batch_size]
+            generate_ip_vectors(assets, batch)  # warm-up
+            timings = []
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                generate_ip_vectors(assets, batch)
+                timings.append(time.perf_counter() - t0)
+            summary = latency_summary(timings)
+            result = {
+                "threads": threads,
+                "batch_size": batch_size,
+                **{f"batch_{key}": value for key, value in summary.items() if key.endswith("_ms")},
+                "ms_per_image": summary["p50_ms"] / batch_size,
+                "images_per_second": batch_size * 1000.0 / summary["p50_ms"],
+                "rss_mb": resident_memory_mb(),
+            }
+            results.append(result)
+            print(f"threads {threads:>2}  batch {batch_size:>3}  p50 {summary['p50_ms']:>9.1f} ms  "
+                  f"p95 {summary['p95_ms']:>9.1f} ms  {result['ms_per_image']:>7.1f} ms/image  "
+                  f"{result['images_per_second']:>7.1f} images/s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput and latency of generate_ip_vectors by batch size and threads.")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--weights", default=PRETRAINED_WEIGHTS, help="Use 'none' for random weights (no download).")
+    parser.add_argument("--backend", default=INFERENCE_BACKEND)
+    parser.add_argument("--batch-sizes", default=DEFAULT_BATCH_SIZES, help="Comma separated list.")
+    parser.add_argument("--threads", default=str(torch.get_num_threads()), help="Comma separated torch thread counts.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    results = run(args.model, None if args.weights.lower() == "none" else args.weights, args.backend,
+                  [int(v) for v in args.batch_sizes.split(",")], [int(v) for v in args.threads.split(",")],
+                  args.repeats)
+    if args.json:
+        write_results(args.json, "model", vars(args), results)
@@ -0,0 +1,77 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from io import BytesIO
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_image(width: int, height: int, fmt: str, seed: int = 0) -> bytes:
+    """A smooth synthetic photo-like image (random noise would make JPEG sizes unrealistic)."""
+    rng = np.random.RandomState(seed)
+    small = (rng.rand(max(2, height // 64), max(2, width // 64), 3) * 255).astype(np.uint8)
+    image = Image.fromarray(small).resize((width, height), Image.Resampling.BILINEAR)
+    buffer = BytesIO()
+    image.save(buffer, fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def random_unit_vectors(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Normalized float32 rows, like the model's output."""
+    vectors = np.random.default_rng(seed).standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def latency_summary(seconds: Sequence[float]) -> Dict[str, float]:
+    """Mean and p50/p95/p99 in milliseconds, plus operations per second of the summed time."""
+    if not len(seconds):
+        return {"count": 0}
+    ms = np.asarray(seconds, dtype=np.float64) * 1000.0
+    return {
+        "count": int(ms.size),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+        "ops_per_second": float(ms.size * 1000.0 / ms.sum()) if ms.sum() else 0.0,
+    }
+
+
+def environment() -> Dict[str, Any]:
+    """What a result depends on besides the code: machine, interpreter, libraries and commit."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    libraries = {}
+    for name in ("numpy", "torch", "open_clip", "chromadb", "httpx"):
+        module = sys.modules.get(name)
+        if module is not None:
+            libraries[name] = getattr(module, "__version__", None)
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "libraries": libraries,
+        "env": {key: value for key, value in os.environ.items() if key.startswith("IPLENS_")},
+    }
+
+
+def write_results(path: str, benchmark: str, config: Dict[str, Any], results: List[Dict[str, Any]]):
+    """Writes one run as JSON: {benchmark, environment, config, results}. Compare runs with compare.py."""
+    with open(path, "w") as f:
+        json.dump({"benchmark": benchmark, "environment": environment(), "config": config, "results": results},
+                  f, indent=2)
+    print(f"Results written to {path}")
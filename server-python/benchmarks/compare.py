@@ -0,0 +1,77 @@
+import argparse
+import json
+from typing import Any, Dict, Tuple
+
+# Fields that identify a result row within each benchmark; every other number is compared
+IDENTITY_KEYS = {
+    "decode": ("size", "format"),
+    "model": ("threads", "batch_size"),
+    "db": ("store", "size"),
+    "load": ("endpoint", "concurrency"),
+}
+# Metrics where a larger value is an improvement
+HIGHER_IS_BETTER = ("per_second", "speedup", "success_rate", "recall")
+
+
+def _flatten(result: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    values = {}
+    for key, value in result.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(_flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = float(value)
+    return values
+
+
+def _rows(run: Dict[str, Any]) -> Dict[Tuple, Dict[str, float]]:
+    keys = IDENTITY_KEYS.get(run["benchmark"], ())
+    rows = {}
+    for result in run["results"]:
+        identity = tuple(result.get(key) for key in keys)
+        rows[identity] = {name: value for name, value in _flatten(result).items() if name not in keys}
+    return rows
+
+
+def compare(baseline: Dict[str, Any], candidate: Dict[str, Any], threshold: float) -> int:
+    """Prints every shared metric with its relative change; returns how many regressed by more than `threshold`."""
+    if baseline["benchmark"] != candidate["benchmark"]:
+        raise SystemExit(f"Cannot compare a {baseline['benchmark']} run with a {candidate['benchmark']} run.")
+    print(f"baseline:  {baseline['environment'].get('commit')} {baseline['environment'].get('timestamp')}")
+    print(f"candidate: {candidate['environment'].get('commit')} {candidate['environment'].get('timestamp')}")
+
+    regressions = 0
+    base_rows, cand_rows = _rows(baseline), _rows(candidate)
+    for identity, base in base_rows.items():
+        cand = cand_rows.get(identity)
+        if cand is None:
+            continue
+        print(f"\n{' '.join(str(v) for v in identity)}")
+        for name, old in base.items():
+            if name not in cand or old == 0:
+                continue
+            new = cand[name]
+            change = (new - old) / abs(old)
+            better = change > 0 if any(marker in name for marker in HIGHER_IS_BETTER) else change < 0
+            flag = ""
+            if abs(change) > threshold and not better:
+                flag = "  REGRESSION"
+                regressions += 1
+            print(f"  {name:<40} {old:>12.3f} -> {new:>12.3f}  {change * 100:>+7.1f}%{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark JSON files written with --json.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change flagged as a regression.")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline_run = json.load(f)
+    with open(args.candidate) as f:
+        candidate_run = json.load(f)
+    count = compare(baseline_run, candidate_run, args.threshold)
+    print(f"\n{count} regression(s) above {args.threshold * 100:.0f}%")
+    raise SystemExit(1 if count else 0)
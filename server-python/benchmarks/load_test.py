@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+
+import httpx
+
+from common import latency_summary, make_image, write_results
+
+ENDPOINTS = {"search": "/search-vector", "add": "/add-vector"}
+DEFAULT_MIX = "search=0.8,add=0.2"
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    weights = []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}' in mix. Use {', '.join(ENDPOINTS)}.")
+        weights.append((name, float(weight or 1.0)))
+    return weights
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    """'decode;dur=1.20, embed;dur=30.5' -> {"decode": 1.2, "embed": 30.5} (milliseconds)."""
+    stages = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur" and name:
+                stages[name] = float(value)
+    return stages
+
+
+class LoadTest:
+    """
+    Drives the API with `concurrency` concurrent clients for `duration` seconds (or until
+    `max_requests` have been sent), choosing each request's endpoint by the mix weights.
+
+    Searches cycle through a fixed pool of query images; every add uploads a new image
+    under a unique filename, so adds are real inserts (they are not removed afterwards).
+    """
+
+    def __init__(self, url: str, mix: List[Tuple[str, float]], concurrency: int, duration: float,
+                 max_requests: int, image_size: Tuple[int, int], query_pool: int, near_duplicates: bool):
+        self.url = url.rstrip("/")
+        self.names = [name for name, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.max_requests = max_requests
+        self.image_size = image_size
+        self.near_duplicates = near_duplicates
+        self.run_id = uuid.uuid4().hex[:8]
+
+        self.queries = [make_image(*image_size, "JPEG", seed=seed) for seed in range(query_pool)]
+        self._query_cycle = itertools.cycle(self.queries)
+        self._add_counter = itertools.count()
+        self._sent = 0
+
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.stage_ms: Dict[str, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+
+    async def wait_ready(self, client: httpx.AsyncClient, timeout: float):
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                if (await client.get(f"{self.url}/ready")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"{self.url} did not become ready within {timeout:.0f}s")
+            await asyncio.sleep(0.5)
+
+    def _request(self, name: str) -> Tuple[str, Dict[str, Any], Dict[str, Any]]:
+        if name == "search":
+            params = {} if self.near_duplicates else {"near_duplicates": "false"}
+            return ENDPOINTS[name], params, {"file": ("query.jpg", next(self._query_cycle), "image/jpeg")}
+        n = next(self._add_counter)
+        # Offset seeds keep added images distinct from the query pool and from earlier runs
+        contents = make_image(*self.image_size, "JPEG", seed=1_000_000 + n + random.randrange(1 << 20))
+        return ENDPOINTS[name], {}, {"file": (f"load-{self.run_id}-{n}.jpg", contents, "image/jpeg")}
+
+    async def _client_loop(self, client: httpx.AsyncClient, stop_at: float):
+        while time.perf_counter() < stop_at and (not self.max_requests or self._sent < self.max_requests):
+            self._sent += 1
+            name = random.choices(self.names, self.weights)[0]
+            path, params, files = self._request(name)
+            started = time.perf_counter()
+            try:
+                response = await client.post(f"{self.url}{path}", params=params, files=files)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                response, status = None, type(e).__name__
+            self.latencies[name].append(time.perf_counter() - started)
+            self.statuses[name][status] += 1
+            if response is not None and "server-timing" in response.headers:
+                for stage, ms in parse_server_timing(response.headers["server-timing"]).items():
+                    self.stage_ms[name][stage].append(ms)
+
+    async def run(self, ready_timeout: float) -> List[Dict[str, Any]]:
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+            await self.wait_ready(client, ready_timeout)
+            started = time.perf_counter()
+            await asyncio.gather(*[self._client_loop(client, started + self.duration) for _ in range(self.concurrency)])
+            elapsed = time.perf_counter() - started
+
+        results = []
+        for name in self.names + ["all"]:
+            timings = list(itertools.chain(*self.latencies.values())) if name == "all" else self.latencies[name]
+            statuses = defaultdict(int)
+            for endpoint_statuses in (self.statuses.values() if name == "all" else [self.statuses[name]]):
+                for status, count in endpoint_statuses.items():
+                    statuses[status] += count
+            ok = statuses.get("200", 0)
+            summary = latency_summary(timings)
+            summary.pop("ops_per_second", None)
+            results.append({
+                "endpoint": ENDPOINTS.get(name, name),
+                "concurrency": self.concurrency,
+                "elapsed_seconds": elapsed,
+                "requests": len(timings),
+                "requests_per_second": len(timings) / elapsed if elapsed else 0.0,
+                "success_rate": ok / len(timings) if timings else 0.0,
+                "statuses": dict(statuses),
+                "latency": summary,
+                "server_timing_mean_ms": {stage: sum(values) / len(values)
+                                          for stage, values in sorted(self.stage_ms[name].items())} if name != "all" else {},
+            })
+        return results
+
+
+def print_report(results: List[Dict[str, Any]]):
+    print(f"\n{'endpoint':<16} {'requests':>8} {'req/s':>8} {'ok':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses")
+    for result in results:
+        latency = result["latency"]
+        print(f"{result['endpoint']:<16} {result['requests']:>8} {result['requests_per_second']:>8.1f} "
+              f"{result['success_rate'] * 100:>5.1f}% {latency.get('p50_ms', 0):>8.1f} {latency.get('p95_ms', 0):>8.1f} "
+              f"{latency.get('p99_ms', 0):>8.1f}  {result['statuses']}")
+        if result["server_timing_mean_ms"]:
+            stages = ", ".join(f"{stage} {ms:.1f}" for stage, ms in result["server_timing_mean_ms"].items())
+            print(f"{'':<16} mean server stages (ms): {stages}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent /search-vector and /add-vector load against a running server.")
+    parser.add_argument("--url", default=os.getenv("IPLENS_API_URL", "http://localhost:8000"))
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Endpoint weights, e.g. search=0.8,add=0.2.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run.")
+    parser.add_argument("--requests", type=int, default=0, help="Stop after this many requests (0 = duration only).")
+    parser.add_argument("--image-size", default="640x480")
+    parser.add_argument("--query-pool", type=int, default=32, help="Distinct query images searched in rotation.")
+    parser.add_argument("--no-near-duplicates", action="store_true", help="Always run the vector search.")
+    parser.add_argument("--ready-timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    width, height = (int(v) for v in args.image_size.split("x"))
+    try:
+        load_test = LoadTest(args.url, parse_mix(args.mix), args.concurrency, args.duration, args.requests,
+                             (width, height), args.query_pool, not args.no_near_duplicates)
+    except ValueError as e:
+        sys.exit(str(e))
+    results = asyncio.run(load_test.run(args.ready_timeout))
+    print_report(results)
+    if args.json:
+        write_results(args.json, "load", vars(args), results)
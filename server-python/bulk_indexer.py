@@ -0,0 +1,381 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+import torch
+
+from model_tools import load_ip_model, decode_image, embed_image_tensors, add_vectors_to_db, find_existing_content_hashes
+from embedding_cache import content_hash
+from phash_index import perceptual_hash_encoded
+from ann_index import AnnCollection
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Folder indexed by default (the same one app.py serves under /assets)
+ASSETS_FOLDER = os.path.join(BASE_DIR, "story_protocol_assets")
+# Ids that are already written to the collection, one per line
+CHECKPOINT_FILE = os.path.join(BASE_DIR, ".bulk_index_checkpoint")
+ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+DECODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+INFERENCE_BATCH_SIZE = 32
+WRITE_BATCH_SIZE = 256
+# Longest time written vectors may sit in the writer before being flushed (seconds)
+WRITE_FLUSH_INTERVAL = 2.0
+# Flush interval used when streaming from the registry, favouring freshness over batch size
+STREAM_FLUSH_INTERVAL = 0.5
+# Capacity of each queue between stages; bounds memory regardless of input size
+QUEUE_SIZE = 128
+PROGRESS_INTERVAL = 5.0
+
+# Marks the end of the stream in the stage queues
+_DONE = object()
+
+
+class StageStats:
+    """Counts items and busy time of one pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def fail(self):
+        with self._lock:
+            self.failures += 1
+
+    def summary(self, wall_seconds: float) -> str:
+        busy_rate = self.items / self.busy_seconds if self.busy_seconds > 0 else 0.0
+        wall_rate = self.items / wall_seconds if wall_seconds > 0 else 0.0
+        return (f"{self.name:<10} {self.items:>8} images  {wall_rate:8.1f} img/s (wall)  "
+                f"{busy_rate:8.1f} img/s (busy)  failures: {self.failures}")
+
+
+def iter_folder(folder: str, skip_ids: Optional[set] = None) -> Iterable[Dict[str, Any]]:
+    """
+    Yields one source item per image file in `folder`. The filename is used as the id,
+    just like /add-vector does.
+    """
+    skip_ids = skip_ids or set()
+    for file_name in sorted(os.listdir(folder)):
+        if file_name in skip_ids or not file_name.lower().endswith(ALLOWED_EXTENSIONS):
+            continue
+        path = os.path.join(folder, file_name)
+        if os.path.isfile(path):
+            yield {"id": file_name, "path": path, "metadata": {"filename": file_name}}
+
+
+def load_checkpoint(checkpoint_file: str) -> set:
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class IndexingPipeline:
+    """
+    Streams source items through decode workers, a batched inference stage and a
+    batched database writer, connected by bounded queues.
+
+    Source items are dicts with an "id", optional "metadata", and either the raw
+    image bytes under "data" or a file "path".
+    """
+
+    def __init__(
+        self,
+        loaded_assets: Dict[str, Any],
+        collection,
+        decode_workers: int = DECODE_WORKERS,
+        batch_size: int = INFERENCE_BATCH_SIZE,
+        write_batch_size: int = WRITE_BATCH_SIZE,
+        write_flush_interval: float = WRITE_FLUSH_INTERVAL,
+        queue_size: int = QUEUE_SIZE,
+        checkpoint_file: Optional[str] = CHECKPOINT_FILE,
+    ):
+        self.loaded_assets = loaded_assets
+        self.collection = collection
+        self.decode_workers = max(1, decode_workers)
+        self.batch_size = max(1, batch_size)
+        self.write_batch_size = max(1, write_batch_size)
+        self.write_flush_interval = write_flush_interval
+        self.queue_size = max(1, queue_size)
+        self.checkpoint_file = checkpoint_file
+
+        self.stats = {
+            "decode": StageStats("decode"),
+            "inference": StageStats("inference"),
+            "write": StageStats("write"),
+        }
+        self.duplicates = 0
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    # --- (1) Stages ---
+
+    def _decode_one(self, item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        try:
+            data = item.get("data")
+            if data is None:
+                with open(item["path"], "rb") as f:
+                    data = f.read()
+            image = decode_image(data)
+            tensor = self.loaded_assets["preprocess"](image)
+            phash = perceptual_hash_encoded(data)
+        except Exception as e:
+            self.stats["decode"].fail()
+            print(f"  FAILURE: {item['id']} could not be decoded: {e}")
+            return None
+        self.stats["decode"].record(1, time.perf_counter() - started)
+        return {"id": item["id"], "metadata": item.get("metadata") or {}, "content_hash": content_hash(data),
+                "phash": phash, "tensor": tensor}
+
+    def _decode_stage(self, source: Iterable[Dict[str, Any]], out_queue: queue.Queue):
+        try:
+            with ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix="indexer-decode") as pool:
+                # Keep at most queue_size decodes in flight so the source is read lazily
+                in_flight = queue.Queue(maxsize=self.queue_size)
+
+                def forward():
+                    while True:
+                        future = in_flight.get()
+                        if future is _DONE:
+                            return
+                        decoded = future.result()
+                        if decoded is not None:
+                            self._put(out_queue, decoded)
+
+                forwarder = threading.Thread(target=forward, name="indexer-decode-forward", daemon=True)
+                forwarder.start()
+                for item in source:
+                    if self._stop.is_set():
+                        break
+                    in_flight.put(pool.submit(self._decode_one, item))
+                in_flight.put(_DONE)
+                forwarder.join()
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(out_queue, _DONE, force=True)
+
+    def _inference_stage(self, in_queue: queue.Queue, out_queue: queue.Queue):
+        try:
+            finished = False
+            while not finished:
+                batch = [in_queue.get()]
+                if batch[0] is _DONE:
+                    break
+                # Fill the batch with whatever is already decoded
+                while len(batch) < self.batch_size:
+                    try:
+                        item = in_queue.get(timeout=0.05)
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        finished = True
+                        break
+                    batch.append(item)
+
+                started = time.perf_counter()
+                vectors = embed_image_tensors(self.loaded_assets, torch.stack([item.pop("tensor") for item in batch]))
+                self.stats["inference"].record(len(batch), time.perf_counter() - started)
+                for item, vector in zip(batch, vectors):
+                    item["vector"] = vector
+                    self._put(out_queue, item)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(out_queue, _DONE, force=True)
+
+    def _write_stage(self, in_queue: queue.Queue):
+        checkpoint = open(self.checkpoint_file, "a", encoding="utf-8") if self.checkpoint_file else None
+        pending: List[Dict[str, Any]] = []
+        last_flush = time.monotonic()
+        try:
+            while True:
+                timeout = max(0.0, self.write_flush_interval - (time.monotonic() - last_flush))
+                try:
+                    item = in_queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _DONE:
+                    break
+                if item is not None:
+                    pending.append(item)
+                if pending and (len(pending) >= self.write_batch_size or time.monotonic() - last_flush >= self.write_flush_interval):
+                    self._flush(pending, checkpoint)
+                    pending = []
+                if not pending:
+                    last_flush = time.monotonic()
+
+            if pending:
+                self._flush(pending, checkpoint)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+    def _flush(self, items: List[Dict[str, Any]], checkpoint):
+        started = time.perf_counter()
+
+        # Ids written by an interrupted run (after the add, before the checkpoint) and
+        # bytes already indexed under another id are both skipped
+        existing_ids = set(self.collection.get(ids=[item["id"] for item in items], include=[]).get("ids", []))
+        stored_hashes = find_existing_content_hashes(self.collection, [item["content_hash"] for item in items])
+        fresh, seen_hashes = [], set()
+        for item in items:
+            if item["id"] in existing_ids:
+                continue
+            if item["content_hash"] in stored_hashes or item["content_hash"] in seen_hashes:
+                self.duplicates += 1
+                continue
+            seen_hashes.add(item["content_hash"])
+            fresh.append(item)
+
+        upload_time = str(datetime.now())
+        add_vectors_to_db(
+            self.collection,
+            vectors=[item["vector"] for item in fresh],
+            file_names=[item["id"] for item in fresh],
+            metadatas=[{**item["metadata"], "upload_time": upload_time} for item in fresh],
+            content_hashes=[item["content_hash"] for item in fresh],
+            perceptual_hashes=[item["phash"] for item in fresh],
+            phash_index=self.loaded_assets.get("phash_index"),
+        )
+        if checkpoint:
+            checkpoint.writelines(f"{item['id']}\n" for item in items)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        self.stats["write"].record(len(items), time.perf_counter() - started)
+
+    # --- (2) Plumbing ---
+
+    def _put(self, target: queue.Queue, item: Any, force: bool = False):
+        """Blocking put that gives up once the pipeline is stopping (unless forced)."""
+        while True:
+            if self._stop.is_set() and not force:
+                return
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if force and self._stop.is_set():
+                    # Make room for the end-of-stream marker on shutdown
+                    try:
+                        target.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+            print(f"FATAL ERROR in indexing pipeline: {error}")
+        self._stop.set()
+
+    def stop(self):
+        self._stop.set()
+
+    def report(self, wall_seconds: float):
+        for stats in self.stats.values():
+            print("  " + stats.summary(wall_seconds))
+
+    def run(self, source: Iterable[Dict[str, Any]]):
+        """Runs the pipeline over `source` until it is exhausted, then prints per-stage rates."""
+        decoded = queue.Queue(maxsize=self.queue_size)
+        embedded = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._decode_stage, args=(source, decoded), name="indexer-decode", daemon=True),
+            threading.Thread(target=self._inference_stage, args=(decoded, embedded), name="indexer-inference", daemon=True),
+            threading.Thread(target=self._write_stage, args=(embedded,), name="indexer-write", daemon=True),
+        ]
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        try:
+            writer = threads[-1]
+            while writer.is_alive():
+                writer.join(timeout=PROGRESS_INTERVAL)
+                if writer.is_alive():
+                    print(f"--- Progress after {time.perf_counter() - started:.0f}s "
+                          f"(queues: decoded={decoded.qsize()}, embedded={embedded.qsize()}) ---")
+                    self.report(time.perf_counter() - started)
+        except KeyboardInterrupt:
+            print("Interrupted: flushing the vectors that reached the writer. Re-run to resume.")
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.perf_counter() - started
+        print(f"\n--- Bulk indexing finished in {elapsed:.1f}s (duplicates skipped: {self.duplicates}) ---")
+        self.report(elapsed)
+        if self._error is not None:
+            raise self._error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index a folder of images straight into the vector store, without the HTTP API.")
+    parser.add_argument("--folder", default=ASSETS_FOLDER, help="Folder of images to index (ids are the filenames).")
+    parser.add_argument("--from-story", action="store_true",
+                        help="Stream assets straight from the Story Protocol registry into the index while they download.")
+    parser.add_argument("--max-assets", type=int, default=0, help="With --from-story: stop after this many assets (0 = all).")
+    parser.add_argument("--download-workers", type=int, default=16, help="With --from-story: parallel downloads.")
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=INFERENCE_BATCH_SIZE, help="Images per forward pass.")
+    parser.add_argument("--write-batch-size", type=int, default=WRITE_BATCH_SIZE, help="Vectors per collection.add.")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="File recording indexed ids, used to resume.")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from scratch.")
+    args = parser.parse_args()
+
+    if not args.from_story and not os.path.isdir(args.folder):
+        print(f"ERROR: Image folder not found at '{args.folder}'.")
+        raise SystemExit(1)
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    done = load_checkpoint(args.checkpoint)
+    source_name = "the Story Protocol registry" if args.from_story else args.folder
+    print(f"--- Bulk indexing {source_name} ({len(done)} ids already in the checkpoint) ---")
+
+    assets = load_ip_model(with_text=False)
+    pipeline = IndexingPipeline(
+        assets,
+        assets["vector_db"],
+        decode_workers=args.decode_workers,
+        batch_size=args.batch_size,
+        write_batch_size=args.write_batch_size,
+        # Streamed assets are flushed quickly so the first ones become searchable within seconds
+        write_flush_interval=STREAM_FLUSH_INTERVAL if args.from_story else WRITE_FLUSH_INTERVAL,
+        checkpoint_file=args.checkpoint,
+    )
+
+    if args.from_story:
+        from story_protocol_downloader import iter_ip_metadata, iter_downloaded_assets
+        source = iter_downloaded_assets(
+            iter_ip_metadata(max_assets=args.max_assets),
+            workers=args.download_workers,
+            assets_folder=args.folder,
+            manifest_file=os.path.join(BASE_DIR, "story_protocol_manifest.json"),
+            skip_ids=done,
+        )
+    else:
+        source = iter_folder(args.folder, skip_ids=done)
+    pipeline.run(source)
+    if isinstance(assets["vector_db"], AnnCollection):
+        assets["vector_db"].save()
+    print(f"Collection now holds {assets['vector_db'].count()} vectors.")
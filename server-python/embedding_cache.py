@@ -0,0 +1,218 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from image_decode import FAST_PREPROCESS
+from inference_backends import INFERENCE_BACKEND
+from model_tools import MODEL_NAME, PRETRAINED_WEIGHTS
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Byte budget of the in-memory LRU tier (vectors plus their keys)
+CACHE_MEMORY_BYTES = int(os.getenv("IPLENS_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+# Directory of the persistent tier; set to an empty string to keep the cache in memory only
+CACHE_DIR = os.getenv("IPLENS_CACHE_DIR", os.path.join(BASE_DIR, "embedding_cache"))
+# Most vectors kept in the persistent tier (about 2 KB each at 512-d); the oldest are removed beyond it
+CACHE_MAX_DISK_ENTRIES = int(os.getenv("IPLENS_CACHE_MAX_DISK_ENTRIES", "500000"))
+# Preprocessing path whose pixels the image vectors were computed from
+PREPROCESS_VARIANT = "fast" if FAST_PREPROCESS else "openclip"
+
+
+def content_hash(contents: bytes) -> str:
+    """Returns the SHA-256 hex digest of the raw uploaded bytes."""
+    return hashlib.sha256(contents).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of image embeddings.
+
+    Entries are keyed by the content hash of the uploaded bytes combined with the model
+    name and weights, the inference backend and the preprocessing path, so switching any
+    of them never serves stale vectors. Lookups check the in-memory LRU tier first and
+    then the on-disk tier, promoting disk hits into memory. The disk tier keeps at most
+    `max_disk_entries` vectors, removing the least recently used ones beyond that.
+
+    Without pretrained weights (`weights_name` None) the model is randomly initialised on
+    every load, so its vectors are only cached in memory and never written to disk.
+    """
+
+    def __init__(
+        self,
+        model_name: str = MODEL_NAME,
+        weights_name: str = PRETRAINED_WEIGHTS,
+        memory_budget_bytes: int = CACHE_MEMORY_BYTES,
+        cache_dir: Optional[str] = CACHE_DIR,
+        backend: str = INFERENCE_BACKEND,
+        preprocess: str = PREPROCESS_VARIANT,
+        max_disk_entries: int = CACHE_MAX_DISK_ENTRIES,
+    ):
+        self.model_tag = f"{model_name}/{weights_name}/{backend}/{preprocess}"
+        self.memory_budget_bytes = max(0, memory_budget_bytes)
+        self.cache_dir = (os.path.join(cache_dir, f"{model_name}__{weights_name}__{backend}__{preprocess}")
+                          if cache_dir and weights_name is not None else None)
+        self.max_disk_entries = max(1, max_disk_entries)
+
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+        self._disk_entries = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_entries = sum(1 for _ in self._disk_files())
+
+    def key_for(self, image_hash: str) -> str:
+        """Combines the content hash with the model identity into the cache key."""
+        return hashlib.sha256(f"{self.model_tag}|{image_hash}".encode("utf-8")).hexdigest()
+
+    # --- (1) Lookups ---
+
+    def get(self, image_hash: str) -> Optional[np.ndarray]:
+        """Returns the cached vector for these image bytes, or None on a miss."""
+        key = self.key_for(image_hash)
+
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self._memory_hits += 1
+                return vector
+
+        vector = self._read_disk(key)
+        if vector is not None:
+            self._store_memory(key, vector)
+            with self._lock:
+                self._disk_hits += 1
+            return vector
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def put(self, image_hash: str, vector: np.ndarray):
+        """Stores a vector in both tiers."""
+        key = self.key_for(image_hash)
+        vector = np.ascontiguousarray(vector, dtype=np.float32)
+        # Cached arrays are shared between requests, so they must never be mutated
+        vector.setflags(write=False)
+        self._store_memory(key, vector)
+        self._write_disk(key, vector)
+
+    # --- (2) Memory Tier ---
+
+    def _store_memory(self, key: str, vector: np.ndarray):
+        size = vector.nbytes + len(key)
+        if size > self.memory_budget_bytes:
+            return
+
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous.nbytes + len(key)
+
+            self._memory[key] = vector
+            self._memory_bytes += size
+
+            # Evict least recently used entries until we are back within budget
+            while self._memory_bytes > self.memory_budget_bytes:
+                old_key, old_vector = self._memory.popitem(last=False)
+                self._memory_bytes -= old_vector.nbytes + len(old_key)
+
+    # --- (3) Disk Tier ---
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def _read_disk(self, key: str) -> Optional[np.ndarray]:
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            vector = np.load(path, allow_pickle=False)
+            # The modification time orders entries for pruning, so hits keep theirs fresh
+            os.utime(path)
+        except Exception as e:
+            print(f"WARNING: Discarding unreadable cache entry {path}: {e}")
+            return None
+        vector.setflags(write=False)
+        return vector
+
+    def _disk_files(self):
+        for shard in os.scandir(self.cache_dir):
+            if shard.is_dir():
+                yield from (entry for entry in os.scandir(shard.path) if entry.name.endswith(".npy"))
+
+    def _prune_disk(self):
+        """Removes the least recently used entries down to 90% of max_disk_entries."""
+        if not self._prune_lock.acquire(blocking=False):
+            return  # Another thread is already pruning
+        try:
+            entries = sorted(self._disk_files(), key=lambda entry: entry.stat().st_mtime)
+            target = int(self.max_disk_entries * 0.9)
+            removed = 0
+            for entry in entries[:max(0, len(entries) - target)]:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+            with self._lock:
+                self._disk_entries = len(entries) - removed
+            print(f"--- Embedding cache: removed {removed} old entries from {self.cache_dir} ---")
+        finally:
+            self._prune_lock.release()
+
+    def _write_disk(self, key: str, vector: np.ndarray):
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file and rename, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, vector, allow_pickle=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"WARNING: Could not persist cache entry {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self._disk_entries += 1
+            over_limit = self._disk_entries > self.max_disk_entries
+        if over_limit:
+            self._prune_disk()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._memory_hits + self._disk_hits + self._misses
+        return {
+            "model": self.model_tag,
+            "entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "memory_hits": self._memory_hits,
+            "disk_hits": self._disk_hits,
+            "misses": self._misses,
+            "hit_rate": ((self._memory_hits + self._disk_hits) / lookups) if lookups else 0.0,
+            "disk_entries": self._disk_entries,
+            "max_disk_entries": self.max_disk_entries,
+            "disk_dir": self.cache_dir,
+        }
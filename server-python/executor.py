@@ -0,0 +1,184 @@
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from metrics import add_stages, collect_stages
+from model_tools import MODEL_NAME, PRETRAINED_WEIGHTS, load_embedding_model, generate_ip_vectors, generate_text_vectors
+
+# --- Configuration ---
+CPU_COUNT = os.cpu_count() or 1
+# "thread": one shared model in this process; "process": one model per worker process
+INFERENCE_MODE = os.getenv("IPLENS_INFERENCE_MODE", "thread")
+# Number of batches that may run inference at the same time
+INFERENCE_WORKERS = int(os.getenv("IPLENS_INFERENCE_WORKERS", "1"))
+# Torch intra-op threads per inference worker (0 = split the CPU cores evenly between workers)
+TORCH_THREADS = int(os.getenv("IPLENS_TORCH_THREADS", "0"))
+# Threads for decoding uploads and blocking database calls
+BLOCKING_WORKERS = int(os.getenv("IPLENS_BLOCKING_WORKERS", str(min(4, CPU_COUNT))))
+# Requests allowed in flight at once; anything beyond this is rejected with a 503
+MAX_PENDING_REQUESTS = int(os.getenv("IPLENS_MAX_PENDING_REQUESTS", "64"))
+# Value of the Retry-After header sent back with a 503 under backpressure
+RETRY_AFTER_SECONDS = 1
+
+
+class ExecutorSaturated(Exception):
+    """Raised when the executor already holds MAX_PENDING_REQUESTS requests."""
+
+
+def _threads_per_worker(workers: int) -> int:
+    if TORCH_THREADS > 0:
+        return TORCH_THREADS
+    return max(1, CPU_COUNT // max(1, workers))
+
+
+# --- (1) Process Pool Workers ---
+# Module-level so they can be pickled into worker processes.
+
+_WORKER_ASSETS: Dict[str, Any] = {}
+
+
+def _init_process_worker(model_name: str, weights_name: str, num_threads: int):
+    """Loads one copy of the model into this worker process."""
+    global _WORKER_ASSETS
+    torch.set_num_threads(num_threads)
+    _WORKER_ASSETS = load_embedding_model(model_name, weights_name)
+
+
+def _process_worker_generate_vectors(images: List[Image.Image]) -> np.ndarray:
+    return generate_ip_vectors(_WORKER_ASSETS, images)
+
+
+def _process_worker_generate_text_vectors(texts: List[str]) -> np.ndarray:
+    return generate_text_vectors(_WORKER_ASSETS, texts)
+
+
+# --- (2) Executor ---
+
+class InferenceExecutor:
+    """
+    Runs decode, inference and blocking database work away from the asyncio event loop.
+
+    Inference runs either on threads sharing `loaded_assets`, or on a process pool with
+    one model per worker. Admission is bounded: callers hold a slot from
+    `admission()` for the lifetime of their request and get `ExecutorSaturated`
+    once MAX_PENDING_REQUESTS slots are taken.
+    """
+
+    def __init__(
+        self,
+        loaded_assets: Optional[Dict[str, Any]] = None,
+        mode: str = INFERENCE_MODE,
+        inference_workers: int = INFERENCE_WORKERS,
+        blocking_workers: int = BLOCKING_WORKERS,
+        max_pending: int = MAX_PENDING_REQUESTS,
+        model_name: str = MODEL_NAME,
+        weights_name: str = PRETRAINED_WEIGHTS,
+    ):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown inference mode: {mode}")
+        if mode == "thread" and loaded_assets is None:
+            raise ValueError("Thread mode needs the loaded model assets.")
+
+        self.loaded_assets = loaded_assets
+        self.mode = mode
+        self.inference_workers = max(1, inference_workers)
+        self.blocking_workers = max(1, blocking_workers)
+        self.max_pending = max(1, max_pending)
+        self.model_name = model_name
+        self.weights_name = weights_name
+        self.torch_threads = _threads_per_worker(self.inference_workers)
+
+        self._inference_pool: Optional[Executor] = None
+        self._blocking_pool: Optional[ThreadPoolExecutor] = None
+        self._pending = 0
+        self._rejected = 0
+
+    def start(self):
+        """Creates the worker pools and tunes torch threading."""
+        self._blocking_pool = ThreadPoolExecutor(max_workers=self.blocking_workers, thread_name_prefix="iplens-blocking")
+
+        if self.mode == "process":
+            self._inference_pool = ProcessPoolExecutor(
+                max_workers=self.inference_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_process_worker,
+                initargs=(self.model_name, self.weights_name, self.torch_threads),
+            )
+        else:
+            torch.set_num_threads(self.torch_threads)
+            self._inference_pool = ThreadPoolExecutor(max_workers=self.inference_workers, thread_name_prefix="iplens-inference")
+
+        print(f"--- Inference executor started (mode={self.mode}, workers={self.inference_workers}, "
+              f"torch_threads={self.torch_threads}, max_pending={self.max_pending}) ---")
+
+    def shutdown(self):
+        if self._inference_pool is not None:
+            self._inference_pool.shutdown(wait=False, cancel_futures=True)
+            self._inference_pool = None
+        if self._blocking_pool is not None:
+            self._blocking_pool.shutdown(wait=False, cancel_futures=True)
+            self._blocking_pool = None
+
+    # --- Admission control ---
+
+    @asynccontextmanager
+    async def admission(self):
+        """Holds one request slot, raising ExecutorSaturated when none is free."""
+        if self._pending >= self.max_pending:
+            self._rejected += 1
+            raise ExecutorSaturated(f"{self._pending} requests already in flight")
+        self._pending += 1
+        try:
+            yield
+        finally:
+            self._pending -= 1
+
+    # --- Work submission ---
+
+    @property
+    def embedding_fn(self) -> Callable[[List[Image.Image]], np.ndarray]:
+        """The batch embedding function matching this executor's inference pool."""
+        if self.mode == "process":
+            return _process_worker_generate_vectors
+        return functools.partial(generate_ip_vectors, self.loaded_assets)
+
+    @property
+    def text_embedding_fn(self) -> Callable[[List[str]], np.ndarray]:
+        """The batch text embedding function matching this executor's inference pool."""
+        if self.mode == "process":
+            return _process_worker_generate_text_vectors
+        return functools.partial(generate_text_vectors, self.loaded_assets)
+
+    async def run_inference(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        Runs `fn` on the inference pool (used as the batcher runner). The stages it records
+        (preprocess, inference), in a thread or a worker process, count towards the caller's request.
+        """
+        result, stages = await asyncio.get_running_loop().run_in_executor(self._inference_pool, collect_stages, fn, *args)
+        add_stages(stages)
+        return result
+
+    async def run_blocking(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Runs a blocking call (decode, disk or database I/O) on the blocking pool, in the caller's context."""
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._blocking_pool, call)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "inference_workers": self.inference_workers,
+            "blocking_workers": self.blocking_workers,
+            "torch_threads": self.torch_threads,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "rejected": self._rejected,
+        }
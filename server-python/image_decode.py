@@ -0,0 +1,122 @@
+import os
+from io import BytesIO
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+# --- Configuration ---
+# Uploads larger than this many bytes are rejected before decoding
+MAX_IMAGE_BYTES = int(os.getenv("IPLENS_MAX_IMAGE_BYTES", str(25 * 1024 * 1024)))
+# Images with more pixels than this are rejected from their header, before decoding
+MAX_IMAGE_PIXELS = int(os.getenv("IPLENS_MAX_IMAGE_PIXELS", str(50_000_000)))
+# Smallest side the decoder aims for; JPEGs are decoded at the smallest DCT scale that
+# still covers it, so the model's resize only has a little work left
+DECODE_TARGET_SIZE = int(os.getenv("IPLENS_DECODE_TARGET_SIZE", "224"))
+# Replace the torchvision transform chain with FastPreprocess (set to 0 to disable)
+FAST_PREPROCESS = os.getenv("IPLENS_FAST_PREPROCESS", "1") == "1"
+
+_RESAMPLING = {
+    "bicubic": Image.Resampling.BICUBIC,
+    "bilinear": Image.Resampling.BILINEAR,
+    "nearest": Image.Resampling.NEAREST,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+
+class ImageRejected(ValueError):
+    """Raised for uploads that exceed the configured byte or pixel limits."""
+
+
+# --- (1) Decoding ---
+
+def decode_image(source: Union[bytes, str, os.PathLike], target_size: Optional[int] = DECODE_TARGET_SIZE,
+                 max_bytes: int = MAX_IMAGE_BYTES, max_pixels: int = MAX_IMAGE_PIXELS) -> Image.Image:
+    """
+    Decodes image bytes, or an image file given by path, into a loaded RGB PIL Image,
+    enforcing size limits first.
+
+    The pixel limit is checked from the header, so a decompression bomb is rejected
+    without allocating its pixels. With `target_size`, JPEGs use draft mode: libjpeg
+    decodes at 1/2, 1/4 or 1/8 scale while both sides stay >= target_size.
+    """
+    is_path = isinstance(source, (str, os.PathLike))
+    size = os.path.getsize(source) if is_path else len(source)
+    if size > max_bytes:
+        raise ImageRejected(f"Image is {size} bytes; the limit is {max_bytes}.")
+
+    try:
+        image = Image.open(source if is_path else BytesIO(source))
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(str(e)) from e
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageRejected(f"Image is {width}x{height} pixels; the limit is {max_pixels} pixels.")
+
+    if target_size and image.format == "JPEG":
+        image.draft("RGB", (target_size, target_size))
+    # Force the actual decode here instead of lazily inside the model step
+    image.load()
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+# --- (2) Resize and Tensorize ---
+
+class FastPreprocess:
+    """
+    Drop-in replacement for the OpenCLIP image transform (shortest-side resize,
+    center crop, to-tensor, normalize) that works on one uint8 array instead of
+    going through the torchvision transform chain.
+
+    Large images are first shrunk with Pillow's box reduce (reducing_gap), then
+    resized with the configured filter; normalization is one fused numpy expression.
+    """
+
+    def __init__(self, size: Tuple[int, int], mean: Sequence[float], std: Sequence[float],
+                 interpolation: str = "bicubic"):
+        self.size = tuple(size)
+        self.resample = _RESAMPLING[interpolation]
+        # Folds ToTensor's /255 into the normalization: (x / 255 - mean) / std
+        self.scale = (1.0 / (255.0 * np.asarray(std, dtype=np.float32))).reshape(1, 1, 3)
+        self.offset = (np.asarray(mean, dtype=np.float32) / np.asarray(std, dtype=np.float32)).reshape(1, 1, 3)
+
+    @classmethod
+    def from_config(cls, preprocess_cfg: Dict[str, Any]) -> Optional["FastPreprocess"]:
+        """Builds from an OpenCLIP preprocess_cfg, or returns None for unsupported resize modes."""
+        if preprocess_cfg.get("resize_mode", "shortest") != "shortest":
+            return None
+        if preprocess_cfg.get("interpolation", "bicubic") not in _RESAMPLING:
+            return None
+        size = preprocess_cfg["size"]
+        size = (size, size) if isinstance(size, int) else size
+        return cls(size, preprocess_cfg["mean"], preprocess_cfg["std"], preprocess_cfg.get("interpolation", "bicubic"))
+
+    def resize(self, image: Image.Image) -> Image.Image:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        crop_h, crop_w = self.size
+        width, height = image.size
+        # Same output size as torchvision's Resize(int): shortest side to size, long side truncated
+        short = min(crop_h, crop_w)
+        if width <= height:
+            new_w, new_h = short, int(short * height / width)
+        else:
+            new_w, new_h = int(short * width / height), short
+        if (new_w, new_h) != (width, height):
+            image = image.resize((new_w, new_h), self.resample, reducing_gap=3.0)
+        left, top = int(round((new_w - crop_w) / 2.0)), int(round((new_h - crop_h) / 2.0))
+        return image.crop((left, top, left + crop_w, top + crop_h))
+
+    def __call__(self, image: Image.Image) -> torch.Tensor:
+        pixels = np.asarray(self.resize(image), dtype=np.float32)
+        normalized = pixels * self.scale - self.offset
+        return torch.from_numpy(np.ascontiguousarray(normalized.transpose(2, 0, 1)))
+
+
+def build_preprocess(visual: torch.nn.Module, default_preprocess):
+    """FastPreprocess for the vision tower when enabled and supported, the OpenCLIP transform otherwise."""
+    preprocess_cfg = getattr(visual, "preprocess_cfg", None)
+    if not FAST_PREPROCESS or not preprocess_cfg:
+        return default_preprocess
+    return FastPreprocess.from_config(preprocess_cfg) or default_preprocess
@@ -0,0 +1,121 @@
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+# --- Configuration ---
+# Pointer to the index the API serves: which collection, built with which model
+ACTIVE_INDEX_PATH = os.getenv("IPLENS_ACTIVE_INDEX_PATH", "./active_index.json")
+# Collection of the original model; it keeps its name so existing stores stay valid
+DEFAULT_COLLECTION = "ip_vector_collection"
+DEFAULT_MODEL = ("ViT-B-16", "openai")
+
+
+class IndexVersion:
+    """
+    One versioned vector index: the collection name and the model (name, weights and
+    output dimension) whose vectors it holds. Queries must be embedded with the same
+    model, so the API loads the model of the active version.
+    """
+
+    def __init__(self, collection: str, model_name: str, weights_name: Optional[str], dim: Optional[int] = None):
+        self.collection = collection
+        self.model_name = model_name
+        self.weights_name = weights_name
+        self.dim = dim
+
+    @classmethod
+    def for_model(cls, model_name: str, weights_name: Optional[str], dim: Optional[int] = None) -> "IndexVersion":
+        """The version a model's vectors go into: the original collection, or one named after the model."""
+        if (model_name, weights_name) == DEFAULT_MODEL:
+            return cls(DEFAULT_COLLECTION, model_name, weights_name, dim)
+        slug = re.sub(r"[^A-Za-z0-9._-]+", "-", f"{model_name}__{weights_name}").strip("-._")
+        return cls(f"ip_vectors__{slug}", model_name, weights_name, dim)
+
+    @property
+    def model_id(self) -> str:
+        return f"{self.model_name}/{self.weights_name}"
+
+    def collection_metadata(self) -> Dict[str, Any]:
+        """What the collection records about its vectors when it is created."""
+        metadata = {"model": self.model_id}
+        if self.dim:
+            metadata["dim"] = int(self.dim)
+        return metadata
+
+    def check_collection(self, metadata: Optional[Dict[str, Any]]):
+        """Refuses a collection whose recorded model or dimension differs from this version's."""
+        metadata = metadata or {}
+        if metadata.get("model") not in (None, self.model_id):
+            raise RuntimeError(f"Collection '{self.collection}' holds vectors of {metadata['model']}, "
+                               f"not {self.model_id}. Check {ACTIVE_INDEX_PATH} or run reembed.py.")
+        if metadata.get("dim") and self.dim and int(metadata["dim"]) != int(self.dim):
+            raise RuntimeError(f"Collection '{self.collection}' holds {metadata['dim']}-d vectors, "
+                               f"but {self.model_id} produces {self.dim}-d vectors.")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"collection": self.collection, "model_name": self.model_name,
+                "weights_name": self.weights_name, "dim": self.dim}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "IndexVersion":
+        return cls(data["collection"], data["model_name"], data.get("weights_name"), data.get("dim"))
+
+    def __repr__(self) -> str:
+        return f"IndexVersion({self.collection!r}, {self.model_id}, dim={self.dim})"
+
+
+def read_active_index(path: str = ACTIVE_INDEX_PATH) -> Optional[Dict[str, Any]]:
+    """The pointer file's contents ("active" and "previous" versions), or None before the first switch."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def active_version(default_model_name: str, default_weights_name: Optional[str],
+                   path: str = ACTIVE_INDEX_PATH) -> IndexVersion:
+    """The version the pointer names, or the default model's version when there is no pointer yet."""
+    pointer = read_active_index(path)
+    if pointer is None:
+        return IndexVersion.for_model(default_model_name, default_weights_name)
+    return IndexVersion.from_dict(pointer["active"])
+
+
+def previous_version(path: str = ACTIVE_INDEX_PATH) -> Optional[IndexVersion]:
+    pointer = read_active_index(path)
+    return IndexVersion.from_dict(pointer["previous"]) if pointer and pointer.get("previous") else None
+
+
+def activate(version: IndexVersion, previous: Optional[IndexVersion] = None, path: str = ACTIVE_INDEX_PATH):
+    """
+    Points the API at `version`. The new pointer is written to a temporary file, fsynced
+    and renamed over the old one, so readers see either the old or the new pointer, never
+    a partial one. Processes pick it up when they (re)start.
+    """
+    pointer = {
+        "active": version.to_dict(),
+        "previous": previous.to_dict() if previous is not None else None,
+        "activated_at": str(datetime.now()),
+    }
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".active_index-", dir=folder)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(pointer, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # Make the rename itself durable
+    dir_fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
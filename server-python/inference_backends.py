@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    import onnxruntime
+except ImportError:  # Only needed for the "onnx" backend
+    onnxruntime = None
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Which backend load_embedding_model builds: fp32, fp16, bf16, int8 or onnx
+INFERENCE_BACKEND = os.getenv("IPLENS_INFERENCE_BACKEND", "fp32")
+# Where exported ONNX vision encoders are kept between runs
+ONNX_CACHE_DIR = os.getenv("IPLENS_ONNX_CACHE_DIR", os.path.join(BASE_DIR, "onnx_models"))
+BACKENDS = ("fp32", "fp16", "bf16", "int8", "onnx")
+
+
+def resident_memory_mb() -> float:
+    """Current resident set size of this process in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1024.0 * 1024.0) if os.uname().sysname == "Darwin" else peak / 1024.0
+
+
+# --- (1) Vision-only Backends ---
+# Every backend exposes encode_image(tensor) -> float32 tensor, like the OpenCLIP model,
+# so model_tools.embed_image_tensors works unchanged.
+
+class TorchVisionEncoder(nn.Module):
+    """
+    The OpenCLIP vision tower on its own, optionally cast to fp16/bf16.
+    The text tower is never used for image search, so it is not kept in memory.
+    """
+
+    def __init__(self, visual: nn.Module, dtype: torch.dtype = torch.float32, name: str = "fp32"):
+        super().__init__()
+        self.visual = visual.to(dtype)
+        self.dtype = dtype
+        self.name = name
+
+    @property
+    def output_dim(self) -> int:
+        return self.visual.output_dim
+
+    def encode_image(self, image: torch.Tensor) -> torch.Tensor:
+        return self.visual(image.to(self.dtype)).float()
+
+
+def quantize_int8(visual: nn.Module) -> TorchVisionEncoder:
+    """Dynamic int8 quantization of every Linear layer (weights int8, activations quantized on the fly)."""
+    quantized = torch.ao.quantization.quantize_dynamic(visual, {nn.Linear}, dtype=torch.qint8)
+    return TorchVisionEncoder(quantized, torch.float32, name="int8")
+
+
+class OnnxVisionEncoder:
+    """The vision tower exported to ONNX and run on ONNX Runtime's CPU provider."""
+
+    name = "onnx"
+
+    def __init__(self, onnx_path: str, output_dim: int, num_threads: int = 0):
+        if onnxruntime is None:
+            raise RuntimeError("The onnx backend needs the 'onnxruntime' package.")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_dim = output_dim
+
+    def eval(self):
+        return self
+
+    def encode_image(self, image: torch.Tensor) -> torch.Tensor:
+        inputs = {self.input_name: image.detach().cpu().numpy().astype(np.float32, copy=False)}
+        return torch.from_numpy(self.session.run(None, inputs)[0])
+
+
+def export_onnx(visual: nn.Module, onnx_path: str, image_size: int = 224):
+    """Exports the fp32 vision tower with a dynamic batch dimension."""
+    os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+    tmp_path = f"{onnx_path}.tmp"
+    dummy = torch.zeros(1, 3, image_size, image_size)
+    export_kwargs = dict(
+        input_names=["image"],
+        output_names=["embedding"],
+        dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}},
+        opset_version=17,
+    )
+    # The fused attention fast path has no ONNX equivalent, so trace the plain ops instead
+    fastpath = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        with torch.no_grad():
+            try:
+                torch.onnx.export(visual, (dummy,), tmp_path, dynamo=False, **export_kwargs)
+            except TypeError:
+                # Older torch releases have no `dynamo` switch
+                torch.onnx.export(visual, (dummy,), tmp_path, **export_kwargs)
+    finally:
+        torch.backends.mha.set_fastpath_enabled(fastpath)
+    os.replace(tmp_path, onnx_path)
+
+
+def build_backend(visual: nn.Module, backend: str = INFERENCE_BACKEND, model_tag: Optional[str] = None,
+                  device: Optional[torch.device] = None):
+    """
+    Turns the OpenCLIP vision tower into the requested inference backend.
+    The ONNX export is cached under `model_tag`; without a tag (e.g. randomly initialized
+    weights, which differ on every load) it is exported to a temporary file each time.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}'. Choose one of {', '.join(BACKENDS)}.")
+
+    visual = visual.eval()
+    image_size = visual.image_size[0] if isinstance(visual.image_size, (tuple, list)) else visual.image_size
+
+    if backend == "fp32":
+        encoder = TorchVisionEncoder(visual, torch.float32, name="fp32")
+    elif backend == "fp16":
+        encoder = TorchVisionEncoder(visual, torch.float16, name="fp16")
+    elif backend == "bf16":
+        encoder = TorchVisionEncoder(visual, torch.bfloat16, name="bf16")
+    elif backend == "int8":
+        if device is not None and device.type != "cpu":
+            raise ValueError("The int8 backend runs on CPU only.")
+        encoder = quantize_int8(visual)
+    elif model_tag is None:
+        with tempfile.TemporaryDirectory(prefix="iplens-onnx-") as export_dir:
+            onnx_path = os.path.join(export_dir, "visual.onnx")
+            print("--- Exporting vision encoder to ONNX (not cached) ---")
+            export_onnx(visual.float().cpu(), onnx_path, image_size)
+            encoder = OnnxVisionEncoder(onnx_path, visual.output_dim, num_threads=torch.get_num_threads())
+    else:
+        onnx_path = os.path.join(ONNX_CACHE_DIR, f"{model_tag}.onnx")
+        if not os.path.exists(onnx_path):
+            print(f"--- Exporting vision encoder to ONNX: {onnx_path} ---")
+            export_onnx(visual.float().cpu(), onnx_path, image_size)
+        encoder = OnnxVisionEncoder(onnx_path, visual.output_dim, num_threads=torch.get_num_threads())
+
+    return encoder.eval()
+
+
+# --- (2) Backend Comparison ---
+
+def _load_images(folder: str, limit: int) -> List[Any]:
+    from PIL import Image
+    from model_tools import decode_image
+
+    images = []
+    if folder and os.path.isdir(folder):
+        for file_name in sorted(os.listdir(folder)):
+            if len(images) >= limit:
+                break
+            if not file_name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
+                continue
+            try:
+                with open(os.path.join(folder, file_name), "rb") as f:
+                    images.append(decode_image(f.read()))
+            except Exception:
+                continue
+    # Pad with synthetic images when the folder has too few
+    rng = np.random.RandomState(0)
+    while len(images) < limit:
+        images.append(Image.fromarray((rng.rand(256, 256, 3) * 255).astype(np.uint8)))
+    return images
+
+
+def _measure_backend(backend: str, model_name: str, weights_name: str, folder: str, num_images: int,
+                     batch_size: int) -> Dict[str, Any]:
+    """Runs in a fresh process: loads one backend, then measures memory, latency and vectors."""
+    from model_tools import load_embedding_model, embed_image_tensors
+
+    # Fixed seed so repeated runs (and randomly initialised test models) are comparable
+    torch.manual_seed(0)
+    rss_before = resident_memory_mb()
+    started = time.perf_counter()
+    assets = load_embedding_model(model_name, weights_name, backend=backend, with_text=False)
+    load_seconds = time.perf_counter() - started
+    rss_loaded = resident_memory_mb()
+
+    images = _load_images(folder, num_images)
+    tensors = torch.stack([assets["preprocess"](image) for image in images])
+
+    # Warm-up pass, then timed batches
+    embed_image_tensors(assets, tensors[:batch_size])
+    latencies = []
+    vectors = []
+    for start in range(0, len(tensors), batch_size):
+        batch = tensors[start:start + batch_size]
+        t0 = time.perf_counter()
+        vectors.append(embed_image_tensors(assets, batch))
+        latencies.append((time.perf_counter() - t0) / len(batch))
+
+    return {
+        "backend": backend,
+        "load_seconds": load_seconds,
+        "rss_mb_model": rss_loaded - rss_before,
+        "rss_mb_peak": resident_memory_mb(),
+        "latency_ms_per_image": float(np.median(latencies) * 1000.0),
+        "vectors": np.concatenate(vectors).tolist(),
+    }
+
+
+def _recall_at_k(reference: np.ndarray, candidate: np.ndarray, k: int) -> float:
+    """
+    Every image is used once as a query against all others. Recall@k is the overlap of the
+    candidate backend's top-k neighbours with the fp32 top-k neighbours.
+    """
+    def top_k(vectors: np.ndarray) -> np.ndarray:
+        scores = vectors @ vectors.T
+        np.fill_diagonal(scores, -np.inf)
+        return np.argsort(-scores, axis=1)[:, :k]
+
+    ref, cand = top_k(reference), top_k(candidate)
+    hits = [len(set(r) & set(c)) for r, c in zip(ref, cand)]
+    return float(np.mean(hits) / k)
+
+
+def compare_backends(backends: List[str], model_name: str, weights_name: str, folder: str,
+                     num_images: int = 64, batch_size: int = 16, k: int = 10) -> List[Dict[str, Any]]:
+    """
+    Loads each backend in its own process (so memory figures are not polluted by the
+    others) and reports resident memory, latency and recall@k against fp32.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    backends = ["fp32"] + [b for b in backends if b != "fp32"]
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                results.append(pool.submit(_measure_backend, backend, model_name, weights_name,
+                                           folder, num_images, batch_size).result())
+            except Exception as e:
+                print(f"FAILURE: backend {backend} could not be measured: {e}")
+
+    fp32 = next((result for result in results if result["backend"] == "fp32"), None)
+    if fp32 is None:
+        raise RuntimeError("The fp32 reference could not be measured, so recall cannot be computed.")
+    reference = np.asarray(fp32["vectors"], dtype=np.float32)
+    k = min(k, len(reference) - 1)
+    for result in results:
+        vectors = np.asarray(result.pop("vectors"), dtype=np.float32)
+        result[f"recall@{k}"] = _recall_at_k(reference, vectors, k)
+        result["mean_cosine_to_fp32"] = float(np.mean(np.sum(reference * vectors, axis=1)))
+    return results
+
+
+if __name__ == "__main__":
+    from model_tools import MODEL_NAME, PRETRAINED_WEIGHTS
+
+    parser = argparse.ArgumentParser(description="Compare memory, latency and recall of the inference backends.")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="Comma separated list of backends.")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--weights", default=PRETRAINED_WEIGHTS)
+    parser.add_argument("--folder", default=os.path.join(BASE_DIR, "story_protocol_assets"),
+                        help="Images used for latency and recall (synthetic images fill any gap).")
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    results = compare_backends(args.backends.split(","), args.model, args.weights, args.folder,
+                               num_images=args.images, batch_size=args.batch_size, k=args.k)
+
+    print(f"\n{'backend':<8} {'model RSS MB':>12} {'peak RSS MB':>12} {'ms/image':>9} {'recall':>7} {'cos(fp32)':>9}")
+    for result in results:
+        recall = next(v for key, v in result.items() if key.startswith("recall@"))
+        print(f"{result['backend']:<8} {result['rss_mb_model']:>12.0f} {result['rss_mb_peak']:>12.0f} "
+              f"{result['latency_ms_per_image']:>9.1f} {recall:>7.3f} {result['mean_cosine_to_fp32']:>9.4f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -1,13 +1,28 @@
 import requests
+import argparse
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
 
 # --- Configuration ---
 # Set this to the folder containing your Story Protocol images
 IMAGE_FOLDER = "./story_protocol_assets"
 # The endpoint on your running FastAPI server that adds the vector
 ADD_VECTOR_URL = "http://127.0.0.1:8000/add-vector"
+# The bulk endpoint that embeds and stores many images per request
+ADD_VECTORS_URL = "http://127.0.0.1:8000/add-vectors"
 # List of image file extensions to process
 ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Files that were already ingested, one filename per line, so interrupted runs can resume
+CHECKPOINT_FILE = "./.ingestion_checkpoint"
+# Images per /add-vectors request and number of requests in flight
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_WORKERS = 4
+# How often a batch is retried when the server answers 503 (busy) or drops the connection
+MAX_RETRIES = 5
+MIME_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.webp': 'image/webp'}
 
 def batch_ingestion():
     """
@@ -65,5 +80,133 @@ def batch_ingestion():
     print(f"Total files attempted: {file_count}")
     print(f"Total files successfully added: {success_count}")
 
+
+
+# --- Parallel, resumable ingestion through /add-vectors ---
+
+def _load_checkpoint(checkpoint_file: str) -> set:
+    if not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def _post_batch(session: requests.Session, url: str, filenames: List[str]) -> dict:
+    """
+    Uploads one batch of files to the bulk endpoint, retrying while the server is busy.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        handles = [open(os.path.join(IMAGE_FOLDER, name), 'rb') for name in filenames]
+        try:
+            files = [
+                ('files', (name, handle, MIME_TYPES.get(os.path.splitext(name)[1].lower(), 'image/jpeg')))
+                for name, handle in zip(filenames, handles)
+            ]
+            response = session.post(url, files=files, timeout=600)
+        except requests.exceptions.ConnectionError:
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+        finally:
+            for handle in handles:
+                handle.close()
+
+        if response.status_code == 503 and attempt < MAX_RETRIES:
+            time.sleep(float(response.headers.get('Retry-After', 2 ** attempt)))
+            continue
+        response.raise_for_status()
+        return response.json()
+
+
+def parallel_ingestion(batch_size: int = DEFAULT_BATCH_SIZE, workers: int = DEFAULT_WORKERS,
+                       url: str = ADD_VECTORS_URL, checkpoint_file: str = CHECKPOINT_FILE):
+    """
+    Uploads the IMAGE_FOLDER in batches to /add-vectors with several requests in flight.
+    Finished files are appended to the checkpoint file, so re-running skips them.
+    """
+    if not os.path.isdir(IMAGE_FOLDER):
+        print(f"ERROR: Image folder not found at '{IMAGE_FOLDER}'.")
+        return
+
+    done = _load_checkpoint(checkpoint_file)
+    pending = sorted(
+        name for name in os.listdir(IMAGE_FOLDER)
+        if name.lower().endswith(ALLOWED_EXTENSIONS) and os.path.isfile(os.path.join(IMAGE_FOLDER, name)) and name not in done
+    )
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    print("--- Starting Parallel Ingestion ---")
+    print(f"Targeting URL: {url}")
+    print(f"{len(done)} files already ingested, {len(pending)} to go in {len(batches)} batches ({workers} workers).")
+    if not batches:
+        return
+
+    # One pooled session per worker thread
+    local = threading.local()
+    def session() -> requests.Session:
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    totals = {'added': 0, 'duplicates': 0, 'skipped': 0, 'errors': 0, 'failed_batches': 0}
+    processed = 0
+    started = time.perf_counter()
+
+    with open(checkpoint_file, 'a', encoding='utf-8') as checkpoint, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(lambda b=batch: _post_batch(session(), url, b)): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            processed += len(batch)
+            try:
+                data = future.result()
+            except requests.exceptions.ConnectionError:
+                print(f"FATAL ERROR: Could not connect to the server at {url}.")
+                print("Please ensure your FastAPI application is running!")
+                for other in futures:
+                    other.cancel()
+                break
+            except Exception as e:
+                totals['failed_batches'] += 1
+                print(f"FAILURE: batch starting with {batch[0]} failed: {e}")
+                continue
+
+            totals['added'] += len(data.get('added', []))
+            totals['duplicates'] += len(data.get('duplicates', []))
+            totals['skipped'] += len(data.get('skipped', []))
+            totals['errors'] += len(data.get('errors', []))
+            for error in data.get('errors', []):
+                print(f"FAILURE: {error['filename']}: {error['detail']}")
+
+            # Added files, duplicates of stored bytes and skipped (already indexed) files are
+            # final; only errors are retried on the next run
+            finished = (set(data.get('added', [])) | set(data.get('skipped', []))
+                        | {duplicate['id'] for duplicate in data.get('duplicates', [])})
+            checkpoint.writelines(f"{name}\n" for name in batch if name in finished)
+            checkpoint.flush()
+
+            elapsed = time.perf_counter() - started
+            rate = processed / elapsed if elapsed > 0 else 0.0
+            eta = (len(pending) - processed) / rate if rate > 0 else 0.0
+            print(f"[{processed}/{len(pending)}] {rate:.1f} images/s, ETA {eta:.0f}s. "
+                  f"Database count: {data.get('new_total_count', 'N/A')}")
+
+    elapsed = time.perf_counter() - started
+    print("\n--- Parallel Ingestion Complete ---")
+    print(f"Added: {totals['added']}, duplicates: {totals['duplicates']}, skipped: {totals['skipped']}, "
+          f"errors: {totals['errors']}, failed batches: {totals['failed_batches']}")
+    print(f"Throughput: {processed / elapsed if elapsed > 0 else 0.0:.1f} images/s over {elapsed:.1f}s")
+
+
 if __name__ == "__main__":
-    batch_ingestion()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Upload the Story Protocol assets to the IP Lens API.")
+    parser.add_argument("--serial", action="store_true", help="Use the original one-request-per-file /add-vector path.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Images per /add-vectors request.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent requests.")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="File recording already ingested filenames.")
+    args = parser.parse_args()
+
+    if args.serial:
+        batch_ingestion()
+    else:
+        parallel_ingestion(batch_size=args.batch_size, workers=args.workers, checkpoint_file=args.checkpoint)
\ No newline at end of file
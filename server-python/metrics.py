@@ -0,0 +1,350 @@
+import asyncio
+import bisect
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter as _FrameCounter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi.responses import JSONResponse
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Add a Server-Timing header with the per-stage durations to every response
+SERVER_TIMING = os.getenv("IPLENS_SERVER_TIMING", "1") == "1"
+# Allow arming the sampling profiler over HTTP (POST /debug/profile)
+PROFILING_ENABLED = os.getenv("IPLENS_PROFILING", "0") == "1"
+# Profile this many requests right after startup (0 = off)
+PROFILE_REQUESTS_AT_STARTUP = int(os.getenv("IPLENS_PROFILE_REQUESTS", "0"))
+PROFILE_DIR = os.getenv("IPLENS_PROFILE_DIR", os.path.join(BASE_DIR, "profiles"))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("IPLENS_PROFILE_INTERVAL_MS", "5")) / 1000.0
+
+# Seconds; covers sub-millisecond cache hits up to multi-second bulk requests
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+# --- (1) Metric Types (Prometheus text exposition format) ---
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(labelnames, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(_Metric):
+    """A gauge set directly, or read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], Iterable[Tuple[Dict[str, Any], float]]]] = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], Iterable[Tuple[Dict[str, Any], float]]]):
+        """`function` returns (labels, value) pairs; it replaces any directly set values."""
+        self._function = function
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            try:
+                items = sorted((self._key(labels), value) for labels, value in self._function())
+            except Exception as e:
+                print(f"WARNING: Could not collect {self.name}: {e}")
+                items = []
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: per-bucket counts (plus +Inf), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self._lock:
+            items = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- (2) Request-Path Metrics ---
+
+REQUEST_SECONDS = Histogram("iplens_request_seconds", "End-to-end request latency.", ("method", "route", "status"))
+STAGE_SECONDS = Histogram("iplens_stage_seconds", "Time spent per request-path stage.", ("stage",))
+BATCH_SIZE = Histogram("iplens_batch_size", "Items per model forward pass.", ("batcher",), buckets=BATCH_SIZE_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram("iplens_queue_wait_seconds", "Time items wait in a batcher queue.", ("batcher",))
+
+# Stage durations of the current request, for the Server-Timing header
+_REQUEST_STAGES: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("iplens_request_stages", default=None)
+
+
+def observe_stage(name: str, seconds: float):
+    """Records a stage duration globally and, inside a request, for its Server-Timing header."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    stages = _REQUEST_STAGES.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+def add_stages(stages: Dict[str, float]):
+    """
+    Adds durations recorded by collect_stages (in a worker thread or process, or for a
+    batch shared with other requests) to the current request's Server-Timing header.
+    """
+    current = _REQUEST_STAGES.get()
+    if current is not None:
+        for name, seconds in stages.items():
+            current[name] = current.get(name, 0.0) + seconds
+
+
+def collect_stages(fn: Callable[..., Any], *args: Any) -> Tuple[Any, Dict[str, float]]:
+    """
+    Runs `fn` with a fresh stage record and returns (result, stages). Executor threads and
+    processes do not see the caller's context, so work submitted there is wrapped in this
+    and the caller hands the stages to add_stages.
+    """
+    stages: Dict[str, float] = {}
+
+    def call():
+        _REQUEST_STAGES.set(stages)
+        return fn(*args)
+
+    return contextvars.copy_context().run(call), stages
+
+
+@contextmanager
+def stage(name: str):
+    """Times the enclosed block (awaits included) as stage `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse whose body rendering is recorded as the "serialize" stage."""
+
+    def render(self, content: Any) -> bytes:
+        with stage("serialize"):
+            return super().render(content)
+
+
+def _server_timing(stages: Dict[str, float], total: float) -> bytes:
+    entries = [f"{name};dur={seconds * 1000.0:.2f}" for name, seconds in stages.items()]
+    entries.append(f"total;dur={total * 1000.0:.2f}")
+    return ", ".join(entries).encode()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every request by route template, collects the stages
+    recorded while handling it, adds them as a Server-Timing header and feeds the
+    request count of an armed profiler.
+    """
+
+    def __init__(self, app, server_timing: bool = SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stages: Dict[str, float] = {}
+        # Only requests that started while the profiler was armed count towards it
+        profiled = PROFILER.armed
+        token = _REQUEST_STAGES.set(stages)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if self.server_timing:
+                    headers = list(message.get("headers") or [])
+                    headers.append((b"server-timing", _server_timing(stages, time.perf_counter() - started)))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            _REQUEST_STAGES.reset(token)
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=scope.get("method", ""),
+                                    route=getattr(route, "path", "unmatched"), status=status["code"])
+            if profiled and PROFILER.request_finished():
+                # Joining the sampler and writing the profile are blocking
+                await asyncio.to_thread(PROFILER.finish)
+
+
+# --- (3) Sampling Profiler ---
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread (event loop, blocking pool, inference workers)
+    every `interval` seconds while armed, and writes them in collapsed-stack format
+    ("frame;frame;frame count", readable by flamegraph.pl or speedscope) once the
+    requested number of requests has finished.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS, output_dir: str = PROFILE_DIR):
+        self.interval = interval
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self._remaining = 0
+        self._samples: _FrameCounter = _FrameCounter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.last_profile: Optional[str] = None
+
+    @property
+    def armed(self) -> bool:
+        return self._remaining > 0
+
+    def arm(self, requests: int):
+        with self._lock:
+            if self.armed or requests <= 0:
+                return
+            self._remaining = requests
+            self._samples = _FrameCounter()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample_loop, name="iplens-profiler", daemon=True)
+            self._thread.start()
+        print(f"--- Sampling profiler armed for {requests} requests ---")
+
+    def request_finished(self) -> bool:
+        """Counts one profiled request; True when it was the last one and finish() is due."""
+        if not self.armed:
+            return False
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining > 0:
+                return False
+            self._stop.set()
+        return True
+
+    def finish(self):
+        """Waits for the sampling thread and writes the profile (blocking; call off the event loop)."""
+        self._thread.join()
+        self.last_profile = self._write()
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                self._samples[";".join(reversed(stack))] += 1
+
+    def _write(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w") as f:
+            for stack, count in self._samples.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"--- Sampling profile written to {path} ({sum(self._samples.values())} samples) ---")
+        return path
+
+    def status(self) -> Dict[str, Any]:
+        return {"armed": self.armed, "remaining_requests": self._remaining, "last_profile": self.last_profile}
+
+
+PROFILER = SamplingProfiler()
+
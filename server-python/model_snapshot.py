@@ -0,0 +1,125 @@
+import json
+import os
+from typing import Any, Dict
+
+import open_clip
+import torch
+from open_clip.transformer import QuickGELU
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from torch import nn
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Pre-serialized vision (and text) towers, written on the first load and read on every later one
+SNAPSHOT_DIR = os.getenv("IPLENS_SNAPSHOT_DIR", os.path.join(BASE_DIR, "model_snapshots"))
+# Set to 0 to always build the model through open_clip (and its weight download)
+USE_SNAPSHOT = os.getenv("IPLENS_MODEL_SNAPSHOT", "1") == "1"
+
+
+def snapshot_path(model_name: str, weights_name: str, tower: str = "visual") -> str:
+    suffix = "" if tower == "visual" else f"__{tower}"
+    return os.path.join(SNAPSHOT_DIR, f"{model_name}__{weights_name}{suffix}.safetensors")
+
+
+def save_vision_snapshot(visual: nn.Module, path: str):
+    """
+    Writes the vision tower's weights as safetensors, with what is needed to rebuild the
+    module and its transform (preprocess config, activation) in the file's metadata.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    metadata = {
+        "preprocess_cfg": json.dumps(getattr(visual, "preprocess_cfg", None) or {}),
+        "quick_gelu": json.dumps(any(isinstance(module, QuickGELU) for module in visual.modules())),
+    }
+    tmp_path = f"{path}.tmp"
+    save_file({name: tensor.detach().contiguous().cpu() for name, tensor in visual.state_dict().items()},
+              tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+    print(f"--- Saved vision snapshot: {path} ---")
+
+
+def load_vision_snapshot(model_name: str, path: str, device: torch.device) -> nn.Module:
+    """
+    Rebuilds the vision tower from a snapshot without any network access.
+
+    The architecture is created on the meta device (no allocation, no random init) and
+    the safetensors weights are assigned in place, so loading costs little more than
+    mapping the file. The text tower is never materialized.
+    """
+    with safe_open(path, framework="pt") as f:
+        metadata: Dict[str, Any] = {key: json.loads(value) for key, value in (f.metadata() or {}).items()}
+
+    with torch.device("meta"):
+        model = open_clip.create_model(model_name, pretrained=None, device="meta",
+                                       force_quick_gelu=metadata.get("quick_gelu", False))
+    visual = model.visual
+    del model
+
+    visual.load_state_dict(load_file(path, device=str(device)), assign=True)
+    preprocess_cfg = metadata.get("preprocess_cfg")
+    if preprocess_cfg:
+        # JSON turns the size tuple into a list
+        size = preprocess_cfg["size"]
+        preprocess_cfg["size"] = tuple(size) if isinstance(size, list) else size
+        visual.preprocess_cfg = preprocess_cfg
+    return visual.eval()
+
+
+def text_tower(model: nn.Module) -> nn.Module:
+    """
+    The OpenCLIP model without its vision tower: what encode_text needs (token embedding,
+    transformer, final norm, projection) and nothing else.
+    """
+    del model.visual
+    return model.eval()
+
+
+def save_text_snapshot(text_model: nn.Module, path: str):
+    """Writes a text tower from text_tower() as safetensors."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    metadata = {"quick_gelu": json.dumps(any(isinstance(module, QuickGELU) for module in text_model.modules()))}
+    tmp_path = f"{path}.tmp"
+    save_file({name: tensor.detach().contiguous().cpu() for name, tensor in text_model.state_dict().items()},
+              tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+    print(f"--- Saved text snapshot: {path} ---")
+
+
+def load_text_snapshot(model_name: str, path: str, device: torch.device) -> nn.Module:
+    """
+    Rebuilds the text tower from a snapshot, like load_vision_snapshot. The causal attention
+    mask is not a saved tensor, so it is recomputed from the context length.
+    """
+    with safe_open(path, framework="pt") as f:
+        metadata: Dict[str, Any] = {key: json.loads(value) for key, value in (f.metadata() or {}).items()}
+
+    with torch.device("meta"):
+        model = open_clip.create_model(model_name, pretrained=None, device="meta",
+                                       force_quick_gelu=metadata.get("quick_gelu", False))
+    text_model = text_tower(model)
+    text_model.load_state_dict(load_file(path, device=str(device)), assign=True)
+
+    for name, buffer in list(text_model.named_buffers()):
+        if not buffer.is_meta:
+            continue
+        if not name.endswith("attn_mask"):
+            raise RuntimeError(f"Text snapshot {path} does not restore buffer '{name}'.")
+        context_length = buffer.shape[0]
+        mask = torch.full((context_length, context_length), float("-inf"), device=device).triu_(1)
+        owner = text_model.get_submodule(name.rpartition(".")[0]) if "." in name else text_model
+        owner.register_buffer(name.rpartition(".")[2], mask, persistent=False)
+    return text_model.eval()
+
+
+def openclip_transform(preprocess_cfg: Dict[str, Any]):
+    """The OpenCLIP evaluation transform for a preprocess config."""
+    return open_clip.image_transform(
+        preprocess_cfg["size"],
+        is_train=False,
+        mean=preprocess_cfg.get("mean"),
+        std=preprocess_cfg.get("std"),
+        resize_mode=preprocess_cfg.get("resize_mode"),
+        interpolation=preprocess_cfg.get("interpolation"),
+        fill_color=preprocess_cfg.get("fill_color", 0),
+    )
@@ -1,76 +1,226 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PIL import Image
 import torch 
 import open_clip
 import chromadb
 from chromadb.utils import embedding_functions
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+from inference_backends import INFERENCE_BACKEND, build_backend
+from vector_index import MmapVectorIndex
+from vector_service import VECTOR_SHARDS, ShardedCollection
+from index_versions import DEFAULT_COLLECTION, DEFAULT_MODEL, IndexVersion, active_version
+from ann_index import ANN_INDEX_PATH, AnnCollection, IVFPQIndex
+from phash_index import PerceptualHashIndex, load_phash_index
+from image_decode import build_preprocess, decode_image as _decode_image
+from model_snapshot import (USE_SNAPSHOT, load_text_snapshot, load_vision_snapshot, openclip_transform, save_text_snapshot,
+                            save_vision_snapshot, snapshot_path, text_tower)
+from metrics import stage
 
 # We assume the vector dimension is 768 based on the ViT-B-16 model
 VECTOR_DIMENSION = 768 
 
 
+# Which vector store load_vector_db opens: "chroma", the embedded "mmap" index, or "sharded"
+# (shard services listed in IPLENS_VECTOR_SHARDS, see vector_service.py)
+VECTOR_STORE = os.getenv("IPLENS_VECTOR_STORE", "chroma")
+# Folder of the embedded mmap index
+VECTOR_INDEX_PATH = os.getenv("IPLENS_VECTOR_INDEX_PATH", "./vector_index")
+# Keep the CLIP text tower loaded for /search-text (set to 0 to save its memory)
+TEXT_SEARCH = os.getenv("IPLENS_TEXT_SEARCH", "1") == "1"
+
+
 # --- (1) Model Loading Function ---
 
-# NOTE: The OpenCLIP model structure is 'ViT-B-16' and its weights are 'openai'
-MODEL_NAME = "ViT-B-16"
-PRETRAINED_WEIGHTS = "openai"
+# OpenCLIP model and weights to use before any index has been activated, and the target of
+# reembed.py ("none" = random weights)
+DEFAULT_MODEL_NAME = os.getenv("IPLENS_MODEL_NAME", DEFAULT_MODEL[0])
+DEFAULT_PRETRAINED_WEIGHTS = os.getenv("IPLENS_PRETRAINED_WEIGHTS", DEFAULT_MODEL[1])
+if DEFAULT_PRETRAINED_WEIGHTS.lower() in ("", "none"):
+    DEFAULT_PRETRAINED_WEIGHTS = None
+
+# NOTE: Queries must be embedded by the model that built the index, so the served model
+# is the one recorded in the active index pointer (see index_versions.py)
+ACTIVE_INDEX = active_version(DEFAULT_MODEL_NAME, DEFAULT_PRETRAINED_WEIGHTS)
+MODEL_NAME = ACTIVE_INDEX.model_name
+PRETRAINED_WEIGHTS = ACTIVE_INDEX.weights_name
+if (MODEL_NAME, PRETRAINED_WEIGHTS) != (DEFAULT_MODEL_NAME, DEFAULT_PRETRAINED_WEIGHTS):
+    print(f"NOTE: The active index was built with {ACTIVE_INDEX.model_id}, which is served; "
+          f"run reembed.py to move to {DEFAULT_MODEL_NAME}/{DEFAULT_PRETRAINED_WEIGHTS}.")
 
-def load_ip_model(model_name: str = MODEL_NAME, weights_name: str = PRETRAINED_WEIGHTS) -> Dict[str, Any]:
+def load_embedding_model(model_name: str = MODEL_NAME, weights_name: str = PRETRAINED_WEIGHTS, backend: str = INFERENCE_BACKEND,
+                         with_text: bool = TEXT_SEARCH) -> Dict[str, Any]:
     """
-    Loads the OpenCLIP vision model and initializes the ChromaDB vector store.
+    Loads the OpenCLIP model and its image preprocessing transform, and keeps only
+    the vision encoder in the requested inference backend (see inference_backends.py).
+    With `with_text`, the text tower and tokenizer are kept as well (fp32, whatever the
+    backend), for text-to-image search.
+    After the first load the towers are read from local safetensors snapshots
+    (see model_snapshot.py), with no network access and no random initialization.
     """
-    print(f"--- Loading OpenCLIP model: {model_name}/{weights_name} ---")
-    
-    try:
-        # 1. Define the device (use GPU if available, otherwise CPU)
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        
-        # 2. Load the model and the required image preprocessing object
+    print(f"--- Loading OpenCLIP model: {model_name}/{weights_name} (backend: {backend}, text: {with_text}) ---")
+
+    # 1. Define the device (use GPU if available, otherwise CPU)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # 2. Load the vision tower and the required image preprocessing object
+    snapshot = snapshot_path(model_name, weights_name)
+    text_snapshot = snapshot_path(model_name, weights_name, tower="text")
+    text_model = None
+    if USE_SNAPSHOT and weights_name and os.path.exists(snapshot) and (not with_text or os.path.exists(text_snapshot)):
+        print(f"--- Loading vision snapshot: {snapshot} ---")
+        visual = load_vision_snapshot(model_name, snapshot, device)
+        preprocess = openclip_transform(visual.preprocess_cfg)
+        if with_text:
+            text_model = load_text_snapshot(model_name, text_snapshot, device)
+    else:
         model, _, preprocess = open_clip.create_model_and_transforms(
             model_name, 
             pretrained=weights_name, 
             device=device
         )
-        
-        # 3. Set model to evaluation mode (CRUCIAL)
-        model.eval() 
-        
-        # --- ChromaDB Initialization ---
-        print("--- Initializing ChromaDB Vector Store ---")
+        visual = model.visual
+        if with_text:
+            text_model = text_tower(model)
+        del model
+        # Randomly initialised models (no weights) are not worth snapshotting
+        if USE_SNAPSHOT and weights_name:
+            save_vision_snapshot(visual, snapshot)
+            if text_model is not None:
+                save_text_snapshot(text_model, text_snapshot)
 
-        # 4. Initialize the Chroma Client (stores data locally in a folder named 'chroma_data')
-        chroma_client = chromadb.PersistentClient(path="./chroma_data")
-        
-        # 5. Define the Embedding Function for Chroma
-        class DummyEmbeddingFunction(embedding_functions.EmbeddingFunction):
-            def __call__(self, texts: list[str]) -> list[list[float]]:
-                return [[0.0] * VECTOR_DIMENSION] * len(texts)
+    # 3. Set model to evaluation mode (CRUCIAL)
+    visual.eval() 
 
-        clip_ef = DummyEmbeddingFunction()
+    # 4. Keep only the vision encoder, in the configured precision/runtime
+    dim = getattr(visual, "output_dim", None)
+    preprocess = build_preprocess(visual, preprocess)
+    # Random weights differ on every load, so their ONNX export must not be reused
+    model_tag = f"{model_name}__{weights_name}" if weights_name is not None else None
+    encoder = build_backend(visual, backend, model_tag=model_tag, device=device)
 
-        
-        # 6. Get or Create the Collection (your table of vectors)
-        collection_name = "ip_vector_collection"
-        
-        try:
-            collection = chroma_client.get_collection(name=collection_name)
-            print(f"Loaded existing collection: {collection_name}. Count: {collection.count()}")
-        except Exception:
-            collection = chroma_client.create_collection(
-                name=collection_name, 
-                embedding_function=clip_ef
-            )
-            print(f"Created new collection: {collection_name}")
-            
-        # 7. Return the model assets AND the database collection
-        print(f"Model and VectorDB loaded successfully on device: {device}")
-        return {
-            "model": model, 
-            "preprocess": preprocess, 
-            "device": device,
-            "vector_db": collection
-        }
+    return {
+        "model": encoder, 
+        "preprocess": preprocess, 
+        "device": device,
+        "backend": backend,
+        "dim": dim,
+        "text_model": text_model,
+        "tokenizer": open_clip.get_tokenizer(model_name) if with_text else None
+    }
+
+
+def load_vector_db(store: str = VECTOR_STORE, use_ann: bool = True, version: Optional[IndexVersion] = None) -> chromadb.Collection:
+    """
+    Opens the persistent ChromaDB store and returns the IP vector collection.
+    With store="mmap" the embedded MmapVectorIndex is returned instead; it offers the
+    same add/get/query/count calls, so the functions below work with either.
+    With store="sharded" it is a ShardedCollection over the shard services, which API
+    workers on any host can share.
+    When a trained IVF-PQ index exists at ANN_INDEX_PATH, it is reconciled with the store
+    and the store is wrapped in an AnnCollection so unfiltered searches use it (not for the
+    sharded store: the in-process index would only see its own worker's adds).
+    `version` picks the versioned collection (default: the active one); a collection that
+    recorded a different model is refused.
+    """
+    version = version or ACTIVE_INDEX
+    collection = _open_vector_store(store, version)
+    version.check_collection(collection.metadata)
+    ann_path = ann_index_path(version)
+    if use_ann and store != "sharded" and os.path.exists(ann_path):
+        index = IVFPQIndex.load(ann_path)
+        print(f"Loaded IVF-PQ index from {ann_path}: {len(index)} vectors, nlist={index.nlist}, m={index.m}")
+        ann = AnnCollection(collection, index, index_path=ann_path)
+        # Rows written after the last save (e.g. before a crash) are not in the index yet
+        ann.reconcile()
+        return ann
+    return collection
+
+
+def ann_index_path(version: IndexVersion) -> str:
+    """IVF-PQ index file of a versioned collection (ANN_INDEX_PATH for the original one)."""
+    if version.collection == DEFAULT_COLLECTION:
+        return ANN_INDEX_PATH
+    root, ext = os.path.splitext(ANN_INDEX_PATH)
+    return f"{root}__{version.collection}{ext}"
+
+
+def _open_vector_store(store: str, version: IndexVersion) -> chromadb.Collection:
+    collection_name = version.collection
+    if store == "mmap":
+        # Versioned indexes live in sub-folders next to the original one
+        path = VECTOR_INDEX_PATH if collection_name == DEFAULT_COLLECTION else os.path.join(VECTOR_INDEX_PATH, collection_name)
+        print(f"--- Initializing embedded mmap vector index at {path} ---")
+        index = MmapVectorIndex(path, name=collection_name, metadata=version.collection_metadata())
+        print(f"Loaded mmap index: {index.name}. Count: {index.count()}")
+        return index
+    if store == "sharded":
+        print(f"--- Connecting to {len(VECTOR_SHARDS)} vector shards ---")
+        collection = ShardedCollection(VECTOR_SHARDS, name=collection_name, metadata=version.collection_metadata())
+        print(f"Connected to sharded collection: {collection_name}. Count: {collection.count()}")
+        return collection
+    if store != "chroma":
+        raise ValueError(f"Unknown vector store '{store}'. Use 'chroma', 'mmap' or 'sharded'.")
+
+    print("--- Initializing ChromaDB Vector Store ---")
+
+    # 1. Initialize the Chroma Client (stores data locally in a folder named 'chroma_data')
+    chroma_client = chromadb.PersistentClient(path="./chroma_data")
+    
+    # 2. Define the Embedding Function for Chroma
+    class DummyEmbeddingFunction(embedding_functions.EmbeddingFunction):
+        def __call__(self, texts: list[str]) -> list[list[float]]:
+            return [[0.0] * (version.dim or VECTOR_DIMENSION)] * len(texts)
+
+    clip_ef = DummyEmbeddingFunction()
+
+    
+    # 3. Get or Create the Collection (your table of vectors), recording its model
+    try:
+        collection = chroma_client.get_collection(name=collection_name)
+        print(f"Loaded existing collection: {collection_name}. Count: {collection.count()}")
+    except Exception:
+        collection = chroma_client.create_collection(
+            name=collection_name, 
+            embedding_function=clip_ef,
+            metadata=version.collection_metadata()
+        )
+        print(f"Created new collection: {collection_name}")
+
+    return collection
+
+
+def load_near_duplicate_index(store: str = VECTOR_STORE) -> Optional[PerceptualHashIndex]:
+    """
+    Opens the perceptual hash index, or returns None with the sharded store: the index is
+    held in memory per process, so API workers sharing the shards would each see only
+    their own adds and answer near-duplicate lookups and duplicate checks differently.
+    """
+    if store == "sharded":
+        print("Perceptual hash index disabled: it is per process, and the sharded store is shared by all workers.")
+        return None
+    return load_phash_index()
+
+
+def load_ip_model(model_name: str = MODEL_NAME, weights_name: str = PRETRAINED_WEIGHTS, with_text: bool = TEXT_SEARCH) -> Dict[str, Any]:
+    """
+    Loads the OpenCLIP vision model and initializes the ChromaDB vector store.
+    """
+    try:
+        # The model and the stores are independent, so they are loaded concurrently
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="iplens-load") as pool:
+            model_future = pool.submit(load_embedding_model, model_name, weights_name, with_text=with_text)
+            db_future = pool.submit(load_vector_db)
+            phash_future = pool.submit(load_near_duplicate_index)
+            assets = model_future.result()
+            assets["vector_db"] = db_future.result()
+            assets["phash_index"] = phash_future.result()
+
+        # Return the model assets AND the database collection
+        print(f"Model and VectorDB loaded successfully on device: {assets['device']}")
+        return assets
         
     except Exception as e:
         print(f"FATAL ERROR: Could not load OpenCLIP model or ChromaDB. Details: {e}")
@@ -79,50 +229,266 @@ def load_ip_model(model_name: str = MODEL_NAME, weights_name: str = PRETRAINED_W
 
 # --- (2) Vector Generation Function ---
 
-def generate_ip_vector(loaded_assets: Dict[str, Any], image: Image.Image) -> np.ndarray:
+def decode_image(source: Union[bytes, str, os.PathLike]) -> Image.Image:
     """
-    Generates a feature vector from a PIL Image object using the pre-loaded OpenCLIP model.
+    Decodes uploaded image bytes, or an image file given by path, into a fully loaded PIL Image.
+    Size limits and reduced-scale JPEG decoding are handled by image_decode.py.
+    """
+    return _decode_image(source)
+
+
+def embed_image_tensors(loaded_assets: Dict[str, Any], input_tensor: torch.Tensor) -> np.ndarray:
+    """
+    Runs the model on an already preprocessed batch tensor of shape (N, 3, H, W).
+    Returns an array of shape (N, dim), one normalized row per image.
     """
     model = loaded_assets["model"]
-    preprocess = loaded_assets["preprocess"]
     device = loaded_assets["device"]
 
-    # 1. Preprocessing (Uses the specific function provided by OpenCLIP)
-    input_tensor = preprocess(image).unsqueeze(0).to(device) 
-    
-    # 2. Inference (Running the model)
     with torch.no_grad():
-        vector_output = model.encode_image(input_tensor)
+        vector_output = model.encode_image(input_tensor.to(device))
         vector_output /= vector_output.norm(dim=-1, keepdim=True)
-        
-    # 3. Post-processing
-    return vector_output.cpu().numpy().squeeze()
+
+    return vector_output.cpu().numpy()
+
+
+def generate_ip_vectors(loaded_assets: Dict[str, Any], images: List[Image.Image]) -> np.ndarray:
+    """
+    Generates feature vectors for a batch of PIL Images with a single forward pass.
+    Returns an array of shape (len(images), dim), one normalized row per image.
+    """
+    preprocess = loaded_assets["preprocess"]
+
+    # 1. Preprocessing each image, then stacking them into one batch tensor
+    with stage("preprocess"):
+        input_tensor = torch.stack([preprocess(image) for image in images])
+
+    # 2. Inference (Running the model once for the whole batch)
+    with stage("inference"):
+        return embed_image_tensors(loaded_assets, input_tensor)
+
+
+def normalize_text_query(text: str) -> str:
+    """Lower-cases and collapses whitespace, as the CLIP tokenizer does, so equivalent queries share a cache entry."""
+    return " ".join(text.lower().split())
+
+
+def generate_text_vectors(loaded_assets: Dict[str, Any], texts: List[str]) -> np.ndarray:
+    """
+    Encodes a batch of text queries with the CLIP text tower into the image embedding
+    space (one tokenizer call, one forward pass). Returns normalized rows of shape (len(texts), dim).
+    """
+    text_model = loaded_assets.get("text_model")
+    if text_model is None:
+        raise RuntimeError("The text tower is not loaded (IPLENS_TEXT_SEARCH=0).")
+
+    with stage("tokenize"):
+        tokens = loaded_assets["tokenizer"](texts).to(loaded_assets["device"])
+
+    with stage("text_inference"), torch.no_grad():
+        vector_output = text_model.encode_text(tokens).float()
+        vector_output /= vector_output.norm(dim=-1, keepdim=True)
+    return vector_output.cpu().numpy()
+
+
+def generate_ip_vector(loaded_assets: Dict[str, Any], image: Image.Image) -> np.ndarray:
+    """
+    Generates a feature vector from a PIL Image object using the pre-loaded OpenCLIP model.
+    """
+    return generate_ip_vectors(loaded_assets, [image])[0]
 
 
 # --- (3) Vector Addition Function ---
 
-def add_vector_to_db(collection: chromadb.Collection, vector: np.ndarray, file_name: str, metadata: dict = None) -> int:
+def find_by_content_hash(collection: chromadb.Collection, content_hash: str) -> Optional[str]:
+    """
+    Returns the id of a stored vector whose source bytes have this content hash, if any.
+    """
+    existing = collection.get(where={"content_hash": content_hash}, limit=1, include=[])
+    ids = existing.get('ids', [])
+    return ids[0] if ids else None
+
+
+def add_vector_to_db(collection: chromadb.Collection, vector: np.ndarray, file_name: str, metadata: dict = None, content_hash: str = None,
+                     perceptual_hash: int = None, phash_index: PerceptualHashIndex = None) -> int:
     """
     Adds a single vector to the ChromaDB collection.
+    When a content hash is given, it is stored in the metadata and the add is skipped
+    if the same bytes are already indexed under another filename.
+    A perceptual hash is stored in the metadata and, with `phash_index`, indexed for
+    near-duplicate lookups.
     """
+    metadata = dict(metadata or {})
+    if content_hash:
+        duplicate_id = find_by_content_hash(collection, content_hash)
+        if duplicate_id is not None:
+            print(f"INFO: {file_name} has the same content as {duplicate_id}. Skipping add.")
+            return collection.count()
+        metadata["content_hash"] = content_hash
+    if perceptual_hash is not None:
+        metadata["phash"] = f"{perceptual_hash:016x}"
+
     collection.add(
         embeddings=[vector.tolist()],
         documents=[f"Vector for file: {file_name}"],
-        metadatas=[metadata or {}],
+        metadatas=[metadata],
         ids=[file_name]
     )
+    if phash_index is not None and perceptual_hash is not None:
+        phash_index.add([file_name], [perceptual_hash])
     return collection.count()
 
 
+def find_existing_content_hashes(collection: chromadb.Collection, content_hashes: List[str]) -> Dict[str, str]:
+    """
+    Maps each content hash that is already stored in the collection to the id holding it.
+    """
+    if not content_hashes:
+        return {}
+    existing = collection.get(where={"content_hash": {"$in": list(set(content_hashes))}}, include=['metadatas'])
+    return {
+        (metadata or {}).get("content_hash"): stored_id
+        for stored_id, metadata in zip(existing.get('ids', []), existing.get('metadatas', []))
+    }
+
+
+def find_existing_ids(collection: chromadb.Collection, ids: List[str]) -> set:
+    """
+    Returns the subset of `ids` that the collection already holds.
+    """
+    if not ids:
+        return set()
+    return set(collection.get(ids=list(set(ids)), include=[]).get('ids', []))
+
+
+def add_vectors_to_db(collection: chromadb.Collection, vectors: np.ndarray, file_names: List[str], metadatas: List[dict] = None, content_hashes: List[str] = None,
+                      perceptual_hashes: List[Optional[int]] = None, phash_index: PerceptualHashIndex = None) -> int:
+    """
+    Adds a batch of vectors to the ChromaDB collection with a single write.
+    Callers are expected to have removed duplicates already; the total count is read once at the end.
+    """
+    _write_vectors(collection.add, vectors, file_names, metadatas, content_hashes, perceptual_hashes, phash_index)
+    return collection.count()
+
+
+def upsert_vectors_to_db(collection: chromadb.Collection, vectors: np.ndarray, file_names: List[str], metadatas: List[dict] = None, content_hashes: List[str] = None,
+                         perceptual_hashes: List[Optional[int]] = None, phash_index: PerceptualHashIndex = None):
+    """
+    Writes a batch of vectors with a single upsert (replacing ids that already exist),
+    without reading the count back. Used by the write buffer, which keeps its own count.
+    """
+    _write_vectors(collection.upsert, vectors, file_names, metadatas, content_hashes, perceptual_hashes, phash_index)
+
+
+def _write_vectors(write, vectors: np.ndarray, file_names: List[str], metadatas: Optional[List[dict]],
+                   content_hashes: Optional[List[str]], perceptual_hashes: Optional[List[Optional[int]]],
+                   phash_index: Optional[PerceptualHashIndex]):
+    metadatas = [dict(metadata or {}) for metadata in (metadatas or [None] * len(file_names))]
+    if content_hashes:
+        for metadata, image_hash in zip(metadatas, content_hashes):
+            if image_hash:
+                metadata["content_hash"] = image_hash
+    if perceptual_hashes:
+        for metadata, phash in zip(metadatas, perceptual_hashes):
+            if phash is not None:
+                metadata["phash"] = f"{phash:016x}"
+
+    if file_names:
+        write(
+            embeddings=np.asarray(vectors, dtype=np.float32).tolist(),
+            documents=[f"Vector for file: {file_name}" for file_name in file_names],
+            metadatas=metadatas,
+            ids=list(file_names)
+        )
+    if phash_index is not None and perceptual_hashes:
+        hashed = [(file_name, phash) for file_name, phash in zip(file_names, perceptual_hashes) if phash is not None]
+        phash_index.add([file_name for file_name, _ in hashed], [phash for _, phash in hashed])
+
+
 # --- (4) Vector Search Function ---
 
-def search_vector_db(collection: chromadb.Collection, query_vector: np.ndarray, n_results: int = 10) -> dict:
+def search_vector_db(collection: chromadb.Collection, query_vector: np.ndarray, n_results: int = 10, nprobe: Optional[int] = None,
+                     where: Optional[dict] = None, max_distance: Optional[float] = None) -> dict:
     """
     Queries the ChromaDB collection to find the most similar vectors.
+    `nprobe` trades recall for latency on an ANN-wrapped collection and is ignored otherwise.
+    A `where` metadata filter is applied by the store before ranking (exact search).
+    The mmap store prunes rows farther than `max_distance` while it scans; other stores ignore it.
     """
+    kwargs = {"nprobe": nprobe} if isinstance(collection, AnnCollection) else {}
+    if where:
+        kwargs["where"] = where
+    if max_distance is not None and isinstance(collection, MmapVectorIndex):
+        kwargs["max_distance"] = max_distance
     results = collection.query(
         query_embeddings=[query_vector.tolist()],
         n_results=n_results,
-        include=['metadatas', 'distances'] 
+        include=['metadatas', 'distances'],
+        **kwargs
     )
-    return results
\ No newline at end of file
+    return results
+
+def search_vectors_db(collection: chromadb.Collection, query_vectors: List[np.ndarray], n_results: int = 10, nprobe: Optional[int] = None,
+                      where: Optional[dict] = None) -> dict:
+    """
+    Queries the collection with many vectors in one call.
+    The result lists are nested per query, in the order of `query_vectors`.
+    """
+    kwargs = {"nprobe": nprobe} if isinstance(collection, AnnCollection) else {}
+    if where:
+        kwargs["where"] = where
+    return collection.query(
+        query_embeddings=np.asarray(query_vectors, dtype=np.float32).tolist(),
+        n_results=n_results,
+        include=['metadatas', 'distances'],
+        **kwargs
+    )
+
+
+def similarity_from_distance(distance: float) -> float:
+    """Cosine similarity of two unit vectors from their squared-L2 distance."""
+    return 1.0 - distance / 2.0
+
+
+def search_vector_page(collection: chromadb.Collection, query_vector: np.ndarray, n_results: int = 10, offset: int = 0,
+                       where: Optional[dict] = None, min_similarity: Optional[float] = None,
+                       nprobe: Optional[int] = None) -> Tuple[dict, bool]:
+    """
+    Returns one page (ranks offset .. offset + n_results) of a search, and whether a next
+    page exists. One extra result is fetched to tell. With `min_similarity`, results are
+    cut off at the first one below it, and no page follows once the cut-off is reached.
+    The mmap store applies the threshold during its scan, so rows below it are never
+    ranked or read; on Chroma, sharded and ANN stores it is a cut-off after ranking.
+    """
+    max_distance = 2.0 * (1.0 - min_similarity) if min_similarity is not None else None
+    raw = search_vector_db(collection, query_vector, n_results=offset + n_results + 1, nprobe=nprobe, where=where,
+                           max_distance=max_distance)
+    ids, distances, metadatas = raw['ids'][0], raw['distances'][0], raw['metadatas'][0]
+    end = len(ids)
+    if min_similarity is not None:
+        # Distances are sorted, so the first result below the threshold ends the ranking
+        end = next((i for i, distance in enumerate(distances) if similarity_from_distance(distance) < min_similarity), end)
+    stop = min(end, offset + n_results)
+    page = {"ids": [ids[offset:stop]], "distances": [distances[offset:stop]], "metadatas": [metadatas[offset:stop]]}
+    return page, end > stop
+
+
+def mean_query_vector(query_vectors: List[np.ndarray]) -> np.ndarray:
+    """Averages normalized query vectors and re-normalizes the result."""
+    mean = np.mean(np.asarray(query_vectors, dtype=np.float32), axis=0)
+    return mean / max(float(np.linalg.norm(mean)), 1e-12)
+
+
+def reciprocal_rank_fusion(raw_results: dict, n_results: int = 10, k: int = 60) -> List[Dict[str, Any]]:
+    """
+    Merges the per-query rankings of a multi-query result with reciprocal rank fusion:
+    each id scores sum(1 / (k + rank)) over the queries that returned it.
+    Returns the top `n_results` as dicts with id, score, best distance and metadata.
+    """
+    fused: Dict[str, Dict[str, Any]] = {}
+    for ids, distances, metadatas in zip(raw_results['ids'], raw_results['distances'], raw_results['metadatas']):
+        for rank, (item_id, distance, metadata) in enumerate(zip(ids, distances, metadatas), start=1):
+            entry = fused.setdefault(item_id, {"id": item_id, "score": 0.0, "distance": distance, "metadata": metadata or {}})
+            entry["score"] += 1.0 / (k + rank)
+            entry["distance"] = min(entry["distance"], distance)
+    return sorted(fused.values(), key=lambda entry: (-entry["score"], entry["distance"]))[:n_results]
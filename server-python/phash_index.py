@@ -0,0 +1,266 @@
+import argparse
+import functools
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from image_decode import decode_image
+
+# --- Configuration ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# SQLite file holding one 64-bit perceptual hash per indexed id
+PHASH_INDEX_PATH = os.getenv("IPLENS_PHASH_INDEX_PATH", "./phash_index.sqlite3")
+# "phash" (DCT, robust to re-encodes and resizes) or "dhash" (gradient, cheaper)
+PHASH_ALGORITHM = os.getenv("IPLENS_PHASH_ALGORITHM", "phash")
+# Hashes within this many differing bits (of 64) count as near-duplicates
+PHASH_MAX_DISTANCE = int(os.getenv("IPLENS_PHASH_MAX_DISTANCE", "6"))
+
+HASH_BITS = 64
+# The hash is split into this many 16-bit chunks for the multi-index search
+NUM_CHUNKS = 4
+CHUNK_BITS = HASH_BITS // NUM_CHUNKS
+# Recently added hashes are scanned linearly until this many have accumulated
+MIN_PENDING_BEFORE_REBUILD = 4096
+
+
+# --- (1) Hash Functions ---
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), "big")
+
+
+def phash(image: Image.Image) -> int:
+    """DCT hash: signs of the 8x8 lowest frequencies of a 32x32 greyscale thumbnail vs. their median."""
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.Resampling.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    # The DC term only reflects overall brightness, so it is left out of the median
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def dhash(image: Image.Image) -> int:
+    """Gradient hash: whether each pixel of a 9x8 greyscale thumbnail is brighter than its left neighbour."""
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+HASH_FUNCTIONS = {"phash": phash, "dhash": dhash}
+
+
+def perceptual_hash(image: Image.Image, algorithm: str = PHASH_ALGORITHM) -> int:
+    return HASH_FUNCTIONS[algorithm](image)
+
+
+def perceptual_hash_encoded(source: Union[bytes, str, os.PathLike], algorithm: str = PHASH_ALGORITHM) -> int:
+    """
+    Hashes encoded image bytes, or an image file given by path, under the upload size
+    limits. JPEGs are decoded at reduced scale (draft mode), which is much cheaper than a
+    full decode and does not change a 32x32 thumbnail meaningfully.
+    """
+    return perceptual_hash(decode_image(source, target_size=64), algorithm)
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << HASH_BITS) if value >= (1 << (HASH_BITS - 1)) else value
+
+
+def _chunks(hashes: np.ndarray) -> List[np.ndarray]:
+    return [((hashes >> np.uint64(CHUNK_BITS * j)) & np.uint64(0xFFFF)).astype(np.uint16) for j in range(NUM_CHUNKS)]
+
+
+@functools.lru_cache(maxsize=None)
+def _flip_masks(radius: int) -> np.ndarray:
+    values = np.arange(1 << CHUNK_BITS, dtype=np.uint16)
+    return values[np.bitwise_count(values) <= radius]
+
+
+def _chunk_neighbours(value: int, radius: int) -> np.ndarray:
+    """Every 16-bit value within `radius` bits of `value`."""
+    return _flip_masks(radius) ^ np.uint16(value)
+
+
+# --- (2) Multi-Index Hamming Search ---
+
+class PerceptualHashIndex:
+    """
+    Near-duplicate lookup over 64-bit perceptual hashes.
+
+    Each hash is split into four 16-bit chunks, and each chunk is kept as a sorted array
+    (multi-index hashing). If two hashes differ in at most r bits, at least one chunk
+    differs in at most r // 4 bits, so a search only checks the entries whose chunk
+    matches one of the few values within that radius, then verifies the full distance.
+    The hashes are persisted in SQLite and loaded into memory on start.
+    """
+
+    def __init__(self, path: str = PHASH_INDEX_PATH, algorithm: str = PHASH_ALGORITHM):
+        if algorithm not in HASH_FUNCTIONS:
+            raise ValueError(f"Unknown perceptual hash '{algorithm}'. Use one of {', '.join(HASH_FUNCTIONS)}.")
+        self.path = path
+        self.algorithm = algorithm
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS hashes (id TEXT PRIMARY KEY, hash INTEGER NOT NULL)")
+        stored = self._db.execute("SELECT value FROM settings WHERE key = 'algorithm'").fetchone()
+        if stored is None:
+            self._db.execute("INSERT INTO settings VALUES ('algorithm', ?)", (algorithm,))
+        elif stored[0] != algorithm:
+            raise ValueError(f"{path} holds {stored[0]} hashes; rebuild it to switch to {algorithm}.")
+        self._db.commit()
+
+        self.ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._alive = np.zeros(0, dtype=bool)
+        self._sorted_chunks: List[np.ndarray] = []
+        self._sorted_positions: List[np.ndarray] = []
+        self._indexed = 0  # positions below this are in the sorted chunk arrays
+
+        rows = self._db.execute("SELECT id, hash FROM hashes").fetchall()
+        self._append([row[0] for row in rows], [row[1] & 0xFFFFFFFFFFFFFFFF for row in rows])
+        self._rebuild()
+
+    def __len__(self) -> int:
+        return int(self._alive.sum())
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self._positions
+
+    def _append(self, ids: Sequence[str], hashes: Sequence[int]):
+        start = len(self.ids)
+        self.ids.extend(ids)
+        self._hashes = np.concatenate([self._hashes, np.array(hashes, dtype=np.uint64)])
+        self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+        # A re-added id keeps only its newest position alive
+        for position, item_id in enumerate(ids, start=start):
+            previous = self._positions.get(item_id)
+            if previous is not None:
+                self._alive[previous] = False
+            self._positions[item_id] = position
+
+    def _rebuild(self):
+        """Re-sorts every chunk array so all positions are covered by the multi-index."""
+        self._sorted_chunks, self._sorted_positions = [], []
+        for chunk in _chunks(self._hashes):
+            order = np.argsort(chunk, kind="stable")
+            self._sorted_chunks.append(chunk[order])
+            self._sorted_positions.append(order.astype(np.int64))
+        self._indexed = len(self._hashes)
+
+    def add(self, ids: Sequence[str], hashes: Sequence[int]):
+        """Indexes (or replaces) the hashes of the given ids."""
+        if not ids:
+            return
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO hashes (id, hash) VALUES (?, ?)",
+                [(item_id, _to_signed(int(h))) for item_id, h in zip(ids, hashes)],
+            )
+            self._db.commit()
+            self._append(list(ids), list(hashes))
+            if len(self._hashes) - self._indexed >= max(MIN_PENDING_BEFORE_REBUILD, self._indexed // 16):
+                self._rebuild()
+
+    def remove(self, ids: Iterable[str]):
+        with self._lock:
+            ids = list(ids)
+            self._db.executemany("DELETE FROM hashes WHERE id = ?", [(item_id,) for item_id in ids])
+            self._db.commit()
+            for item_id in ids:
+                position = self._positions.pop(item_id, None)
+                if position is not None:
+                    self._alive[position] = False
+
+    def search(self, query_hash: int, max_distance: int = PHASH_MAX_DISTANCE,
+               limit: Optional[int] = None) -> List[Tuple[str, int]]:
+        """Returns (id, Hamming distance) pairs within `max_distance` bits, closest first."""
+        with self._lock:
+            query = np.array([query_hash], dtype=np.uint64)
+            radius = max_distance // NUM_CHUNKS
+            candidates = []
+            for j, value in enumerate(_chunks(query)):
+                probes = _chunk_neighbours(int(value[0]), radius)
+                sorted_chunk = self._sorted_chunks[j]
+                lo = np.searchsorted(sorted_chunk, probes, side="left")
+                counts = np.searchsorted(sorted_chunk, probes, side="right") - lo
+                total = int(counts.sum())
+                if total:
+                    # Concatenated [lo, hi) ranges without a Python loop
+                    starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                    candidates.append(self._sorted_positions[j][starts + np.arange(total)])
+            # Hashes added since the last rebuild are checked directly
+            candidates.append(np.arange(self._indexed, len(self._hashes), dtype=np.int64))
+
+            positions = np.unique(np.concatenate(candidates))
+            positions = positions[self._alive[positions]]
+            distances = np.bitwise_count(self._hashes[positions] ^ query[0]).astype(np.int64)
+            keep = distances <= max_distance
+            positions, distances = positions[keep], distances[keep]
+            order = np.argsort(distances, kind="stable")[:limit]
+            return [(self.ids[positions[i]], int(distances[i])) for i in order]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def load_phash_index(path: str = PHASH_INDEX_PATH, algorithm: str = PHASH_ALGORITHM) -> PerceptualHashIndex:
+    print(f"--- Initializing perceptual hash index at {path} ---")
+    index = PerceptualHashIndex(path, algorithm)
+    print(f"Loaded perceptual hash index ({algorithm}). Count: {len(index)}")
+    return index
+
+
+# --- (3) Backfill ---
+
+def backfill(collection, index: PerceptualHashIndex, assets_folder: str, batch_size: int = 1000) -> int:
+    """
+    Hashes the stored original of every id in the collection that the index lacks.
+    Ids are filenames in the assets folder; ids without a file are skipped.
+    """
+    total, added, offset = collection.count(), 0, 0
+    while offset < total:
+        batch_ids = collection.get(limit=batch_size, offset=offset, include=[])["ids"]
+        offset += batch_size
+        missing = [item_id for item_id in batch_ids if item_id not in index]
+        ids, hashes = [], []
+        for item_id in missing:
+            path = os.path.join(assets_folder, item_id)
+            try:
+                hashes.append(perceptual_hash_encoded(path, index.algorithm))
+                ids.append(item_id)
+            except Exception as e:
+                print(f"  SKIPPED: {item_id}: {e}")
+        index.add(ids, hashes)
+        added += len(ids)
+        print(f"Checked {min(offset, total)}/{total} ids, hashed {added}")
+    return added
+
+
+if __name__ == "__main__":
+    from model_tools import load_vector_db
+
+    parser = argparse.ArgumentParser(description="Hash every indexed asset that the perceptual hash index is missing.")
+    parser.add_argument("--folder", default=os.path.join(BASE_DIR, "story_protocol_assets"))
+    parser.add_argument("--path", default=PHASH_INDEX_PATH)
+    parser.add_argument("--algorithm", default=PHASH_ALGORITHM, choices=sorted(HASH_FUNCTIONS))
+    args = parser.parse_args()
+
+    phash_index = PerceptualHashIndex(args.path, args.algorithm)
+    backfill(load_vector_db(use_ann=False), phash_index, args.folder)
+    print(f"Perceptual hash index now holds {len(phash_index)} hashes.")
@@ -0,0 +1,195 @@
+import argparse
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import torch
+
+from bulk_indexer import ASSETS_FOLDER, DECODE_WORKERS, INFERENCE_BATCH_SIZE, WRITE_BATCH_SIZE, IndexingPipeline
+from index_versions import ACTIVE_INDEX_PATH, IndexVersion, activate, previous_version
+from model_tools import (ACTIVE_INDEX, DEFAULT_MODEL_NAME, DEFAULT_PRETRAINED_WEIGHTS, decode_image, load_embedding_model,
+                         load_vector_db, upsert_vectors_to_db)
+
+# --- Configuration ---
+# Rows read per get() while listing a collection
+LIST_BATCH_SIZE = 1000
+# Listing passes run to pick up rows added to the old index while the job was running
+MAX_PASSES = 5
+
+
+def list_rows(collection, with_metadata: bool = True) -> Dict[str, dict]:
+    """Maps every id in the collection to its metadata, reading it in pages."""
+    rows: Dict[str, dict] = {}
+    offset = 0
+    while True:
+        batch = collection.get(limit=LIST_BATCH_SIZE, offset=offset, include=["metadatas"] if with_metadata else [])
+        ids = batch.get("ids", [])
+        if not ids:
+            return rows
+        metadatas = batch.get("metadatas") or [None] * len(ids)
+        for item_id, metadata in zip(ids, metadatas):
+            rows[item_id] = metadata or {}
+        offset += len(ids)
+
+
+def throttled(items: Iterable[Dict[str, Any]], max_per_second: float) -> Iterable[Dict[str, Any]]:
+    """Yields at most `max_per_second` items per second (0 = unthrottled), pacing the whole pipeline."""
+    if max_per_second <= 0:
+        yield from items
+        return
+    interval = 1.0 / max_per_second
+    next_at = time.monotonic()
+    for item in items:
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_at = max(next_at, time.monotonic()) + interval
+        yield item
+
+
+class ReembedPipeline(IndexingPipeline):
+    """
+    The bulk indexing pipeline, re-embedding rows of an existing collection: items carry
+    the old row's metadata (content and perceptual hashes included), which is written
+    unchanged next to the new vector. The target collection doubles as the checkpoint:
+    ids already in it are not embedded again.
+    """
+
+    def _decode_one(self, item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        try:
+            with open(item["path"], "rb") as f:
+                image = decode_image(f.read())
+            tensor = self.loaded_assets["preprocess"](image)
+        except Exception as e:
+            self.stats["decode"].fail()
+            print(f"  FAILURE: {item['id']} could not be decoded: {e}")
+            return None
+        self.stats["decode"].record(1, time.perf_counter() - started)
+        return {"id": item["id"], "metadata": item["metadata"], "tensor": tensor}
+
+    def _flush(self, items: List[Dict[str, Any]], checkpoint):
+        started = time.perf_counter()
+        upsert_vectors_to_db(
+            self.collection,
+            vectors=[item["vector"] for item in items],
+            file_names=[item["id"] for item in items],
+            metadatas=[item["metadata"] for item in items],
+        )
+        self.stats["write"].record(len(items), time.perf_counter() - started)
+
+    @property
+    def interrupted(self) -> bool:
+        return self._stop.is_set()
+
+
+def reembed(assets: Dict[str, Any], source, target, folder: str, max_per_second: float, mirror_deletes: bool,
+            max_passes: int = MAX_PASSES, **pipeline_options) -> Optional[List[str]]:
+    """
+    Re-embeds every row of `source` that `target` does not hold yet, from the original
+    files in `folder`, repeating until a listing pass finds nothing new (rows added to the
+    source while the job runs are picked up by the next pass). With `mirror_deletes`, rows
+    deleted from the source meanwhile are removed from the target as well.
+
+    Returns the source ids still missing from the target (empty when complete), or None
+    when the run was interrupted.
+    """
+    unreadable = set()
+    for number in range(1, max_passes + 1):
+        source_rows = list_rows(source)
+        target_ids = set(list_rows(target, with_metadata=False))
+        if mirror_deletes:
+            stale = sorted(target_ids - set(source_rows))
+            if stale:
+                target.delete(ids=stale)
+                print(f"Removed {len(stale)} rows that were deleted from the source.")
+
+        items = []
+        for item_id, metadata in source_rows.items():
+            if item_id in target_ids or item_id in unreadable:
+                continue
+            path = os.path.join(folder, item_id)
+            if not os.path.isfile(path):
+                print(f"  MISSING: no original file for {item_id} in {folder}")
+                unreadable.add(item_id)
+                continue
+            items.append({"id": item_id, "path": path, "metadata": metadata})
+        print(f"--- Pass {number}: {len(source_rows)} source rows, {len(target_ids)} already re-embedded, "
+              f"{len(items)} to embed ---")
+        if not items:
+            break
+
+        pipeline = ReembedPipeline(assets, target, checkpoint_file=None, **pipeline_options)
+        pipeline.run(throttled(items, max_per_second))
+        if pipeline.interrupted:
+            return None
+
+    return sorted(set(list_rows(source, with_metadata=False)) - set(list_rows(target, with_metadata=False)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the index for another model next to the active one, from the original images, "
+                    "and switch to it once it is complete.")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="OpenCLIP model (default: IPLENS_MODEL_NAME).")
+    parser.add_argument("--weights", default=DEFAULT_PRETRAINED_WEIGHTS or "none",
+                        help="Pretrained weights (default: IPLENS_PRETRAINED_WEIGHTS; 'none' = random).")
+    parser.add_argument("--folder", default=ASSETS_FOLDER, help="Folder holding the original images (ids are filenames).")
+    parser.add_argument("--max-rate", type=float, default=0.0, help="Images per second at most (0 = as fast as possible).")
+    parser.add_argument("--threads", type=int, default=0, help="Torch threads for inference (0 = torch default).")
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=INFERENCE_BATCH_SIZE, help="Images per forward pass.")
+    parser.add_argument("--write-batch-size", type=int, default=WRITE_BATCH_SIZE, help="Vectors per upsert.")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="Switch even if some rows have no readable original (they are left out of the new index).")
+    parser.add_argument("--no-activate", action="store_true", help="Build or update the new index without switching to it.")
+    parser.add_argument("--rollback", action="store_true", help="Point the API back at the previous index and exit.")
+    args = parser.parse_args()
+
+    if args.rollback:
+        previous = previous_version()
+        if previous is None:
+            raise SystemExit(f"{ACTIVE_INDEX_PATH} records no previous index to roll back to.")
+        activate(previous, previous=ACTIVE_INDEX)
+        print(f"Active index is {previous.collection} ({previous.model_id}) again. Restart the API workers.")
+        raise SystemExit(0)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    weights = None if args.weights.lower() == "none" else args.weights
+    assets = load_embedding_model(args.model, weights, with_text=False)
+    target_version = IndexVersion.for_model(args.model, weights, dim=assets["dim"])
+
+    if target_version.collection == ACTIVE_INDEX.collection:
+        # Already switched: copy over what reached the old index before the API restarted
+        source_version = previous_version()
+        if source_version is None:
+            raise SystemExit(f"{target_version.model_id} is already the active model; there is nothing to re-embed.")
+        print(f"--- {target_version.model_id} is active; catching up with {source_version.collection} ---")
+    else:
+        source_version = ACTIVE_INDEX
+        print(f"--- Re-embedding {source_version.collection} ({source_version.model_id}) into "
+              f"{target_version.collection} ({target_version.model_id}, {target_version.dim}-d) ---")
+
+    source_collection = load_vector_db(use_ann=False, version=source_version)
+    target_collection = load_vector_db(use_ann=False, version=target_version)
+    missing = reembed(
+        assets, source_collection, target_collection, args.folder, args.max_rate,
+        # Once the new index is live the API writes to it directly, so nothing may be removed from it
+        mirror_deletes=source_version is ACTIVE_INDEX,
+        decode_workers=args.decode_workers, batch_size=args.batch_size, write_batch_size=args.write_batch_size,
+    )
+    if missing is None:
+        raise SystemExit("Interrupted. Run the same command again to resume; finished rows are kept.")
+    print(f"{target_collection.count()} vectors in {target_version.collection}; "
+          f"{len(missing)} source rows are not re-embedded.")
+
+    if source_version is not ACTIVE_INDEX or args.no_activate:
+        raise SystemExit(0)
+    if missing and not args.allow_missing:
+        raise SystemExit("Not switching: some rows could not be re-embedded (see MISSING/FAILURE above). "
+                         "Restore their files and re-run, or pass --allow-missing.")
+    activate(target_version, previous=source_version)
+    print(f"Active index is now {target_version.collection} ({target_version.model_id}). Restart the API workers to "
+          f"serve it; python ann_index.py train builds its IVF-PQ index. {source_version.collection} is kept for "
+          f"--rollback until you delete it.")
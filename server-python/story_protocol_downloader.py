@@ -1,7 +1,16 @@
 import requests
+import argparse
 import os
 import hashlib
-from typing import List, Dict, Any
+import json
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from typing import List, Dict, Any, Iterator, Optional
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -11,36 +20,111 @@ STORY_API_KEY = os.getenv("VITE_STORY_PRODUCTION_API_KEY")
 
 # The folder where downloaded images will be saved
 ASSETS_FOLDER = "./story_protocol_assets"
-# The API endpoint for listing IP assets
-ASSETS_API_URL = "https://api.storyapis.com/api/v4/assets"
-# The maximum number of assets to download for the demo
-MAX_ASSETS_LIMIT = 200
+# ETag/size record of every downloaded file, used for incremental syncs
+MANIFEST_FILE = "./story_protocol_manifest.json"
+# The API endpoint for listing IP assets (overridable to point at a local stub server)
+ASSETS_API_URL = os.getenv("STORY_ASSETS_API_URL", "https://api.storyapis.com/api/v4/assets")
+# The maximum number of assets to download (0 = everything the registry returns)
+MAX_ASSETS_LIMIT = int(os.getenv("STORY_MAX_ASSETS", "200"))
+# Assets requested per page of the registry listing
+PAGE_SIZE = 100
+# Parallel downloads overall, and at most this many against any single host
+DOWNLOAD_WORKERS = 16
+PER_HOST_CONNECTIONS = 4
+# Size of the chunks streamed from the response to disk
+CHUNK_SIZE = 64 * 1024
 
 
-def fetch_ip_metadata() -> List[Dict[str, Any]]:
+def create_session(pool_size: int = DOWNLOAD_WORKERS) -> requests.Session:
     """
-    STEP 1: Queries the Story Protocol registry to get IP Asset metadata.
-    This function uses the provided API endpoint to fetch the latest assets.
+    Creates a session whose connection pool is large enough for every download worker,
+    with retries on transient server errors.
     """
-    print("STEP 1: Querying Story Protocol Registry...")
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET", "HEAD", "POST"))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _to_metadata(asset: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Transforms one raw API asset into the minimum required structure."""
+    # We look for the media URL nested within nftMetadata -> image -> originalUrl
+    image_metadata = (asset.get('nftMetadata') or {}).get('image') or {}
+    media_url = image_metadata.get('originalUrl')
+
+    # The API response doesn't directly provide a mediaHash.
+    if not (media_url and asset.get('ipId')):
+        return None
+
+    # Simple file name creation from IP ID and base filename
+    base_name = os.path.basename(media_url).split('?')[0].split('/')[-1] or 'image'
+
+    return {
+        "ipId": asset['ipId'],
+        "mediaUrl": media_url,
+        "mediaHash": "DEMO_HASH_IGNORED_FOR_PUBLIC_ASSETS", # Placeholder for the demo
+        "filename": f"{asset['ipId']}_{base_name}"
+    }
+
 
+def iter_ip_metadata(max_assets: int = MAX_ASSETS_LIMIT, page_size: int = PAGE_SIZE,
+                     session: Optional[requests.Session] = None, api_url: str = None) -> Iterator[Dict[str, Any]]:
+    """
+    STEP 1: Pages through the Story Protocol registry and yields IP Asset metadata
+    as each page arrives, until the registry is exhausted or `max_assets` is reached.
+    """
+    session = session or create_session()
+    api_url = api_url or ASSETS_API_URL
     headers = {
         'Content-Type': 'application/json',
         'X-Api-Key': STORY_API_KEY
     }
 
-    # Payload to fetch the latest 200 assets, removing the owner filter
-    payload = {
-        "includeLicenses": False,
-        "moderated": False,
-        "orderBy": "blockNumber",
-        "orderDirection": "desc",
-        "pagination": {
-            "limit": MAX_ASSETS_LIMIT,
-            "offset": 0
-        },
-        # 'where' filter is omitted entirely to get assets from all owners
-    }
+    offset = 0
+    yielded = 0
+    while True:
+        limit = page_size if not max_assets else min(page_size, max_assets - offset)
+        if limit <= 0:
+            return
+
+        # Payload to fetch the latest assets, removing the owner filter
+        payload = {
+            "includeLicenses": False,
+            "moderated": False,
+            "orderBy": "blockNumber",
+            "orderDirection": "desc",
+            "pagination": {
+                "limit": limit,
+                "offset": offset
+            },
+            # 'where' filter is omitted entirely to get assets from all owners
+        }
+
+        response = session.post(api_url, headers=headers, json=payload, timeout=20)
+        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+        raw_assets = response.json().get('data', [])
+
+        for asset in raw_assets:
+            item = _to_metadata(asset)
+            if item is not None:
+                yielded += 1
+                yield item
+
+        offset += len(raw_assets)
+        print(f"INFO: Registry page done, {offset} assets listed ({yielded} with images).")
+        if len(raw_assets) < limit:
+            return
+
+
+def fetch_ip_metadata(max_assets: int = MAX_ASSETS_LIMIT) -> List[Dict[str, Any]]:
+    """
+    STEP 1: Queries the Story Protocol registry to get IP Asset metadata.
+    This function uses the provided API endpoint to fetch the latest assets.
+    """
+    print("STEP 1: Querying Story Protocol Registry...")
 
     try:
         # Check if the API key is set before proceeding
@@ -48,36 +132,11 @@ def fetch_ip_metadata() -> List[Dict[str, Any]]:
             print("ERROR: API Key is a placeholder. Please update STORY_API_KEY with a valid key.")
             return []
 
-        response = requests.post(ASSETS_API_URL, headers=headers, json=payload, timeout=20)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        data = response.json()
-        raw_assets = data.get('data', [])
-
-        if not raw_assets:
+        metadata_list = list(iter_ip_metadata(max_assets=max_assets))
+        if not metadata_list:
             print("INFO: API returned an empty list of assets.")
             return []
 
-        # Transform raw API data into the minimum required structure
-        metadata_list = []
-        for asset in raw_assets:
-            # We look for the media URL nested within nftMetadata -> image -> originalUrl
-            image_metadata = asset.get('nftMetadata', {}).get('image', {})
-            media_url = image_metadata.get('originalUrl')
-            
-            # The API response doesn't directly provide a mediaHash.
-            if media_url and asset.get('ipId'):
-                
-                # Simple file name creation from IP ID and base filename
-                base_name = os.path.basename(media_url).split('?')[0].split('/')[-1] or 'image'
-                
-                metadata_list.append({
-                    "ipId": asset['ipId'],
-                    "mediaUrl": media_url,
-                    "mediaHash": "DEMO_HASH_IGNORED_FOR_PUBLIC_ASSETS", # Placeholder for the demo
-                    "filename": f"{asset['ipId']}_{base_name}"
-                })
-        
         print(f"INFO: Successfully retrieved {len(metadata_list)} image metadata records.")
         return metadata_list
 
@@ -89,80 +148,267 @@ def fetch_ip_metadata() -> List[Dict[str, Any]]:
         print(f"Response: {e.response.text}")
     except Exception as e:
         print(f"UNEXPECTED ERROR during API call: {e}")
-        
+
     return []
 
 
-def verify_hash(data: bytes, expected_hash: str) -> bool:
+def verify_hash(digest: str, expected_hash: str) -> bool:
     """
     Simulates hash verification, always succeeding in this demo mode.
+    `digest` is the SHA-256 of the downloaded bytes, computed while streaming.
+    """
+    return True
+
+
+# --- Download Manifest ---
+
+class DownloadManifest:
     """
-    return True 
-
-def download_and_save_assets(metadata_list: List[Dict[str, Any]]):
-    """
-    STEP 2 & 3: Downloads images from the mediaUrl and saves them locally.
-    """
-    os.makedirs(ASSETS_FOLDER, exist_ok=True)
-    print(f"\nSTEP 2 & 3: Starting asset download and verification into {ASSETS_FOLDER}...")
-
-    success_count = 0
-    
-    for item in metadata_list:
-        ip_id = item['ipId']
-        media_url = item['mediaUrl']
-        media_hash = item['mediaHash']
-        local_filename = item['filename']
-        file_path = os.path.join(ASSETS_FOLDER, local_filename)
-        
-        # Clean up URL for reliable download (e.g., removing spaces if they exist)
-        clean_url = media_url.strip().replace(' ', '%20')
-
-        try:
-            # Download the image (STEP 2: Download)
-            response = requests.get(clean_url, timeout=15, stream=True)
-            response.raise_for_status() 
-            
-            # Read the content
-            image_data = response.content
-            
-            # Verify the image integrity (STEP 3: Verification)
-            if not verify_hash(image_data, media_hash):
-                # This path is skipped in demo mode, but here for completeness
-                print(f"  FAILURE: {local_filename} (IP ID: {ip_id}) - Hash verification failed! Skipping.")
-                continue
-
-            # Save the file locally
-            with open(file_path, 'wb') as f:
-                f.write(image_data)
-            
-            success_count += 1
-            print(f"  SUCCESS: {local_filename} (IP ID: {ip_id}) - Downloaded and verified.")
-
-        except requests.exceptions.HTTPError as e:
-            print(f"  FAILURE: {local_filename} - HTTP Error during download: {e}. URL: {clean_url}")
-        except requests.exceptions.RequestException as e:
-            print(f"  FAILURE: {local_filename} - General request error: {e}. URL: {clean_url}")
-        except Exception as e:
-            print(f"  FAILURE: {local_filename} - An unexpected error occurred: {e}")
-
-    print(f"\nAsset Retrieval Complete. Successfully downloaded and verified {success_count} files.")
+    Thread-safe record of url, ETag, size and SHA-256 for every saved file, persisted as JSON.
+    """
+
+    def __init__(self, path: str = MANIFEST_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def get(self, filename: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self.entries.get(filename)
+
+    def set(self, filename: str, entry: Dict[str, Any]):
+        with self._lock:
+            self.entries[filename] = entry
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self.entries, indent=2, sort_keys=True)
+        # Write to a temporary file and rename, so an interrupted sync never corrupts it
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+# --- Concurrent Downloader ---
+
+class HostLimiter:
+    """Caps the number of simultaneous connections per host."""
+
+    def __init__(self, per_host: int = PER_HOST_CONNECTIONS):
+        self._lock = threading.Lock()
+        self._semaphores = defaultdict(lambda: threading.BoundedSemaphore(per_host))
+
+    def for_url(self, url: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._semaphores[urlparse(url).netloc]
+
+
+def _is_current(item: Dict[str, Any], file_path: str, manifest: DownloadManifest) -> bool:
+    """A file is up to date when it exists and matches the size recorded for the same URL."""
+    if not os.path.exists(file_path):
+        return False
+    entry = manifest.get(item['filename'])
+    if entry is None:
+        # Present from an older, manifest-less run
+        return True
+    return entry.get('url') == item['mediaUrl'] and entry.get('size') == os.path.getsize(file_path)
+
+
+def download_asset(session: requests.Session, item: Dict[str, Any], manifest: DownloadManifest,
+                   limiter: HostLimiter, assets_folder: str = ASSETS_FOLDER, revalidate: bool = False) -> str:
+    """
+    STEP 2 & 3: Streams one asset to disk in chunks and verifies it.
+    Returns "downloaded", "skipped" or "not-modified".
+    """
+    file_path = os.path.join(assets_folder, item['filename'])
+
+    # Skip files already present, unless asked to revalidate them against the server
+    if not revalidate and _is_current(item, file_path, manifest):
+        return "skipped"
+
+    # Clean up URL for reliable download (e.g., removing spaces if they exist)
+    clean_url = item['mediaUrl'].strip().replace(' ', '%20')
+
+    # Only a file that still matches its manifest record may be kept on a 304
+    headers = {}
+    entry = manifest.get(item['filename'])
+    if entry and entry.get('etag') and _is_current(item, file_path, manifest):
+        headers['If-None-Match'] = entry['etag']
+
+    with limiter.for_url(clean_url):
+        # Download the image (STEP 2: Download)
+        with session.get(clean_url, headers=headers, timeout=15, stream=True) as response:
+            if response.status_code == 304:
+                return "not-modified"
+            response.raise_for_status()
+
+            # Stream into a temporary file next to the target, then rename it into place
+            digest = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=assets_folder, suffix=".part")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+
+                # Verify the image integrity (STEP 3: Verification)
+                if not verify_hash(digest.hexdigest(), item['mediaHash']):
+                    raise ValueError("Hash verification failed")
+
+                os.replace(tmp_path, file_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            manifest.set(item['filename'], {
+                "ipId": item['ipId'],
+                "url": item['mediaUrl'],
+                "etag": response.headers.get('ETag'),
+                "lastModified": response.headers.get('Last-Modified'),
+                "size": size,
+                "sha256": digest.hexdigest(),
+            })
+    return "downloaded"
+
+
+def download_and_save_assets(metadata_list: List[Dict[str, Any]], workers: int = DOWNLOAD_WORKERS,
+                             per_host: int = PER_HOST_CONNECTIONS, revalidate: bool = False,
+                             assets_folder: str = ASSETS_FOLDER, manifest_file: str = MANIFEST_FILE):
+    """
+    STEP 2 & 3: Downloads images from the mediaUrl and saves them locally,
+    several at a time over a pooled session.
+    """
+    os.makedirs(assets_folder, exist_ok=True)
+    print(f"\nSTEP 2 & 3: Starting asset download and verification into {assets_folder}...")
+
+    session = create_session(pool_size=workers)
+    manifest = DownloadManifest(manifest_file)
+    limiter = HostLimiter(per_host)
+    counts = {"downloaded": 0, "skipped": 0, "not-modified": 0, "failed": 0}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(download_asset, session, item, manifest, limiter, assets_folder, revalidate): item
+            for item in metadata_list
+        }
+        for future in as_completed(futures):
+            item = futures[future]
+            local_filename = item['filename']
+            try:
+                outcome = future.result()
+                counts[outcome] += 1
+                if outcome == "downloaded":
+                    print(f"  SUCCESS: {local_filename} (IP ID: {item['ipId']}) - Downloaded and verified.")
+            except requests.exceptions.HTTPError as e:
+                counts["failed"] += 1
+                print(f"  FAILURE: {local_filename} - HTTP Error during download: {e}. URL: {item['mediaUrl']}")
+            except requests.exceptions.RequestException as e:
+                counts["failed"] += 1
+                print(f"  FAILURE: {local_filename} - General request error: {e}. URL: {item['mediaUrl']}")
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"  FAILURE: {local_filename} - An unexpected error occurred: {e}")
+
+    manifest.save()
+    print(f"\nAsset Retrieval Complete. Downloaded {counts['downloaded']}, already present {counts['skipped']}, "
+          f"unchanged {counts['not-modified']}, failed {counts['failed']}.")
+    return counts
+
+
+def iter_downloaded_assets(metadata_iter: Iterator[Dict[str, Any]], workers: int = DOWNLOAD_WORKERS,
+                           per_host: int = PER_HOST_CONNECTIONS, max_in_flight: int = None,
+                           assets_folder: str = ASSETS_FOLDER, manifest_file: str = MANIFEST_FILE,
+                           skip_ids: Optional[set] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Downloads assets concurrently while `metadata_iter` is still being paged, and yields
+    each one as soon as it is on disk, as a source item for bulk_indexer.IndexingPipeline.
+    At most `max_in_flight` downloads are outstanding, so memory stays flat for any catalogue size.
+    """
+    os.makedirs(assets_folder, exist_ok=True)
+    max_in_flight = max_in_flight or workers * 2
+    skip_ids = skip_ids or set()
+    session = create_session(pool_size=workers)
+    manifest = DownloadManifest(manifest_file)
+    limiter = HostLimiter(per_host)
+
+    def to_source_item(item: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "id": item['filename'],
+            "path": os.path.join(assets_folder, item['filename']),
+            "metadata": {"filename": item['filename'], "ipId": item['ipId'], "source_url": item['mediaUrl']},
+        }
+
+    in_flight = {}
+    completed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            def drain(block_until_room: bool):
+                nonlocal completed
+                if not in_flight:
+                    return
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED) if block_until_room else (
+                    [f for f in in_flight if f.done()], None)
+                for future in done:
+                    item = in_flight.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"  FAILURE: {item['filename']} - download failed: {e}. URL: {item['mediaUrl']}")
+                        continue
+                    completed += 1
+                    # Persist the manifest now and then so an interrupted sync keeps its progress
+                    if completed % 100 == 0:
+                        manifest.save()
+                    yield to_source_item(item)
+
+            for item in metadata_iter:
+                if item['filename'] in skip_ids:
+                    continue
+                while len(in_flight) >= max_in_flight:
+                    yield from drain(block_until_room=True)
+                future = pool.submit(download_asset, session, item, manifest, limiter, assets_folder)
+                in_flight[future] = item
+                yield from drain(block_until_room=False)
+
+            while in_flight:
+                yield from drain(block_until_room=True)
+    finally:
+        manifest.save()
 
 
 if __name__ == "__main__":
-    if STORY_API_KEY == "YOUR_API_KEY_HERE":
-    
+    parser = argparse.ArgumentParser(description="Download Story Protocol IP asset images.")
+    parser.add_argument("--max-assets", type=int, default=MAX_ASSETS_LIMIT, help="0 downloads everything.")
+    parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument("--per-host", type=int, default=PER_HOST_CONNECTIONS)
+    parser.add_argument("--revalidate", action="store_true",
+                        help="Re-check present files with conditional requests (ETag) instead of skipping them.")
+    args = parser.parse_args()
+
+    if not STORY_API_KEY or STORY_API_KEY == "YOUR_API_KEY_HERE":
+        print("ERROR: VITE_STORY_PRODUCTION_API_KEY is not set. Add it to your .env file.")
+        raise SystemExit(1)
+
     # 1. Query for asset metadata
-    metadata = fetch_ip_metadata()
-    
+    metadata = fetch_ip_metadata(max_assets=args.max_assets)
+
     if metadata:
         # 2. Download, verify, and save the assets
-        download_and_save_assets(metadata)
-        
+        download_and_save_assets(metadata, workers=args.workers, per_host=args.per_host, revalidate=args.revalidate)
+
         # 3. Final instruction for the user
         print("\n========================================================")
         print("NEXT STEP: Run 'python ingestion_script.py'")
         print("The assets are now saved locally and ready for vector indexing.")
         print("========================================================")
     else:
-        print("\nNo IP Asset metadata retrieved. Cannot proceed with download.")
\ No newline at end of file
+        print("\nNo IP Asset metadata retrieved. Cannot proceed with download.")
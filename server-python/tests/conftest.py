@@ -0,0 +1,55 @@
+import io
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# The tests import the server modules from the parent folder, like the benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Everything the server writes goes to a scratch folder, and the model has random weights
+# (no download); set before any server module reads its configuration
+SCRATCH_DIR = tempfile.mkdtemp(prefix="iplens-tests-")
+os.environ.update({
+    "IPLENS_PRETRAINED_WEIGHTS": "none",
+    "IPLENS_TEXT_SEARCH": "0",
+    "IPLENS_WARMUP": "0",
+    "IPLENS_BACKGROUND_STARTUP": "0",
+    "IPLENS_CACHE_DIR": "",
+    "IPLENS_VECTOR_STORE": "mmap",
+    "IPLENS_VECTOR_INDEX_PATH": os.path.join(SCRATCH_DIR, "vector_index"),
+    "IPLENS_ACTIVE_INDEX_PATH": os.path.join(SCRATCH_DIR, "active_index.json"),
+    "IPLENS_PHASH_INDEX_PATH": os.path.join(SCRATCH_DIR, "phash_index.sqlite3"),
+    "IPLENS_ANN_INDEX_PATH": os.path.join(SCRATCH_DIR, "ann_index.npz"),
+    "IPLENS_ASSETS_DIR": os.path.join(SCRATCH_DIR, "assets"),
+    "IPLENS_UPLOAD_SPOOL_DIR": os.path.join(SCRATCH_DIR, ".upload_spool"),
+    "IPLENS_SNAPSHOT_DIR": os.path.join(SCRATCH_DIR, "model_snapshots"),
+    "IPLENS_ONNX_CACHE_DIR": os.path.join(SCRATCH_DIR, "onnx_models"),
+    "IPLENS_PROFILE_DIR": os.path.join(SCRATCH_DIR, "profiles"),
+})
+
+
+def _image_bytes(seed: int, size=(64, 48), fmt: str = "JPEG") -> bytes:
+    pixels = (np.random.RandomState(seed).rand(size[1], size[0], 3) * 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def image_bytes():
+    """Builds encoded noise images: image_bytes(seed, size=(w, h), fmt="JPEG"), different for every seed."""
+    return _image_bytes
+
+
+@pytest.fixture(scope="session")
+def api():
+    """The app started once for the session (model loaded in the foreground), with a TestClient."""
+    from fastapi.testclient import TestClient
+    import app
+
+    with TestClient(app.app) as client:
+        yield client
@@ -0,0 +1,92 @@
+import threading
+
+import numpy as np
+
+from ann_index import AnnCollection, IVFPQIndex, build_index
+from vector_index import MmapVectorIndex
+
+
+def _trained_index(dim: int = 32, count: int = 512) -> IVFPQIndex:
+    rng = np.random.RandomState(0)
+    index = IVFPQIndex(dim, nlist=8, m=8)
+    index.train(rng.rand(count, dim).astype(np.float32), iterations=3)
+    index.add([f"v{i}" for i in range(count)], rng.rand(count, dim).astype(np.float32))
+    return index
+
+
+def test_search_returns_an_added_vector_first():
+    index = _trained_index()
+    vector = np.random.RandomState(1).rand(1, 32).astype(np.float32)
+    index.add(["probe"], vector)
+    assert index.search(vector[0], 5, nprobe=8)[0] == "probe"
+
+
+def test_search_is_safe_while_other_threads_write():
+    index = _trained_index()
+    rng = np.random.RandomState(2)
+    errors, stop = [], threading.Event()
+
+    def write():
+        for round_no in range(200):
+            ids = [f"w{round_no}-{i}" for i in range(16)]
+            index.add(ids, rng.rand(16, 32).astype(np.float32))
+            index.remove(ids[::2])
+        stop.set()
+
+    def search():
+        query = np.random.RandomState(3).rand(32).astype(np.float32)
+        while not stop.is_set():
+            try:
+                results = index.search(query, 10, nprobe=8)
+                assert len(results) == 10
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=search) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def _store(path, count: int, dim: int = 32, seed: int = 0) -> MmapVectorIndex:
+    store = MmapVectorIndex(str(path), name="test")
+    store.add([f"s{i}" for i in range(count)], np.random.RandomState(seed).rand(count, dim).astype(np.float32))
+    return store
+
+
+def test_reconcile_encodes_rows_written_after_the_last_save(tmp_path):
+    store = _store(tmp_path / "store", 300)
+    ann = AnnCollection(store, build_index(store, nlist=8, m=8, sample_size=300))
+    # Rows that reached the store but not the saved index, and an index entry the store lost
+    late = np.random.RandomState(5).rand(20, 32).astype(np.float32)
+    store.add([f"late{i}" for i in range(20)], late)
+    ann.index.add(["ghost"], late[:1])
+
+    assert ann.reconcile() == {"missing": 20, "stale": 1, "retrained": 0}
+    assert len(ann.index) == store.count()
+    assert ann.query(late[3:4], n_results=1, nprobe=8)["ids"][0] == ["late3"]
+    assert ann.reconcile() == {"missing": 0, "stale": 0, "retrained": 0}
+
+
+def test_reconcile_retrains_when_most_rows_are_missing(tmp_path):
+    store = _store(tmp_path / "store", 40)
+    ann = AnnCollection(store, build_index(store, nlist=4, m=8, sample_size=40))
+    store.add([f"new{i}" for i in range(200)], np.random.RandomState(6).rand(200, 32).astype(np.float32))
+
+    assert ann.reconcile()["retrained"] == 1
+    assert len(ann.index) == store.count() == 240
+
+
+def test_writes_save_the_index_once_the_interval_has_passed(tmp_path):
+    store = _store(tmp_path / "store", 100)
+    path = str(tmp_path / "ann.npz")
+    ann = AnnCollection(store, build_index(store, nlist=4, m=8, sample_size=100), index_path=path, save_interval=0)
+    ann.upsert(ids=["fresh"], embeddings=np.random.RandomState(7).rand(1, 32).astype(np.float32))
+    assert "fresh" in IVFPQIndex.load(path).ids
+
+    ann.save_interval = 3600
+    ann.upsert(ids=["later"], embeddings=np.random.RandomState(8).rand(1, 32).astype(np.float32))
+    assert "later" not in IVFPQIndex.load(path).ids
@@ -0,0 +1,193 @@
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import app
+
+
+def _files(*entries):
+    """Multipart files from (filename, bytes) or (filename, bytes, content type) tuples."""
+    return [("files", (entry[0], entry[1], entry[2] if len(entry) > 2 else "image/jpeg")) for entry in entries]
+
+
+def test_add_vectors_keeps_files_inside_the_assets_folder(api, image_bytes):
+    response = api.post("/add-vectors", files=_files(("../../escaped.jpg", image_bytes(401)),
+                                                     ("nested\\dir\\inner.jpg", image_bytes(402))))
+    assert response.status_code == 200
+    assert sorted(response.json()["added"]) == ["escaped.jpg", "inner.jpg"]
+    assert os.path.isfile(os.path.join(app.ASSETS_FOLDER, "escaped.jpg"))
+    assert os.path.isfile(os.path.join(app.ASSETS_FOLDER, "inner.jpg"))
+    assert not os.path.exists(os.path.join(app.ASSETS_FOLDER, "..", "..", "escaped.jpg"))
+
+
+def test_add_vectors_reports_unusable_filenames(api, image_bytes):
+    response = api.post("/add-vectors", files=_files(("..", image_bytes(403)), ("some/dir/.", image_bytes(404))))
+    assert response.status_code == 200
+    body = response.json()
+    assert body["added"] == []
+    assert [error["detail"] for error in body["errors"]] == ["Invalid filename.", "Invalid filename."]
+
+
+def test_add_vector_refuses_an_unusable_filename(api, image_bytes):
+    response = api.post("/add-vector", files={"file": ("..", image_bytes(405), "image/jpeg")})
+    assert response.status_code == 400
+
+
+def test_add_vectors_never_replaces_a_different_file(api, image_bytes):
+    existing = os.path.join(app.ASSETS_FOLDER, "taken.jpg")
+    with open(existing, "wb") as f:
+        f.write(image_bytes(406))
+
+    response = api.post("/add-vectors", files=_files(("taken.jpg", image_bytes(407))))
+    body = response.json()
+    assert body["added"] == []
+    assert body["errors"] == [{"filename": "taken.jpg", "detail": "A different file named taken.jpg already exists."}]
+    with open(existing, "rb") as f:
+        assert f.read() == image_bytes(406)
+
+    single = api.post("/add-vector", files={"file": ("taken.jpg", image_bytes(407), "image/jpeg")})
+    assert single.status_code == 409
+
+
+def test_add_vectors_indexes_an_unindexed_file_with_the_same_bytes(api, image_bytes):
+    existing = os.path.join(app.ASSETS_FOLDER, "on_disk.jpg")
+    with open(existing, "wb") as f:
+        f.write(image_bytes(408))
+
+    response = api.post("/add-vectors", files=_files(("on_disk.jpg", image_bytes(408))))
+    assert response.json()["added"] == ["on_disk.jpg"]
+    with open(existing, "rb") as f:
+        assert f.read() == image_bytes(408)
+
+
+def test_add_vectors_reports_duplicates_and_skips(api, image_bytes):
+    first = api.post("/add-vectors", files=_files(("dup_a.jpg", image_bytes(410)), ("dup_b.jpg", image_bytes(410)),
+                                                  ("dup_a.jpg", image_bytes(411))))
+    body = first.json()
+    assert body["added"] == ["dup_a.jpg"]
+    assert body["duplicates"] == [{"id": "dup_b.jpg", "duplicate_of": "dup_a.jpg"}]
+    assert body["skipped"] == ["dup_a.jpg"]
+    assert not os.path.exists(os.path.join(app.ASSETS_FOLDER, "dup_b.jpg"))
+
+    again = api.post("/add-vectors", files=_files(("dup_a.jpg", image_bytes(410)), ("dup_c.jpg", image_bytes(410)))).json()
+    assert again["added"] == []
+    assert again["skipped"] == ["dup_a.jpg"]
+    assert again["duplicates"] == [{"id": "dup_c.jpg", "duplicate_of": "dup_a.jpg"}]
+
+
+def test_add_vectors_reports_per_file_errors(api, image_bytes):
+    response = api.post("/add-vectors", files=_files(("ok.jpg", image_bytes(412)), ("notes.txt", b"hello", "text/plain"),
+                                                     ("broken.jpg", b"not an image")))
+    assert response.status_code == 200
+    body = response.json()
+    assert body["added"] == ["ok.jpg"]
+    errors = {error["filename"]: error["detail"] for error in body["errors"]}
+    assert errors["notes.txt"] == "Invalid file type."
+    assert errors["broken.jpg"].startswith("Could not decode image")
+    assert not os.path.exists(os.path.join(app.ASSETS_FOLDER, "broken.jpg"))
+
+
+def test_search_vectors_returns_one_ranking_per_query(api, image_bytes):
+    api.post("/add-vectors", files=_files(*[(f"multi_{seed}.jpg", image_bytes(seed)) for seed in range(420, 424)]))
+
+    response = api.post("/search-vectors?n_results=2&fusion=rrf",
+                        files=_files(("q1.jpg", image_bytes(420)), ("q2.jpg", image_bytes(421)), ("bad.jpg", b"nope")))
+    assert response.status_code == 200
+    body = response.json()
+    assert [query["query_filename"] for query in body["queries"]] == ["q1.jpg", "q2.jpg"]
+    assert all(len(query["results"]) == 2 for query in body["queries"])
+    assert body["queries"][0]["results"][0]["id"] == "multi_420.jpg"
+    assert body["queries"][1]["results"][0]["id"] == "multi_421.jpg"
+    assert len(body["fused"]) == 2
+    assert [error["filename"] for error in body["errors"]] == ["bad.jpg"]
+
+
+def test_search_vectors_validates_its_parameters(api, image_bytes):
+    files = _files(("q.jpg", image_bytes(425)))
+    assert api.post("/search-vectors?fusion=vote", files=files).status_code == 400
+    assert api.post("/search-vectors?n_results=0", files=files).status_code == 400
+    too_many = api.post(f"/search-vectors?n_results={app.MAX_SEARCH_WINDOW + 1}", files=files)
+    assert too_many.status_code == 400
+    assert too_many.json()["detail"] == f"Results beyond rank {app.MAX_SEARCH_WINDOW} are not available."
+    assert api.post('/search-vectors?where={"ipId": {"$bogus": 1}}', files=files).status_code == 400
+
+
+def test_search_vector_pages_follow_the_ranking(api, image_bytes):
+    api.post("/add-vectors", files=_files(*[(f"page_{seed}.jpg", image_bytes(seed)) for seed in range(460, 468)]))
+    query = {"file": ("query.jpg", image_bytes(460), "image/jpeg")}
+
+    first = api.post("/search-vector?n_results=3", files=query).json()
+    second = api.post(f"/search-vector?n_results=3&cursor={first['next_cursor']}", files=query).json()
+    ranking = api.post("/search-vector?n_results=6", files=query).json()
+    assert first["results"][0]["id"] == "page_460.jpg"
+    assert [item["id"] for item in first["results"] + second["results"]] == [item["id"] for item in ranking["results"]]
+    assert second["next_cursor"] and second["next_cursor"] != first["next_cursor"]
+
+
+def test_search_vector_rejects_foreign_and_broken_cursors(api, image_bytes):
+    api.post("/add-vectors", files=_files(*[(f"cursor_{seed}.jpg", image_bytes(seed)) for seed in range(470, 474)]))
+    query = {"file": ("query.jpg", image_bytes(470), "image/jpeg")}
+    cursor = api.post("/search-vector?n_results=2", files=query).json()["next_cursor"]
+
+    for broken in ("not-a-cursor", cursor[:-4], app._encode_cursor(2, "x")[:10] + "!!"):
+        response = api.post(f"/search-vector?n_results=2&cursor={broken}", files=query)
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid cursor."
+
+    other_image = {"file": ("other.jpg", image_bytes(471), "image/jpeg")}
+    tampered = app._encode_cursor(2, "0" * 64)
+    for files, params in ((other_image, ""), (query, '&where={"ipId": "0x1"}'), (query, "&min_similarity=0.5")):
+        response = api.post(f"/search-vector?n_results=2&cursor={cursor}{params}", files=files)
+        assert response.status_code == 400
+        assert response.json()["detail"] == "The cursor belongs to a different search."
+    response = api.post(f"/search-vector?n_results=2&cursor={tampered}", files=query)
+    assert response.json()["detail"] == "The cursor belongs to a different search."
+
+    deep = app._encode_cursor(app.MAX_SEARCH_WINDOW, app._query_fingerprint(
+        app.content_hash(image_bytes(470)), None, None))
+    response = api.post(f"/search-vector?n_results=2&cursor={deep}", files=query)
+    assert response.status_code == 400
+    assert response.json()["detail"] == f"Results beyond rank {app.MAX_SEARCH_WINDOW} are not available."
+
+
+def _smooth_image(seed: int, size=(256, 192), quality: int = 95) -> bytes:
+    """A blurry colour field: its perceptual hash survives resizing and re-encoding."""
+    pixels = (np.random.RandomState(seed).rand(6, 8, 3) * 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).resize(size, Image.Resampling.BILINEAR).save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def test_near_duplicates_lead_a_full_page_of_vector_results(api, image_bytes):
+    api.post("/add-vectors", files=_files(("nd_original.jpg", _smooth_image(430)),
+                                          *[(f"nd_other_{seed}.jpg", image_bytes(seed)) for seed in range(431, 437)]))
+    query = {"file": ("query.jpg", _smooth_image(430, size=(200, 150), quality=60), "image/jpeg")}
+
+    page = api.post("/search-vector?n_results=3&near_duplicates=true", files=query).json()
+    assert page["match_type"] == "near-duplicate"
+    assert len(page["results"]) == 3
+    first, *rest = page["results"]
+    assert first["id"] == "nd_original.jpg"
+    assert first["hamming_distance"] is not None
+    assert first["similarity"] == pytest.approx(1 - first["distance"] / 2, abs=1e-5)
+    assert all(item["hamming_distance"] is None for item in rest)
+
+    # The cursor continues with the vector ranking instead of starting it over
+    second = api.post(f"/search-vector?n_results=3&near_duplicates=true&cursor={page['next_cursor']}", files=query).json()
+    assert not {item["id"] for item in page["results"]} & {item["id"] for item in second["results"]}
+
+    # Without the flag it is a plain vector search
+    plain = api.post("/search-vector?n_results=3", files=query).json()
+    assert plain["match_type"] == "vector"
+    assert all(item["hamming_distance"] is None for item in plain["results"])
+
+
+def test_server_timing_includes_the_stages_run_in_worker_threads(api, image_bytes):
+    response = api.post("/generate-vector", files={"file": ("timing.jpg", image_bytes(440), "image/jpeg")})
+    assert response.status_code == 200
+    timing = response.headers["server-timing"]
+    for name in ("upload", "decode", "preprocess", "inference", "embed"):
+        assert f"{name};dur=" in timing
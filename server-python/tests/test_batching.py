@@ -0,0 +1,116 @@
+import asyncio
+import threading
+
+import pytest
+
+from batching import BatcherSaturated, MicroBatcher
+from executor import ExecutorSaturated, InferenceExecutor
+
+
+def test_concurrent_submissions_share_a_batch():
+    calls = []
+
+    def batch_fn(items):
+        calls.append(list(items))
+        return [item * 10 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(batch_fn, max_batch_size=4, max_wait_ms=50)
+        await batcher.start()
+        try:
+            return await asyncio.gather(*[batcher.submit(item) for item in range(6)])
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40, 50]
+    assert [len(call) for call in calls] == [4, 2]
+
+
+def test_a_failing_batch_fails_each_of_its_submissions():
+    def batch_fn(items):
+        raise ValueError("broken model")
+
+    async def main():
+        batcher = MicroBatcher(batch_fn, max_batch_size=2, max_wait_ms=20)
+        await batcher.start()
+        try:
+            return await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    assert [type(result) for result in asyncio.run(main())] == [ValueError, ValueError]
+
+
+def test_stop_fails_the_running_batch_and_the_queue():
+    release = threading.Event()
+
+    def batch_fn(items):
+        release.wait(5)
+        return items
+
+    async def main():
+        batcher = MicroBatcher(batch_fn, max_batch_size=1, max_wait_ms=0)
+        await batcher.start()
+        submissions = [asyncio.ensure_future(batcher.submit(item)) for item in range(3)]
+        while batcher.queue_depth != 2:
+            await asyncio.sleep(0.001)
+        await batcher.stop()
+        release.set()
+        return await asyncio.wait_for(asyncio.gather(*submissions, return_exceptions=True), timeout=5)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) and "stopped" in str(result) for result in results)
+
+
+def test_a_full_queue_refuses_or_waits():
+    started, release = threading.Event(), threading.Event()
+
+    def batch_fn(items):
+        started.set()
+        release.wait(5)
+        return items
+
+    async def main():
+        batcher = MicroBatcher(batch_fn, max_batch_size=1, max_wait_ms=0, max_queue_size=1)
+        await batcher.start()
+        first = asyncio.ensure_future(batcher.submit("running"))
+        while not started.is_set():
+            await asyncio.sleep(0.001)
+        queued = asyncio.ensure_future(batcher.submit("queued"))
+        await asyncio.sleep(0)
+        with pytest.raises(BatcherSaturated):
+            await batcher.submit("refused")
+        waiting = asyncio.ensure_future(batcher.submit("waited", wait_if_full=True))
+        release.set()
+        try:
+            return await asyncio.gather(first, queued, waiting)
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == ["running", "queued", "waited"]
+
+
+def test_admission_rejects_requests_beyond_the_limit():
+    executor = InferenceExecutor(loaded_assets={}, mode="thread", max_pending=2)
+
+    async def main():
+        async with executor.admission(), executor.admission():
+            with pytest.raises(ExecutorSaturated):
+                async with executor.admission():
+                    pass
+        # Slots are given back when requests finish
+        async with executor.admission():
+            return executor.stats()
+
+    stats = asyncio.run(main())
+    assert stats["rejected"] == 1
+    assert stats["pending"] == 1
+
+
+def test_saturated_server_answers_503_with_retry_after(api, image_bytes, monkeypatch):
+    import app
+
+    monkeypatch.setattr(app.EXECUTOR, "_pending", app.EXECUTOR.max_pending)
+    response = api.post("/generate-vector", files={"file": ("busy.jpg", image_bytes(450), "image/jpeg")})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
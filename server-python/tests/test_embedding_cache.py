@@ -0,0 +1,40 @@
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+def _cache(tmp_path, **options) -> EmbeddingCache:
+    options = {"model_name": "ViT-B-16", "weights_name": "openai", "backend": "fp32", "preprocess": "fast", **options}
+    return EmbeddingCache(cache_dir=str(tmp_path), **options)
+
+
+def test_disk_hits_survive_a_new_cache(tmp_path):
+    vector = np.arange(8, dtype=np.float32)
+    _cache(tmp_path).put("abc", vector)
+    cached = _cache(tmp_path).get("abc")
+    assert np.array_equal(cached, vector)
+
+
+def test_backend_and_preprocess_are_part_of_the_key(tmp_path):
+    _cache(tmp_path).put("abc", np.ones(8, dtype=np.float32))
+    assert _cache(tmp_path, backend="int8").get("abc") is None
+    assert _cache(tmp_path, preprocess="openclip").get("abc") is None
+    assert _cache(tmp_path, weights_name=None).get("abc") is None
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = _cache(tmp_path, memory_budget_bytes=0, max_disk_entries=20)
+    for i in range(50):
+        cache.put(f"hash{i}", np.full(8, i, dtype=np.float32))
+    assert cache.stats()["disk_entries"] <= 20
+    assert sum(1 for _ in cache._disk_files()) == cache.stats()["disk_entries"]
+    assert cache.get("hash49") is not None
+
+
+def test_random_weights_are_never_cached_on_disk(tmp_path):
+    cache = _cache(tmp_path, weights_name=None)
+    cache.put("abc", np.ones(8, dtype=np.float32))
+    assert cache.cache_dir is None
+    assert cache.get("abc") is not None
+    assert not any(tmp_path.iterdir())
+    assert _cache(tmp_path, weights_name=None).get("abc") is None
@@ -0,0 +1,50 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_decode import ImageRejected, decode_image
+
+
+def _encoded(size, fmt="JPEG", mode="RGB") -> bytes:
+    pixels = (np.random.RandomState(0).rand(size[1], size[0], 3) * 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).convert(mode).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def test_rejects_images_over_the_byte_limit():
+    data = _encoded((64, 48))
+    with pytest.raises(ImageRejected, match="bytes"):
+        decode_image(data, max_bytes=len(data) - 1)
+    assert decode_image(data, max_bytes=len(data)).size == (64, 48)
+
+
+def test_rejects_images_over_the_pixel_limit_from_the_header():
+    data = _encoded((100, 80), fmt="PNG")
+    with pytest.raises(ImageRejected, match="100x80"):
+        decode_image(data, max_pixels=100 * 80 - 1)
+    assert decode_image(data, max_pixels=100 * 80).size == (100, 80)
+
+
+def test_jpegs_are_decoded_at_the_smallest_scale_covering_the_target():
+    data = _encoded((1600, 1200))
+    # 1/8 scale (200x150) would be smaller than 224, so 1/4 is used
+    assert decode_image(data, target_size=224).size == (400, 300)
+    assert decode_image(data, target_size=100).size == (200, 150)
+    assert decode_image(data, target_size=None).size == (1600, 1200)
+    # Other formats have no reduced-scale decode
+    assert decode_image(_encoded((1600, 1200), fmt="PNG"), target_size=224).size == (1600, 1200)
+
+
+def test_decodes_paths_to_loaded_rgb_images(tmp_path):
+    path = tmp_path / "gray.png"
+    path.write_bytes(_encoded((64, 48), fmt="PNG", mode="L"))
+    for source in (path, str(path)):
+        image = decode_image(source)
+        assert image.mode == "RGB"
+        assert image.size == (64, 48)
+
+    with pytest.raises(ImageRejected):
+        decode_image(path, max_bytes=path.stat().st_size - 1)
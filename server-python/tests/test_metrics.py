@@ -0,0 +1,69 @@
+import asyncio
+import os
+import time
+
+from batching import MicroBatcher
+from executor import InferenceExecutor
+from metrics import _REQUEST_STAGES, SamplingProfiler, stage
+
+
+def _timed(name: str):
+    def work(*args):
+        with stage(name):
+            time.sleep(0.001)
+        return args[0] if args else None
+    return work
+
+
+def test_stages_recorded_in_executor_threads_reach_the_request():
+    executor = InferenceExecutor(loaded_assets={}, mode="thread")
+    executor.start()
+
+    async def request():
+        stages = {}
+        _REQUEST_STAGES.set(stages)
+        await executor.run_blocking(_timed("decode"))
+        await executor.run_inference(_timed("inference"), [1])
+        return stages
+
+    try:
+        stages = asyncio.run(request())
+    finally:
+        executor.shutdown()
+    assert set(stages) == {"decode", "inference"}
+
+
+def test_every_request_in_a_batch_gets_its_stages():
+    def batch_fn(items):
+        with stage("inference"):
+            time.sleep(0.001)
+        return [item * 2 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(batch_fn, max_batch_size=4, max_wait_ms=20)
+        await batcher.start()
+
+        async def request(item):
+            stages = {}
+            _REQUEST_STAGES.set(stages)
+            return await batcher.submit(item), stages
+
+        try:
+            return await asyncio.gather(*[request(item) for item in range(3)])
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(main())
+    assert [result for result, _ in results] == [0, 2, 4]
+    assert all("inference" in stages for _, stages in results)
+
+
+def test_profiler_writes_its_profile_after_the_last_request(tmp_path):
+    profiler = SamplingProfiler(interval=0.001, output_dir=str(tmp_path))
+    profiler.arm(2)
+    time.sleep(0.01)
+    assert profiler.request_finished() is False
+    assert profiler.request_finished() is True
+    profiler.finish()
+    assert os.path.isfile(profiler.last_profile)
+    assert not profiler.armed
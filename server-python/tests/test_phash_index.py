@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import phash_index
+from phash_index import PerceptualHashIndex
+
+
+def _random_hashes(count: int, seed: int = 0) -> list:
+    rng = np.random.RandomState(seed)
+    return [int.from_bytes(rng.bytes(8), "big") for _ in range(count)]
+
+
+def _flip(value: int, bits: list) -> int:
+    for bit in bits:
+        value ^= 1 << int(bit)
+    return value
+
+
+def _brute_force(ids, hashes, query, max_distance):
+    found = [(item_id, bin(h ^ query).count("1")) for item_id, h in zip(ids, hashes)]
+    return sorted(((item_id, bits) for item_id, bits in found if bits <= max_distance), key=lambda pair: (pair[1], pair[0]))
+
+
+def test_multi_index_finds_everything_within_the_radius(tmp_path):
+    hashes = _random_hashes(2000)
+    query = hashes[0]
+    # Neighbours spread over the four 16-bit chunks, up to the full search radius
+    rng = np.random.RandomState(1)
+    neighbours = [_flip(query, list(rng.choice(64, size=distance, replace=False))) for distance in range(9) for _ in range(3)]
+    ids = [f"h{i}" for i in range(len(hashes) + len(neighbours))]
+    all_hashes = hashes + neighbours
+
+    index = PerceptualHashIndex(str(tmp_path / "phash.sqlite3"))
+    index.add(ids, all_hashes)
+    index._rebuild()  # search the sorted chunk arrays, not the linear tail
+
+    for max_distance in (0, 3, 6, 8):
+        expected = _brute_force(ids, all_hashes, query, max_distance)
+        result = index.search(query, max_distance)
+        assert sorted(result, key=lambda pair: (pair[1], pair[0])) == expected
+        assert [bits for _, bits in result] == sorted(bits for _, bits in result)
+
+
+def test_hashes_added_since_the_last_rebuild_are_found(tmp_path, monkeypatch):
+    monkeypatch.setattr(phash_index, "MIN_PENDING_BEFORE_REBUILD", 10 ** 6)
+    index = PerceptualHashIndex(str(tmp_path / "phash.sqlite3"))
+    index.add(["a"], [0x0123456789ABCDEF])
+    assert index._indexed == 0
+    assert index.search(_flip(0x0123456789ABCDEF, [0, 20, 40, 60]), 6) == [("a", 4)]
+
+
+def test_limit_readd_and_remove(tmp_path):
+    index = PerceptualHashIndex(str(tmp_path / "phash.sqlite3"))
+    base = 0xFFFF0000FFFF0000
+    index.add(["a", "b", "c"], [base, _flip(base, [1]), _flip(base, [1, 2, 3])])
+    index._rebuild()
+    assert index.search(base, 6, limit=2) == [("a", 0), ("b", 1)]
+
+    # Re-adding an id replaces its hash; removed ids are never returned
+    index.add(["a"], [_flip(base, list(range(0, 64, 2)))])
+    index.remove(["b"])
+    assert index.search(base, 6) == [("c", 3)]
+    assert len(index) == 2
+
+
+def test_hashes_persist_and_the_algorithm_is_checked(tmp_path):
+    path = str(tmp_path / "phash.sqlite3")
+    index = PerceptualHashIndex(path)
+    index.add(["a", "b"], [2 ** 64 - 1, 5])
+    index.close()
+
+    reopened = PerceptualHashIndex(path)
+    assert reopened.search(2 ** 64 - 1, 0) == [("a", 0)]
+    assert reopened.search(5, 0) == [("b", 0)]
+    reopened.close()
+    with pytest.raises(ValueError):
+        PerceptualHashIndex(path, algorithm="dhash")
@@ -0,0 +1,146 @@
+import importlib
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+NUM_ASSETS = 7
+IMAGE_DELAY_SECONDS = 0.05
+
+
+class StubStory:
+    """A local stand-in for the Story Protocol registry and the hosts serving the images."""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.conditional = Counter()
+        self.failures = {}  # image name -> 5xx answers still to give
+        self.active = defaultdict(int)
+        self.max_active = defaultdict(int)
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                offset, limit = body["pagination"]["offset"], body["pagination"]["limit"]
+                data = [{"ipId": f"0xip{i}", "nftMetadata": {"image": {"originalUrl": stub.image_url(i)}}}
+                        for i in range(offset, min(offset + limit, NUM_ASSETS))]
+                self._send(200, json.dumps({"data": data}).encode(), "application/json")
+
+            def do_GET(self):
+                name = self.path.rsplit("/", 1)[-1]
+                host = self.headers["Host"].split(":")[0]
+                with stub.lock:
+                    stub.requests[name] += 1
+                    stub.active[host] += 1
+                    stub.max_active[host] = max(stub.max_active[host], stub.active[host])
+                    failing = stub.failures.get(name, 0)
+                    if failing:
+                        stub.failures[name] = failing - 1
+                try:
+                    time.sleep(IMAGE_DELAY_SECONDS)
+                    etag = f'"{name}-v1"'
+                    if failing:
+                        self._send(503, b"busy", "text/plain")
+                    elif self.headers.get("If-None-Match") == etag:
+                        with stub.lock:
+                            stub.conditional[name] += 1
+                        self._send(304, b"", "image/jpeg", etag)
+                    else:
+                        self._send(200, f"image bytes of {name}".encode(), "image/jpeg", etag)
+                finally:
+                    with stub.lock:
+                        stub.active[host] -= 1
+
+            def _send(self, status, body, content_type, etag=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def image_url(self, i: int) -> str:
+        # Even assets come from one host name, odd ones from another (both this server)
+        host = "127.0.0.1" if i % 2 == 0 else "localhost"
+        return f"http://{host}:{self.port}/images/asset{i}.jpg"
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/v4/assets"
+
+
+@pytest.fixture
+def stub():
+    server = StubStory()
+    yield server
+    server.server.shutdown()
+
+
+@pytest.fixture
+def downloader(stub, monkeypatch):
+    """The downloader module, re-imported so STORY_ASSETS_API_URL points at the stub."""
+    monkeypatch.setenv("STORY_ASSETS_API_URL", stub.api_url)
+    import story_protocol_downloader
+    return importlib.reload(story_protocol_downloader)
+
+
+def _download(downloader, tmp_path, **options):
+    return downloader.download_and_save_assets(
+        list(downloader.iter_ip_metadata(max_assets=0, page_size=3)),
+        assets_folder=str(tmp_path / "assets"), manifest_file=str(tmp_path / "manifest.json"), **options)
+
+
+def test_registry_is_paged_from_the_configured_url(downloader):
+    assert downloader.ASSETS_API_URL.startswith("http://127.0.0.1:")
+    items = list(downloader.iter_ip_metadata(max_assets=0, page_size=3))
+    assert [item["ipId"] for item in items] == [f"0xip{i}" for i in range(NUM_ASSETS)]
+    assert len(list(downloader.iter_ip_metadata(max_assets=4, page_size=3))) == 4
+
+
+def test_manifest_skips_current_files_and_revalidates_with_etags(downloader, stub, tmp_path):
+    assert _download(downloader, tmp_path)["downloaded"] == NUM_ASSETS
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    assert manifest["0xip0_asset0.jpg"]["etag"] == '"asset0.jpg-v1"'
+
+    # Present files with the recorded size are not requested again
+    before = sum(stub.requests.values())
+    assert _download(downloader, tmp_path)["skipped"] == NUM_ASSETS
+    assert sum(stub.requests.values()) == before
+
+    # A file whose size no longer matches the manifest is fetched again
+    with open(os.path.join(tmp_path, "assets", "0xip1_asset1.jpg"), "ab") as f:
+        f.write(b"truncated or modified")
+    counts = _download(downloader, tmp_path)
+    assert counts["downloaded"] == 1 and counts["skipped"] == NUM_ASSETS - 1
+
+    # --revalidate sends If-None-Match and keeps files the server reports unchanged
+    assert _download(downloader, tmp_path, revalidate=True)["not-modified"] == NUM_ASSETS
+    assert sum(stub.conditional.values()) == NUM_ASSETS
+
+
+def test_server_errors_are_retried(downloader, stub, tmp_path):
+    stub.failures["asset2.jpg"] = 2
+    counts = _download(downloader, tmp_path)
+    assert counts["downloaded"] == NUM_ASSETS and counts["failed"] == 0
+    assert stub.requests["asset2.jpg"] == 3
+
+
+def test_connections_are_capped_per_host(downloader, stub, tmp_path):
+    counts = _download(downloader, tmp_path, workers=8, per_host=2)
+    assert counts["downloaded"] == NUM_ASSETS
+    assert set(stub.max_active) == {"127.0.0.1", "localhost"}
+    assert all(active <= 2 for active in stub.max_active.values())
@@ -0,0 +1,48 @@
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+from uploads import RequestSizeLimitMiddleware
+
+LIMIT = 64 * 1024
+BOUNDARY = "iplens-test-boundary"
+
+
+def _client() -> TestClient:
+    app = FastAPI()
+    app.add_middleware(RequestSizeLimitMiddleware, max_bytes=LIMIT)
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        return {"size": len(await file.read())}
+
+    return TestClient(app)
+
+
+def _multipart(size: int, chunk_size: int = 8 * 1024):
+    """A multipart body holding one `size` byte file, yielded in chunks (sent without Content-Length)."""
+    yield (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.jpg\"\r\n"
+           f"Content-Type: image/jpeg\r\n\r\n").encode()
+    for start in range(0, size, chunk_size):
+        yield b"x" * min(chunk_size, size - start)
+    yield f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def _post(client: TestClient, body):
+    return client.post("/upload", content=body, headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+
+
+def test_body_under_the_limit_is_passed_through():
+    response = _post(_client(), _multipart(LIMIT // 2))
+    assert response.status_code == 200
+    assert response.json() == {"size": LIMIT // 2}
+
+
+def test_content_length_over_the_limit_is_rejected():
+    response = _post(_client(), b"".join(_multipart(2 * LIMIT)))
+    assert response.status_code == 413
+
+
+def test_chunked_body_over_the_limit_is_rejected_with_413():
+    response = _post(_client(), _multipart(2 * LIMIT))
+    assert response.status_code == 413
+    assert "byte limit" in response.json()["detail"]
@@ -0,0 +1,52 @@
+import base64
+
+import msgpack
+import numpy as np
+import orjson
+import pytest
+from fastapi import HTTPException
+
+from vector_encoding import encode_vectors, negotiate_vector_format
+
+VECTORS = np.random.RandomState(0).randn(3, 8).astype(np.float32)
+
+
+@pytest.mark.parametrize("accept, requested, expected", [
+    (None, None, "json"),
+    ("*/*", None, "json"),
+    ("application/octet-stream", None, "raw"),
+    ("application/x-msgpack", None, "msgpack"),
+    ("text/html, application/msgpack;q=0.5, application/octet-stream;q=0.9", None, "raw"),
+    ("application/octet-stream", "base64", "base64"),
+])
+def test_negotiation(accept, requested, expected):
+    assert negotiate_vector_format(accept, requested, "float32") == expected
+
+
+@pytest.mark.parametrize("accept, requested, dtype, status", [
+    ("text/html", None, "float32", 406),
+    (None, "xml", "float32", 400),
+    (None, None, "int8", 400),
+])
+def test_negotiation_errors(accept, requested, dtype, status):
+    with pytest.raises(HTTPException) as raised:
+        negotiate_vector_format(accept, requested, dtype)
+    assert raised.value.status_code == status
+
+
+def test_every_encoding_round_trips():
+    ids = ["a", "b", "c"]
+    document = orjson.loads(encode_vectors(VECTORS, "json", ids=ids).body)
+    assert [item["id"] for item in document["vectors"]] == ids
+    assert np.array_equal(np.array([item["vector"] for item in document["vectors"]], dtype=np.float32), VECTORS)
+
+    raw = encode_vectors(VECTORS, "raw", "float16", ids=ids)
+    assert raw.headers["x-vector-count"] == "3" and raw.headers["x-vector-dim"] == "8"
+    assert np.allclose(np.frombuffer(raw.body, "<f2").reshape(3, 8), VECTORS, atol=1e-2)
+
+    document = orjson.loads(encode_vectors(VECTORS, "base64", ids=ids).body)
+    assert document["ids"] == ids
+    assert np.array_equal(np.frombuffer(base64.b64decode(document["vectors"]), "<f4").reshape(3, 8), VECTORS)
+
+    document = msgpack.unpackb(encode_vectors(VECTORS[:1], "msgpack", single=True).body)
+    assert np.array_equal(np.frombuffer(document["vector"], "<f4"), VECTORS[0])
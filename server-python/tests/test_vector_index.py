@@ -0,0 +1,60 @@
+import numpy as np
+
+from model_tools import search_vector_page
+from vector_index import MmapVectorIndex, exact_search
+
+
+def _unit_vectors(count: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    vectors = np.random.RandomState(seed).randn(count, dim).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_exact_search_matches_brute_force():
+    matrix, queries = _unit_vectors(1000), _unit_vectors(3, seed=1)
+    rows, distances = exact_search(matrix, queries, 10)
+    expected = ((queries[:, None, :] - matrix[None, :, :]) ** 2).sum(axis=2)
+    for query_no in range(3):
+        assert list(rows[query_no]) == list(np.argsort(expected[query_no])[:10])
+        assert np.allclose(distances[query_no], np.sort(expected[query_no])[:10], atol=1e-5)
+
+
+def test_max_distance_prunes_rows_beyond_the_threshold():
+    matrix, queries = _unit_vectors(1000), _unit_vectors(3, seed=1)
+    rows, distances = exact_search(matrix, queries, 50)
+    max_distance = float(np.median(np.concatenate(distances)))
+    pruned_rows, pruned_distances = exact_search(matrix, queries, 50, max_distance=max_distance)
+    for query_no in range(3):
+        keep = distances[query_no] <= max_distance
+        assert list(pruned_rows[query_no]) == list(rows[query_no][keep])
+        assert np.all(pruned_distances[query_no] <= max_distance)
+
+
+def test_query_with_max_distance_and_filter(tmp_path):
+    index = MmapVectorIndex(str(tmp_path / "index"))
+    vectors = _unit_vectors(200)
+    index.add(ids=[f"id{i}" for i in range(200)], embeddings=vectors,
+              metadatas=[{"group": i % 2} for i in range(200)])
+    result = index.query(vectors[:1], n_results=20, where={"group": 0}, max_distance=1.0, include=["distances", "metadatas"])
+    assert result["ids"][0][0] == "id0"
+    assert all(distance <= 1.0 for distance in result["distances"][0])
+    assert all(metadata["group"] == 0 for metadata in result["metadatas"][0])
+
+
+def test_search_pages_walk_the_ranking_without_gaps(tmp_path):
+    index = MmapVectorIndex(str(tmp_path / "index"))
+    vectors = _unit_vectors(25)
+    index.add(ids=[f"id{i}" for i in range(25)], embeddings=vectors, metadatas=[{"n": i} for i in range(25)])
+    ranking = index.query(vectors[:1], n_results=25)["ids"][0]
+
+    pages, offset, has_more = [], 0, True
+    while has_more:
+        page, has_more = search_vector_page(index, vectors[0], n_results=10, offset=offset)
+        pages.append(page["ids"][0])
+        offset += len(page["ids"][0])
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == ranking
+
+    # With a threshold no page follows the cut-off
+    page, has_more = search_vector_page(index, vectors[0], n_results=10, min_similarity=0.99)
+    assert page["ids"][0] == ["id0"]
+    assert has_more is False
@@ -0,0 +1,111 @@
+import socket
+
+import httpx
+import numpy as np
+import pytest
+
+from vector_index import MmapVectorIndex
+from vector_service import LocalShards, ShardedCollection, shard_for
+
+NUM_SHARDS = 3
+DIM = 32
+COUNT = 300
+
+
+def _free_base_port(count: int) -> int:
+    """The first of `count` consecutive free local ports."""
+    for base in range(18100, 30000, 10):
+        sockets = []
+        try:
+            for port in range(base, base + count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+    raise RuntimeError("No free ports for the shard services.")
+
+
+def _unit_vectors(count: int, seed: int) -> np.ndarray:
+    vectors = np.random.RandomState(seed).randn(count, DIM).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture(scope="module")
+def stores(tmp_path_factory):
+    """The same rows in a sharded collection (all shards on this machine) and in one mmap index."""
+    data_dir = tmp_path_factory.mktemp("shards")
+    ids = [f"id{i}" for i in range(COUNT)]
+    vectors = _unit_vectors(COUNT, seed=1)
+    metadatas = [{"ipId": f"ip{i % 5}", "n": i} for i in range(COUNT)]
+
+    reference = MmapVectorIndex(str(data_dir / "reference"))
+    reference.add(ids=ids, embeddings=vectors, metadatas=metadatas)
+    with LocalShards(NUM_SHARDS, data_dir=str(data_dir), base_port=_free_base_port(NUM_SHARDS)) as shards:
+        sharded = ShardedCollection(shards.urls)
+        sharded.add(ids=ids, embeddings=vectors, metadatas=metadatas)
+        yield sharded, reference
+        sharded.close()
+
+
+def test_rows_are_spread_over_every_shard(stores):
+    sharded, _ = stores
+    sharded.check()
+    counts = [httpx.get(f"{url}/count").json()["count"] for url in sharded.urls]
+    assert sum(counts) == COUNT == sharded.count()
+    assert all(count > 0 for count in counts)
+    assert shard_for("id7", NUM_SHARDS) == shard_for("id7", NUM_SHARDS)
+
+
+@pytest.mark.parametrize("where", [None, {"ipId": "ip3"}])
+def test_scatter_gather_top_k_matches_a_single_index(stores, where):
+    sharded, reference = stores
+    queries = _unit_vectors(4, seed=2)
+    include = ["metadatas", "distances"]
+    expected = reference.query(queries, n_results=10, where=where, include=include)
+    merged = sharded.query(queries, n_results=10, where=where, include=include)
+    assert merged["ids"] == expected["ids"]
+    assert np.allclose(merged["distances"], expected["distances"], atol=1e-5)
+    assert merged["metadatas"] == expected["metadatas"]
+
+
+def test_get_pages_through_every_shard(stores):
+    sharded, _ = stores
+    for where, total in ((None, COUNT), ({"ipId": "ip1"}, COUNT // 5)):
+        seen, offset = [], 0
+        while True:
+            page = sharded.get(where=where, limit=17, offset=offset, include=[])
+            if not page["ids"]:
+                break
+            assert len(page["ids"]) <= 17
+            seen += page["ids"]
+            offset += len(page["ids"])
+        assert len(seen) == len(set(seen)) == total
+
+
+def test_get_by_id_and_upsert(stores):
+    sharded, _ = stores
+    found = sharded.get(ids=["id3", "id77", "missing"], include=["metadatas"])
+    assert sorted(found["ids"]) == ["id3", "id77"]
+
+    sharded.upsert(ids=["id3", "extra"], embeddings=_unit_vectors(2, seed=3),
+                   metadatas=[{"ipId": "ip3", "n": 3}, {"ipId": "x", "n": -1}])
+    assert sharded.count() == COUNT + 1
+    sharded.delete(ids=["extra"])
+    assert sharded.count() == COUNT
+
+
+def test_bad_filter_is_a_value_error(stores):
+    sharded, _ = stores
+    with pytest.raises(ValueError):
+        sharded.get(where={"n": {"$foo": 1}})
+
+
+def test_perceptual_hash_index_is_not_loaded_for_the_sharded_store():
+    # Each worker would hold its own copy and miss the other workers' adds
+    from model_tools import load_near_duplicate_index
+    assert load_near_duplicate_index("sharded") is None
@@ -0,0 +1,64 @@
+import asyncio
+
+import numpy as np
+
+from vector_index import MmapVectorIndex
+from write_buffer import WriteBuffer
+
+
+def _vector(seed: int, dim: int = 8) -> np.ndarray:
+    vector = np.random.RandomState(seed).randn(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _run(collection, adds):
+    """Starts a buffer on `collection`, awaits `adds(buffer)` and stops it again."""
+    async def main():
+        buffer = WriteBuffer(collection, flush_ms=50)
+        await buffer.start()
+        try:
+            return buffer, await adds(buffer)
+        finally:
+            await buffer.stop()
+    return asyncio.run(main())
+
+
+def test_one_flush_writes_each_id_and_each_content_hash_once(tmp_path):
+    collection = MmapVectorIndex(str(tmp_path / "index"), name="test")
+    buffer, written = _run(collection, lambda buffer: buffer.add_many(
+        ["a.jpg", "b.jpg", "a.jpg", "c.jpg"],
+        [_vector(1), _vector(2), _vector(3), _vector(2)],
+        content_hashes=["hash-a", "hash-b", "hash-x", "hash-b"],
+    ))
+
+    assert [duplicate_of for duplicate_of, _ in written] == [None, None, "a.jpg", "b.jpg"]
+    assert collection.count() == 2
+    assert buffer.count == 2
+    assert buffer.stats()["flushes"] == 1
+    assert buffer.stats()["duplicates"] == 2
+
+
+def test_bytes_stored_by_an_earlier_flush_are_reported_as_duplicates(tmp_path):
+    collection = MmapVectorIndex(str(tmp_path / "index"), name="test")
+    _run(collection, lambda buffer: buffer.add("a.jpg", _vector(1), content_hash="hash-a"))
+
+    buffer, (duplicate_of, count) = _run(collection, lambda buffer: buffer.add("copy.jpg", _vector(1), content_hash="hash-a"))
+    assert duplicate_of == "a.jpg"
+    assert count == 1
+    assert collection.count() == 1
+
+
+def test_running_count_matches_the_collection(tmp_path):
+    collection = MmapVectorIndex(str(tmp_path / "index"), name="test")
+    _run(collection, lambda buffer: buffer.add_many(["a.jpg", "b.jpg"], [_vector(1), _vector(2)]))
+
+    async def adds(buffer):
+        first = await buffer.add("c.jpg", _vector(3), content_hash="hash-c")
+        # Re-adding an existing id replaces its row and does not grow the count
+        second = await buffer.add("a.jpg", _vector(4))
+        return first, second
+
+    buffer, ((_, after_new), (_, after_replace)) = _run(collection, adds)
+    assert after_new == 3
+    assert after_replace == 3
+    assert buffer.count == collection.count() == 3
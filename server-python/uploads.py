@@ -0,0 +1,198 @@
+import hashlib
+import os
+import tarfile
+import tempfile
+import zipfile
+from typing import BinaryIO, List, Optional, Tuple
+
+from image_decode import MAX_IMAGE_BYTES, ImageRejected
+
+# --- Configuration ---
+# Bytes copied per read while spooling, hashing and extracting uploads
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Whole request bodies above this are refused before the multipart form is parsed
+MAX_REQUEST_BYTES = int(os.getenv("IPLENS_MAX_REQUEST_BYTES", str(1024 * 1024 * 1024)))
+# Largest zip/tar archive accepted by the bulk endpoints
+MAX_ARCHIVE_BYTES = int(os.getenv("IPLENS_MAX_ARCHIVE_BYTES", str(MAX_REQUEST_BYTES)))
+
+
+class UploadTooLarge(ImageRejected):
+    """Raised when an upload, archive member or request body exceeds its size cap."""
+
+
+def safe_filename(filename: Optional[str]) -> Optional[str]:
+    """
+    The base name of a client-supplied filename (either path separator), or None when
+    nothing usable is left ("", "." or ".."). Asset paths are only ever built from this.
+    """
+    name = (filename or "").replace("\\", "/").rsplit("/", 1)[-1]
+    if name in ("", ".", ".."):
+        return None
+    return name
+
+
+def hash_file(path: str) -> str:
+    """sha256 of a file on disk, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# --- (1) Spooled Files ---
+
+class SpooledUpload:
+    """
+    An upload streamed to a temporary file next to the assets folder, with its size and
+    sha256 computed on the way. Decoding reads the file, and saving the asset is a rename.
+    """
+
+    def __init__(self, path: str, filename: str, size: int, content_hash: str):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.content_hash = content_hash
+        self.moved = False
+
+    def move_to(self, destination: str):
+        os.replace(self.path, destination)
+        self.path = destination
+        self.moved = True
+
+    def discard(self):
+        if not self.moved:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadSpool:
+    """
+    Owns the temporary files of one request. Use as a context manager: anything not
+    moved into place with SpooledUpload.move_to is deleted on exit.
+    Every method does blocking file I/O; call them from a worker thread.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.uploads: List[SpooledUpload] = []
+
+    def __enter__(self) -> "UploadSpool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    def cleanup(self):
+        for upload in self.uploads:
+            upload.discard()
+        self.uploads = []
+
+    def add_file(self, source: BinaryIO, filename: Optional[str], max_bytes: int = MAX_IMAGE_BYTES) -> SpooledUpload:
+        """Copies `source` in chunks into a new temporary file, hashing it and enforcing `max_bytes`."""
+        digest = hashlib.sha256()
+        size = 0
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix=".upload-")
+        upload = SpooledUpload(path, filename or "", 0, "")
+        self.uploads.append(upload)
+        with os.fdopen(fd, "wb") as target:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"{filename or 'Upload'} is larger than the {max_bytes} byte limit.")
+                digest.update(chunk)
+                target.write(chunk)
+        upload.size = size
+        upload.content_hash = digest.hexdigest()
+        return upload
+
+    def extract_archive(self, archive: SpooledUpload, extensions: Tuple[str, ...],
+                        max_member_bytes: int = MAX_IMAGE_BYTES) -> List[SpooledUpload]:
+        """
+        Streams every file with one of `extensions` inside a zip or (optionally compressed)
+        tar archive into its own spooled file. Directory structure is dropped, only the base
+        filenames are kept.
+        Members are capped on their decompressed size, so archive bombs stop early.
+        """
+        entries = []
+        if archive.filename.lower().endswith(".zip") or zipfile.is_zipfile(archive.path):
+            with zipfile.ZipFile(archive.path) as opened:
+                for info in opened.infolist():
+                    name = safe_filename(info.filename)
+                    if not info.is_dir() and name and name.lower().endswith(extensions):
+                        with opened.open(info) as member:
+                            entries.append(self.add_file(member, name, max_member_bytes))
+        else:
+            with tarfile.open(archive.path, mode="r:*") as opened:
+                for member in opened:
+                    name = safe_filename(member.name)
+                    if member.isfile() and name and name.lower().endswith(extensions):
+                        with opened.extractfile(member) as source:
+                            entries.append(self.add_file(source, name, max_member_bytes))
+        return entries
+
+
+# --- (2) Request Body Cap ---
+
+class RequestSizeLimitMiddleware:
+    """
+    ASGI middleware that refuses request bodies over `max_bytes`: immediately when the
+    Content-Length says so, otherwise as soon as the streamed body crosses the limit.
+
+    A chunked body that crosses the limit gets the 413 from here, and the application
+    sees a disconnect. Raising from receive() would not do: the form parser catches the
+    error and answers 400.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            return await self._reject(send)
+
+        received = 0
+        started = False
+        rejected = False
+
+        async def tracked_send(message):
+            nonlocal started
+            if rejected:
+                return  # The 413 has been sent; drop whatever the application answers
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    if not started:
+                        await self._reject(send)
+                    rejected = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        await self.app(scope, limited_receive, tracked_send)
+
+    async def _reject(self, send):
+        body = f'{{"detail": "Request body is larger than the {self.max_bytes} byte limit."}}'.encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,126 @@
+import base64
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+from metrics import stage
+
+try:
+    import msgpack
+except ImportError:  # Only needed for application/msgpack responses
+    msgpack = None
+
+# --- Configuration ---
+# Response encodings of the vector endpoints, by ?format= name
+MEDIA_TYPES = {
+    "json": "application/json",
+    "base64": "application/json",
+    "raw": "application/octet-stream",
+    "msgpack": "application/msgpack",
+}
+# Accept header media types and the format each one selects
+ACCEPTED_MEDIA_TYPES = {
+    "application/json": "json",
+    "application/octet-stream": "raw",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/*": "json",
+    "*/*": "json",
+}
+# Element types of the binary encodings (raw, base64, msgpack); JSON lists are always float32 values
+VECTOR_DTYPES = ("float32", "float16")
+
+# OpenAPI description of the alternative response bodies
+VECTOR_RESPONSES = {200: {"content": {"application/octet-stream": {}, "application/msgpack": {}}}}
+
+
+def _accept_entries(accept: str) -> List[tuple]:
+    """Parses an Accept header into (media type, q) pairs, most preferred first."""
+    entries = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = [piece.strip() for piece in part.split(";")]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            entries.append((media_type.lower(), q, position))
+    return [(media_type, q) for media_type, q, _ in sorted(entries, key=lambda e: (-e[1], e[2]))]
+
+
+def negotiate_vector_format(accept: Optional[str], requested: Optional[str], dtype: str) -> str:
+    """
+    Picks the response encoding: `requested` (?format=) when given, otherwise the most
+    preferred supported type in the Accept header, JSON when there is none.
+    406 when nothing acceptable can be produced (msgpack counts only if it is installed).
+    """
+    if dtype not in VECTOR_DTYPES:
+        raise HTTPException(status_code=400, detail=f"dtype must be one of {', '.join(VECTOR_DTYPES)}.")
+    if requested:
+        if requested not in MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(MEDIA_TYPES)}.")
+        if requested == "msgpack" and msgpack is None:
+            raise HTTPException(status_code=406, detail="msgpack responses need the msgpack package on the server.")
+        return requested
+    if not accept:
+        return "json"
+    for media_type, q in _accept_entries(accept):
+        fmt = ACCEPTED_MEDIA_TYPES.get(media_type)
+        if q <= 0 or fmt is None or (fmt == "msgpack" and msgpack is None):
+            continue
+        return fmt
+    raise HTTPException(status_code=406, detail=f"Vectors can be returned as {', '.join(sorted(set(MEDIA_TYPES.values())))} "
+                                                f"(or ?format={'|'.join(MEDIA_TYPES)}).")
+
+
+def _binary(vectors: np.ndarray, dtype: str) -> bytes:
+    """The rows as one little-endian block, without any per-float Python objects."""
+    return np.ascontiguousarray(vectors, dtype=np.dtype(dtype).newbyteorder("<")).tobytes()
+
+
+def encode_vectors(vectors: np.ndarray, fmt: str, dtype: str = "float32", single: bool = False,
+                   ids: Optional[List[str]] = None, extra: Optional[Dict[str, Any]] = None) -> Response:
+    """
+    Renders a (count, dim) matrix in the negotiated format.
+
+    - json: {"vector": [...]} or {"vectors": [{"id", "vector"}, ...]}, written by orjson
+      straight from the float32 array.
+    - base64: the same document with the little-endian `dtype` block as one base64 string
+      ("vector" or "vectors"), plus dtype, dim and count.
+    - raw: the block itself; X-Vector-Count, X-Vector-Dim and X-Vector-Dtype describe it.
+      Rows follow the order of the uploads and rows that could not be embedded are NaN.
+      It carries no ids or errors, so batches with archives should use base64 or msgpack.
+    - msgpack: the base64 document with the block as msgpack bin instead of a string.
+
+    `extra` fields (errors, status) are added to every document format.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    count, dim = vectors.shape if vectors.ndim == 2 else (0, 0)
+    extra = {"status": "success", **(extra or {})}
+    with stage("serialize"):
+        if fmt == "json":
+            if single:
+                document = {"vector": vectors[0], **extra}
+            else:
+                document = {"vectors": [{"id": item_id, "vector": vector} for item_id, vector in zip(ids, vectors)],
+                            **extra}
+            return Response(orjson.dumps(document, option=orjson.OPT_SERIALIZE_NUMPY), media_type=MEDIA_TYPES["json"])
+
+        block = _binary(vectors, dtype)
+        headers = {"X-Vector-Count": str(count), "X-Vector-Dim": str(dim), "X-Vector-Dtype": dtype}
+        if fmt == "raw":
+            return Response(block, media_type=MEDIA_TYPES["raw"], headers=headers)
+
+        key = "vector" if single else "vectors"
+        document = {key: block, "dtype": dtype, "dim": dim, "count": count, **({} if single else {"ids": ids}), **extra}
+        if fmt == "msgpack":
+            return Response(msgpack.packb(document, use_bin_type=True), media_type=MEDIA_TYPES["msgpack"], headers=headers)
+        document[key] = base64.b64encode(block).decode("ascii")
+        return Response(orjson.dumps(document), media_type=MEDIA_TYPES["base64"], headers=headers)
@@ -0,0 +1,398 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# --- Configuration ---
+# Storage precision of the vector matrix: float32 (exact) or float16 (half the memory)
+INDEX_DTYPE = os.getenv("IPLENS_INDEX_DTYPE", "float32")
+# Rows scored per step of a search, which bounds the temporary memory of a query
+SEARCH_CHUNK_ROWS = 65536
+# Metadata fields with a SQLite expression index, so `where` filters on them avoid a table scan
+# (ipId and source_url come from the Story Protocol downloader, content_hash from deduplication)
+METADATA_INDEX_FIELDS = [field for field in os.getenv(
+    "IPLENS_METADATA_INDEX_FIELDS", "ipId,source_url,content_hash,upload_time").split(",") if field]
+
+
+class MmapVectorIndex:
+    """
+    Embedded vector index: a memory-mapped matrix of vectors plus a SQLite sidecar for
+    ids, documents and metadata. Search is an exact vectorized dot product with
+    argpartition top-k.
+
+    It implements the subset of the ChromaDB Collection API this project uses
+    (add, upsert, get, query, delete, count), with the same return shapes and the same
+    squared-L2 distances, so model_tools works with either store.
+
+    Rows are only ever appended; deletes set a tombstone flag so existing row numbers
+    stay valid for the memory map.
+    """
+
+    def __init__(self, path: str, name: str = "ip_vector_collection", dtype: str = INDEX_DTYPE,
+                 metadata: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.name = name
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, "vectors.bin")
+        self._lock = threading.RLock()
+
+        self._db = sqlite3.connect(os.path.join(path, "index.sqlite3"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS rows (
+                row INTEGER PRIMARY KEY,
+                id TEXT NOT NULL,
+                document TEXT,
+                metadata TEXT NOT NULL DEFAULT '{}',
+                deleted INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS rows_live_id ON rows(id) WHERE deleted = 0;
+        """)
+        for field in METADATA_INDEX_FIELDS:
+            # Must match the expression where_to_sql emits, or SQLite will not use it
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS rows_meta_{_index_suffix(field)} "
+                             f"ON rows({_json_field(field)}) WHERE deleted = 0")
+        self._db.commit()
+        settings = dict(self._db.execute("SELECT key, value FROM settings").fetchall())
+        self.dtype = np.dtype(settings.get("dtype", dtype))
+        self.dim = int(settings["dim"]) if "dim" in settings else None
+        # Like Chroma's collection metadata: recorded when the index is created (e.g. the model id)
+        if "metadata" not in settings:
+            settings["metadata"] = json.dumps(metadata or {})
+            with self._db:
+                self._db.execute("INSERT INTO settings (key, value) VALUES ('metadata', ?)", (settings["metadata"],))
+        self.metadata = {**json.loads(settings["metadata"]), "backend": "mmap", "dtype": self.dtype.name}
+
+        # Rows present in the sidecar are the source of truth; trailing bytes from an
+        # interrupted append are cut off
+        total_rows = self._db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows").fetchone()[0]
+        self._truncate_vectors(total_rows)
+        self._deleted = np.zeros(total_rows, dtype=bool)
+        deleted_rows = [r for (r,) in self._db.execute("SELECT row FROM rows WHERE deleted = 1")]
+        self._deleted[deleted_rows] = True
+        self._live_count = total_rows - len(deleted_rows)
+        self._matrix: Optional[np.ndarray] = None
+
+    # --- (1) Storage helpers ---
+
+    @property
+    def total_rows(self) -> int:
+        return len(self._deleted)
+
+    def _truncate_vectors(self, rows: int):
+        if self.dim is None or not os.path.exists(self._vectors_path):
+            return
+        expected = rows * self.dim * self.dtype.itemsize
+        if os.path.getsize(self._vectors_path) > expected:
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(expected)
+
+    def _map(self) -> np.ndarray:
+        """Returns the (rows, dim) memory map, re-opening it after appends."""
+        if self.total_rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        if self._matrix is None or self._matrix.shape[0] != self.total_rows:
+            self._matrix = np.memmap(self._vectors_path, dtype=self.dtype, mode="r", shape=(self.total_rows, self.dim))
+        return self._matrix
+
+    def _live_rows(self, ids: Sequence[str]) -> Dict[str, int]:
+        found = {}
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for stored_id, row in self._db.execute(
+                    f"SELECT id, row FROM rows WHERE deleted = 0 AND id IN ({placeholders})", chunk):
+                found[stored_id] = row
+        return found
+
+    # --- (2) Writes ---
+
+    def add(self, ids: List[str], embeddings, metadatas: Optional[List[dict]] = None,
+            documents: Optional[List[str]] = None, **_):
+        """Appends vectors. Like Chroma, ids that are already present are ignored."""
+        with self._lock:
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            if vectors.ndim == 1:
+                vectors = vectors[None, :]
+            metadatas = metadatas or [None] * len(ids)
+            documents = documents or [None] * len(ids)
+
+            existing = self._live_rows(ids)
+            keep, seen = [], set()
+            for i, item_id in enumerate(ids):
+                if item_id not in existing and item_id not in seen:
+                    keep.append(i)
+                    seen.add(item_id)
+            if not keep:
+                return
+
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._db.execute("INSERT OR REPLACE INTO settings VALUES ('dim', ?)", (str(self.dim),))
+                self._db.execute("INSERT OR REPLACE INTO settings VALUES ('dtype', ?)", (self.dtype.name,))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match index dimension {self.dim}")
+
+            # Vectors first, then the sidecar rows: a crash in between leaves only
+            # unreferenced trailing bytes, which are truncated on the next open
+            first_row = self.total_rows
+            with open(self._vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors[keep], dtype=self.dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO rows (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                    [(first_row + n, ids[i], documents[i], json.dumps(metadatas[i] or {}))
+                     for n, i in enumerate(keep)]
+                )
+            self._deleted = np.concatenate([self._deleted, np.zeros(len(keep), dtype=bool)])
+            self._live_count += len(keep)
+
+    def upsert(self, ids: List[str], embeddings, metadatas: Optional[List[dict]] = None,
+               documents: Optional[List[str]] = None, **_):
+        """Replaces existing ids (tombstoning their old rows) and adds new ones."""
+        with self._lock:
+            self.delete(ids=list(ids))
+            self.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, **_):
+        """Tombstones the matching rows."""
+        with self._lock:
+            rows = self._select_rows(ids=ids, where=where)
+            if not rows:
+                return
+            with self._db:
+                self._db.executemany("UPDATE rows SET deleted = 1 WHERE row = ?", [(row,) for row, *_ in rows])
+            self._deleted[[row for row, *_ in rows]] = True
+            self._live_count -= len(rows)
+
+    # --- (3) Reads ---
+
+    def count(self) -> int:
+        return self._live_count
+
+    def _select_rows(self, ids: Optional[List[str]] = None, where: Optional[dict] = None,
+                     limit: Optional[int] = None, offset: Optional[int] = None,
+                     columns: str = "row, id, document, metadata") -> List[Tuple]:
+        sql = f"SELECT {columns} FROM rows WHERE deleted = 0"
+        params: List[Any] = []
+        if ids is not None:
+            if not ids:
+                return []
+            sql += f" AND id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        if where:
+            clause, where_params = where_to_sql(where)
+            sql += f" AND {clause}"
+            params.extend(where_params)
+        sql += " ORDER BY row"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset or 0])
+        return self._db.execute(sql, params).fetchall()
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Sequence[str] = ("metadatas", "documents"), **_) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._select_rows(ids=ids, where=where, limit=limit, offset=offset)
+            result: Dict[str, Any] = {"ids": [r[1] for r in rows], "included": list(include)}
+            result["metadatas"] = [json.loads(r[3]) for r in rows] if "metadatas" in include else None
+            result["documents"] = [r[2] for r in rows] if "documents" in include else None
+            if "embeddings" in include:
+                matrix = self._map()
+                result["embeddings"] = np.asarray(matrix[[r[0] for r in rows]], dtype=np.float32)
+            else:
+                result["embeddings"] = None
+            return result
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Sequence[str] = ("metadatas", "documents", "distances"),
+              max_distance: Optional[float] = None, **_) -> Dict[str, Any]:
+        """
+        Exact top-k search. Returns Chroma-style nested lists (one list per query) with
+        squared-L2 distances, smallest first. Rows farther than `max_distance` are left out.
+        """
+        with self._lock:
+            queries = np.asarray(query_embeddings, dtype=np.float32)
+            if queries.ndim == 1:
+                queries = queries[None, :]
+            matrix = self._map()
+            candidate_rows = None
+            if where:
+                # Only the row numbers are needed to restrict the scan
+                candidate_rows = np.array([r[0] for r in self._select_rows(where=where, columns="row")], dtype=np.int64)
+            deleted = self._deleted.copy()
+
+        rows, distances = exact_search(matrix, queries, n_results, deleted=deleted, candidate_rows=candidate_rows,
+                                       max_distance=max_distance)
+        return self._format_query(rows, distances, include)
+
+    def _format_query(self, rows: List[np.ndarray], distances: List[np.ndarray], include: Sequence[str]) -> Dict[str, Any]:
+        """Turns per-query row numbers and distances into a Chroma-shaped query result."""
+        with self._lock:
+            all_rows = sorted({int(r) for query_rows in rows for r in query_rows})
+            details = {}
+            for start in range(0, len(all_rows), 500):
+                chunk = all_rows[start:start + 500]
+                for row, item_id, document, metadata in self._db.execute(
+                        f"SELECT row, id, document, metadata FROM rows WHERE row IN ({','.join('?' * len(chunk))})", chunk):
+                    details[row] = (item_id, document, metadata)
+            matrix = self._map() if "embeddings" in include else None
+
+        return {
+            "ids": [[details[int(r)][0] for r in query_rows] for query_rows in rows],
+            "distances": [d.tolist() for d in distances] if "distances" in include else None,
+            "metadatas": [[json.loads(details[int(r)][2]) for r in query_rows] for query_rows in rows]
+            if "metadatas" in include else None,
+            "documents": [[details[int(r)][1] for r in query_rows] for query_rows in rows]
+            if "documents" in include else None,
+            "embeddings": [np.asarray(matrix[query_rows], dtype=np.float32) for query_rows in rows]
+            if matrix is not None else None,
+            "included": list(include),
+        }
+
+
+# --- (4) Search and filter helpers ---
+
+def exact_search(matrix: np.ndarray, queries: np.ndarray, n_results: int, deleted: Optional[np.ndarray] = None,
+                 candidate_rows: Optional[np.ndarray] = None,
+                 max_distance: Optional[float] = None) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """
+    Scores every (candidate) row against every query in chunks and keeps the best
+    `n_results` per query with argpartition. Returns (rows, squared-L2 distances) per query.
+    Rows farther than `max_distance` are pruned as each chunk is scored, so a query
+    may get fewer than `n_results` rows.
+    """
+    num_queries = queries.shape[0]
+    if candidate_rows is None:
+        candidate_rows = np.arange(matrix.shape[0], dtype=np.int64)
+    if deleted is not None and len(candidate_rows):
+        candidate_rows = candidate_rows[~deleted[candidate_rows]]
+
+    k = min(n_results, len(candidate_rows))
+    if k <= 0:
+        return [np.zeros(0, dtype=np.int64)] * num_queries, [np.zeros(0, dtype=np.float32)] * num_queries
+
+    query_norms = np.einsum("ij,ij->i", queries, queries)
+    best_rows = np.zeros((num_queries, 0), dtype=np.int64)
+    best_dist = np.zeros((num_queries, 0), dtype=np.float32)
+
+    contiguous = len(candidate_rows) == matrix.shape[0]
+    for start in range(0, len(candidate_rows), SEARCH_CHUNK_ROWS):
+        chunk_rows = candidate_rows[start:start + SEARCH_CHUNK_ROWS]
+        if contiguous:
+            block = np.asarray(matrix[start:start + len(chunk_rows)], dtype=np.float32)
+        else:
+            block = np.asarray(matrix[chunk_rows], dtype=np.float32)
+        # ||v - q||^2 = ||v||^2 + ||q||^2 - 2 v.q
+        dist = np.einsum("ij,ij->i", block, block)[None, :] + query_norms[:, None] - 2.0 * (queries @ block.T)
+        if max_distance is not None:
+            # Columns no query keeps are dropped before the merge; the rest are ranked last
+            dist[dist > max_distance] = np.inf
+            close = np.isfinite(dist).any(axis=0)
+            if not close.all():
+                dist, chunk_rows = dist[:, close], chunk_rows[close]
+
+        all_dist = np.concatenate([best_dist, dist], axis=1)
+        all_rows = np.concatenate([best_rows, np.broadcast_to(chunk_rows, (num_queries, len(chunk_rows)))], axis=1)
+        if all_dist.shape[1] > k:
+            keep = np.argpartition(all_dist, k - 1, axis=1)[:, :k]
+            all_dist = np.take_along_axis(all_dist, keep, axis=1)
+            all_rows = np.take_along_axis(all_rows, keep, axis=1)
+        best_dist, best_rows = all_dist, all_rows
+
+    order = np.argsort(best_dist, axis=1)
+    best_dist = np.maximum(np.take_along_axis(best_dist, order, axis=1), 0.0)
+    best_rows = np.take_along_axis(best_rows, order, axis=1)
+    if max_distance is not None:
+        kept = [np.isfinite(query_dist) for query_dist in best_dist]
+        return ([query_rows[keep] for query_rows, keep in zip(best_rows, kept)],
+                [query_dist[keep] for query_dist, keep in zip(best_dist, kept)])
+    return list(best_rows), list(best_dist)
+
+
+_COMPARISONS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def _json_field(key: str) -> str:
+    """
+    The SQL expression for a metadata field. The JSON path is inlined (not a bound
+    parameter) so queries match the expression indexes.
+    """
+    if not key or any(c in key for c in "\"'\\"):
+        raise ValueError(f"Unsupported metadata field name: {key!r}")
+    return f"""json_extract(metadata, '$."{key}"')"""
+
+
+def _index_suffix(key: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in key)
+
+
+def where_to_sql(where: dict) -> Tuple[str, List[Any]]:
+    """
+    Translates a Chroma-style metadata filter ({"field": value}, {"field": {"$in": [...]}},
+    $and/$or, and the comparison operators) into a SQL clause over the JSON metadata column.
+    """
+    clauses, params = [], []
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_to_sql(sub) for sub in condition]
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("(" + joiner.join(p[0] for p in parts) + ")")
+            for p in parts:
+                params.extend(p[1])
+            continue
+
+        column = _json_field(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, value in condition.items():
+            if op in _COMPARISONS:
+                clauses.append(f"{column} {_COMPARISONS[op]} ?")
+                params.append(value)
+            elif op in ("$in", "$nin"):
+                values = list(value)
+                if not values:
+                    clauses.append("0" if op == "$in" else "1")
+                    continue
+                negate = "NOT " if op == "$nin" else ""
+                clauses.append(f"{column} {negate}IN ({','.join('?' * len(values))})")
+                params.extend(values)
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+    return " AND ".join(clauses) or "1", params
+
+
+def copy_collection(source, target, batch_size: int = 1000) -> int:
+    """Copies every vector, document and metadata from one store to another, in batches."""
+    copied = 0
+    total = source.count()
+    for offset in range(0, total, batch_size):
+        batch = source.get(limit=batch_size, offset=offset, include=["embeddings", "metadatas", "documents"])
+        if not batch["ids"]:
+            break
+        target.add(ids=batch["ids"], embeddings=np.asarray(batch["embeddings"], dtype=np.float32),
+                   metadatas=batch["metadatas"], documents=batch["documents"])
+        copied += len(batch["ids"])
+    return copied
+
+
+if __name__ == "__main__":
+    import argparse
+    from model_tools import VECTOR_INDEX_PATH, load_vector_db
+
+    parser = argparse.ArgumentParser(description="Copy the ChromaDB collection into the embedded mmap index.")
+    parser.add_argument("--path", default=VECTOR_INDEX_PATH, help="Folder of the mmap index to fill.")
+    parser.add_argument("--dtype", default=INDEX_DTYPE, choices=["float32", "float16"])
+    args = parser.parse_args()
+
+    target = MmapVectorIndex(args.path, dtype=args.dtype)
+    copied = copy_collection(load_vector_db(store="chroma", use_ann=False), target)
+    print(f"Copied {copied} vectors into {args.path}. Index now holds {target.count()}.")
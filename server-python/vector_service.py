@@ -0,0 +1,533 @@
+import argparse
+import base64
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import chromadb
+import httpx
+import numpy as np
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from metrics import REGISTRY, MetricsMiddleware
+from vector_index import INDEX_DTYPE, MmapVectorIndex, copy_collection
+
+# --- Configuration ---
+# Comma separated base URLs of the shard services, in shard order (IPLENS_VECTOR_STORE=sharded)
+VECTOR_SHARDS = [url.strip().rstrip("/") for url in os.getenv("IPLENS_VECTOR_SHARDS", "").split(",") if url.strip()]
+# Seconds a shard call may take before the whole operation fails
+SHARD_TIMEOUT_SECONDS = float(os.getenv("IPLENS_SHARD_TIMEOUT", "30"))
+# Where the local launcher keeps one folder per shard
+SHARD_DATA_DIR = os.getenv("IPLENS_SHARD_DATA_DIR", "./vector_shards")
+SHARD_BASE_PORT = 8100
+COLLECTION_NAME = "ip_vector_collection"
+
+
+# --- (1) Routing and transport helpers ---
+
+def shard_for(item_id: str, num_shards: int) -> int:
+    """Stable shard of an id: the same in every process and on every node (unlike hash())."""
+    digest = hashlib.blake2b(item_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % num_shards
+
+
+def pack_vectors(matrix: np.ndarray) -> Dict[str, Any]:
+    """A (rows, dim) float32 matrix as base64, ~4x smaller and much faster to parse than JSON floats."""
+    matrix = np.ascontiguousarray(matrix, dtype="<f4")
+    return {"shape": list(matrix.shape), "data": base64.b64encode(matrix.tobytes()).decode("ascii")}
+
+
+def unpack_vectors(packed: Dict[str, Any]) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(packed["data"]), dtype="<f4").reshape(packed["shape"]).astype(np.float32)
+
+
+def _as_matrix(vectors, rows: int) -> np.ndarray:
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.asarray(vectors, dtype=np.float32).reshape(rows, -1)
+
+
+class PackedVectors(BaseModel):
+    shape: List[int]
+    data: str
+
+class WriteRequest(BaseModel):
+    ids: List[str]
+    embeddings: PackedVectors
+    metadatas: Optional[List[Optional[dict]]] = None
+    documents: Optional[List[Optional[str]]] = None
+
+class CollectionRequest(BaseModel):
+    metadata: Optional[dict] = None
+
+class DeleteRequest(BaseModel):
+    ids: Optional[List[str]] = None
+    where: Optional[dict] = None
+
+class GetRequest(BaseModel):
+    ids: Optional[List[str]] = None
+    where: Optional[dict] = None
+    limit: Optional[int] = None
+    offset: Optional[int] = None
+    include: List[str] = ["metadatas", "documents"]
+
+class QueryRequest(BaseModel):
+    embeddings: PackedVectors
+    n_results: int = 10
+    where: Optional[dict] = None
+    include: List[str] = ["metadatas", "documents", "distances"]
+
+
+# --- (2) Shard service ---
+
+def open_shard_store(store: str, path: str, name: str = COLLECTION_NAME, metadata: Optional[dict] = None):
+    """
+    One collection of a shard: an mmap index (the default collection in `path`, others in
+    sub-folders) or a Chroma collection in the shard's client. `metadata` is recorded on creation.
+    """
+    if store == "mmap":
+        return MmapVectorIndex(path if name == COLLECTION_NAME else os.path.join(path, name), name=name,
+                               dtype=INDEX_DTYPE, metadata=metadata)
+    if store != "chroma":
+        raise ValueError(f"Unknown shard store '{store}'. Use 'mmap' or 'chroma'.")
+    client = chromadb.PersistentClient(path=path)
+    return client.get_or_create_collection(name=name, embedding_function=None, metadata=metadata or None)
+
+
+def create_shard_app(open_collection: Callable[[str, Optional[dict]], Any], shard_index: int, num_shards: int) -> FastAPI:
+    """
+    HTTP front for one shard's collections: the add/upsert/delete/get/query/count calls of
+    the Collection API, with vectors sent as packed float32. Calls name their collection
+    with ?collection= (versioned indexes live side by side); collections are opened with
+    `open_collection(name, metadata)` on first use. The handlers are plain functions, so
+    Starlette runs them in its thread pool and the event loop stays free.
+    Filters the store rejects (ValueError) answer 400, which the client raises as ValueError again.
+    """
+    shard_app = FastAPI(title=f"IP Lens vector shard {shard_index}/{num_shards}")
+    shard_app.add_middleware(MetricsMiddleware)
+    collections: Dict[str, Any] = {}
+    opening = threading.Lock()
+
+    def collection_for(name: str, metadata: Optional[dict] = None):
+        if not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9._-]{1,126}[A-Za-z0-9]", name):
+            raise HTTPException(status_code=400, detail=f"Invalid collection name '{name}'.")
+        with opening:
+            if name not in collections:
+                collections[name] = open_collection(name, metadata)
+            return collections[name]
+
+    def call(fn, **kwargs):
+        try:
+            return fn(**kwargs)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @shard_app.get("/health")
+    def health():
+        return {"shard": shard_index, "shards": num_shards, "collections": sorted(collections)}
+
+    @shard_app.post("/collections/{name}")
+    def open_named_collection(name: str, request: CollectionRequest):
+        collection = collection_for(name, request.metadata)
+        return {"metadata": collection.metadata or {}, "count": collection.count()}
+
+    @shard_app.get("/count")
+    def count(collection: str = COLLECTION_NAME):
+        return {"count": collection_for(collection).count()}
+
+    @shard_app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    @shard_app.post("/add")
+    def add(request: WriteRequest, collection: str = COLLECTION_NAME):
+        store = collection_for(collection)
+        call(store.add, ids=request.ids, embeddings=unpack_vectors(request.embeddings.model_dump()),
+             metadatas=request.metadatas, documents=request.documents)
+        return {"count": store.count()}
+
+    @shard_app.post("/upsert")
+    def upsert(request: WriteRequest, collection: str = COLLECTION_NAME):
+        store = collection_for(collection)
+        call(store.upsert, ids=request.ids, embeddings=unpack_vectors(request.embeddings.model_dump()),
+             metadatas=request.metadatas, documents=request.documents)
+        return {"count": store.count()}
+
+    @shard_app.post("/delete")
+    def delete(request: DeleteRequest, collection: str = COLLECTION_NAME):
+        store = collection_for(collection)
+        call(store.delete, ids=request.ids, where=request.where)
+        return {"count": store.count()}
+
+    @shard_app.post("/get")
+    def get(request: GetRequest, collection: str = COLLECTION_NAME):
+        result = call(collection_for(collection).get, ids=request.ids, where=request.where, limit=request.limit,
+                      offset=request.offset, include=request.include)
+        ids = list(result["ids"])
+        return {
+            "ids": ids,
+            "metadatas": result.get("metadatas"),
+            "documents": result.get("documents"),
+            "embeddings": pack_vectors(_as_matrix(result["embeddings"], len(ids)))
+            if "embeddings" in request.include else None,
+        }
+
+    @shard_app.post("/query")
+    def query(request: QueryRequest, collection: str = COLLECTION_NAME):
+        store = collection_for(collection)
+        queries = unpack_vectors(request.embeddings.model_dump())
+        # A shard may hold fewer rows than asked for; Chroma refuses n_results above its count
+        n_results = min(request.n_results, store.count())
+        if n_results < 1:
+            empty = [[] for _ in range(len(queries))]
+            return {"ids": empty, "distances": empty, "metadatas": empty, "documents": empty,
+                    "embeddings": [pack_vectors(_as_matrix(None, 0)) for _ in range(len(queries))]
+                    if "embeddings" in request.include else None}
+        kwargs = {"where": request.where} if request.where else {}
+        result = call(store.query, query_embeddings=queries.tolist(), n_results=n_results,
+                      include=request.include, **kwargs)
+        ids = [list(query_ids) for query_ids in result["ids"]]
+        return {
+            "ids": ids,
+            "distances": [list(map(float, d)) for d in result["distances"]] if result.get("distances") is not None else None,
+            "metadatas": result.get("metadatas"),
+            "documents": result.get("documents"),
+            "embeddings": [pack_vectors(_as_matrix(e, len(query_ids))) for e, query_ids in zip(result["embeddings"], ids)]
+            if "embeddings" in request.include else None,
+        }
+
+    return shard_app
+
+
+# --- (3) Client: one collection over all shards ---
+
+class ShardUnavailable(RuntimeError):
+    """A shard did not answer; the operation is failed rather than answered from the other shards."""
+
+
+class ShardedCollection:
+    """
+    A collection spread over shard services by a stable hash of the id.
+
+    It implements the same subset of the Collection API as MmapVectorIndex, so model_tools,
+    the write buffer and the endpoints work with it unchanged. Writes and id lookups go
+    to the owning shards only; filtered gets, deletes by filter, counts and queries are
+    sent to every shard in parallel. A query asks each shard for its own top n_results
+    and merges them by distance, which gives exactly the global top n_results.
+
+    Any process can open one, so several API workers (or hosts) can share the store
+    without opening the same Chroma folder. `name` selects the collection on every shard
+    (created with `metadata` if it does not exist yet).
+    """
+
+    def __init__(self, urls: Sequence[str], name: str = COLLECTION_NAME, metadata: Optional[dict] = None,
+                 timeout: float = SHARD_TIMEOUT_SECONDS, check: bool = True):
+        if not urls:
+            raise ValueError("No vector shards configured. Set IPLENS_VECTOR_SHARDS to the shard URLs.")
+        self.urls = [url.rstrip("/") for url in urls]
+        self.name = name
+        self._client = httpx.Client(timeout=timeout, limits=httpx.Limits(max_connections=8 * len(self.urls)))
+        self._pool = ThreadPoolExecutor(max_workers=len(self.urls), thread_name_prefix="shard")
+        if check:
+            self.check()
+        opened = self._broadcast("POST", f"/collections/{name}", {"metadata": metadata})
+        self.metadata = {**opened[0]["metadata"], "backend": "sharded", "shards": len(self.urls)}
+
+    @property
+    def num_shards(self) -> int:
+        return len(self.urls)
+
+    def check(self) -> List[Dict[str, Any]]:
+        """Verifies every shard answers and was started as the shard at its position in the list."""
+        health = self._broadcast("GET", "/health")
+        for position, status in enumerate(health):
+            if status["shard"] != position or status["shards"] != self.num_shards:
+                raise RuntimeError(f"{self.urls[position]} serves shard {status['shard']} of {status['shards']}, "
+                                   f"but is listed as shard {position} of {self.num_shards}.")
+        return health
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        self._client.close()
+
+    # --- Transport ---
+
+    def _call(self, shard: int, method: str, path: str, body: Optional[dict] = None) -> Dict[str, Any]:
+        url = f"{self.urls[shard]}{path}"
+        try:
+            response = self._client.request(method, url, json=body, params={"collection": self.name})
+        except httpx.HTTPError as e:
+            raise ShardUnavailable(f"Vector shard {shard} ({self.urls[shard]}) is unavailable: {e}") from e
+        if response.status_code == 400:
+            raise ValueError(response.json().get("detail", "Bad request"))
+        if response.status_code != 200:
+            raise ShardUnavailable(f"Vector shard {shard} ({self.urls[shard]}) answered {response.status_code}: {response.text[:200]}")
+        return response.json()
+
+    def _scatter(self, requests: Dict[int, Tuple[str, str, Optional[dict]]]) -> Dict[int, Dict[str, Any]]:
+        """Sends one request per shard concurrently; returns the responses by shard."""
+        if len(requests) == 1:
+            (shard, request), = requests.items()
+            return {shard: self._call(shard, *request)}
+        futures = {shard: self._pool.submit(self._call, shard, *request) for shard, request in requests.items()}
+        return {shard: future.result() for shard, future in futures.items()}
+
+    def _broadcast(self, method: str, path: str, body: Optional[dict] = None) -> List[Dict[str, Any]]:
+        responses = self._scatter({shard: (method, path, body) for shard in range(self.num_shards)})
+        return [responses[shard] for shard in range(self.num_shards)]
+
+    def _group(self, ids: Sequence[str]) -> Dict[int, List[int]]:
+        """Positions of `ids` grouped by owning shard."""
+        groups: Dict[int, List[int]] = {}
+        for position, item_id in enumerate(ids):
+            groups.setdefault(shard_for(item_id, self.num_shards), []).append(position)
+        return groups
+
+    # --- Writes ---
+
+    def _write(self, path: str, ids: List[str], embeddings, metadatas: Optional[List[dict]],
+               documents: Optional[List[str]]):
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        requests = {}
+        for shard, positions in self._group(ids).items():
+            requests[shard] = ("POST", path, {
+                "ids": [ids[p] for p in positions],
+                "embeddings": pack_vectors(vectors[positions]),
+                "metadatas": [metadatas[p] for p in positions] if metadatas is not None else None,
+                "documents": [documents[p] for p in positions] if documents is not None else None,
+            })
+        self._scatter(requests)
+
+    def add(self, ids: List[str], embeddings, metadatas: Optional[List[dict]] = None,
+            documents: Optional[List[str]] = None, **_):
+        self._write("/add", list(ids), embeddings, metadatas, documents)
+
+    def upsert(self, ids: List[str], embeddings, metadatas: Optional[List[dict]] = None,
+               documents: Optional[List[str]] = None, **_):
+        self._write("/upsert", list(ids), embeddings, metadatas, documents)
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, **_):
+        if ids is None:
+            self._broadcast("POST", "/delete", {"where": where})
+            return
+        ids = list(ids)
+        self._scatter({shard: ("POST", "/delete", {"ids": [ids[p] for p in positions], "where": where})
+                       for shard, positions in self._group(ids).items()})
+
+    # --- Reads ---
+
+    def count(self) -> int:
+        return sum(response["count"] for response in self._broadcast("GET", "/count"))
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Sequence[str] = ("metadatas", "documents"), **_) -> Dict[str, Any]:
+        """
+        Rows by id (asking only the owning shards) or by filter. Filtered pages walk the
+        shards in order, so limit/offset page through all of them without overlap.
+        """
+        include = list(include)
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return self._merge_gets([], include)
+            responses = self._scatter({shard: ("POST", "/get", {"ids": [ids[p] for p in positions], "where": where,
+                                                                "include": include})
+                                       for shard, positions in self._group(ids).items()})
+            return self._merge_gets([responses[shard] for shard in sorted(responses)], include)
+
+        body = {"where": where, "include": include}
+        if limit is None and not offset:
+            return self._merge_gets(self._broadcast("POST", "/get", body), include)
+
+        # Sizes of the filtered shards, then one ranged get per shard the page overlaps
+        if where:
+            sizes = [len(r["ids"]) for r in self._broadcast("POST", "/get", {"where": where, "include": []})]
+        else:
+            sizes = [r["count"] for r in self._broadcast("GET", "/count")]
+        skip, remaining, requests = offset or 0, limit, {}
+        for shard, size in enumerate(sizes):
+            if remaining is not None and remaining <= 0:
+                break
+            if skip >= size:
+                skip -= size
+                continue
+            take = size - skip if remaining is None else min(remaining, size - skip)
+            requests[shard] = ("POST", "/get", {**body, "limit": take, "offset": skip})
+            skip = 0
+            if remaining is not None:
+                remaining -= take
+        responses = self._scatter(requests) if requests else {}
+        return self._merge_gets([responses[shard] for shard in sorted(responses)], include)
+
+    @staticmethod
+    def _merge_gets(responses: List[Dict[str, Any]], include: List[str]) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"ids": [item_id for r in responses for item_id in r["ids"]], "included": include}
+        for key in ("metadatas", "documents"):
+            result[key] = [value for r in responses for value in r[key]] if key in include else None
+        if "embeddings" in include:
+            matrices = [unpack_vectors(r["embeddings"]) for r in responses if r["ids"]]
+            result["embeddings"] = np.concatenate(matrices) if matrices else np.zeros((0, 0), dtype=np.float32)
+        else:
+            result["embeddings"] = None
+        return result
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Sequence[str] = ("metadatas", "documents", "distances"), **_) -> Dict[str, Any]:
+        """Scatter-gather top-k: every shard returns its best n_results per query; the best n_results overall are kept."""
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        include = list(include)
+        # Distances are needed to merge, even when the caller does not want them back
+        shard_include = include if "distances" in include else include + ["distances"]
+        responses = self._broadcast("POST", "/query", {"embeddings": pack_vectors(queries), "n_results": n_results,
+                                                       "where": where, "include": shard_include})
+
+        result: Dict[str, Any] = {key: [] for key in ("ids", "distances", "metadatas", "documents", "embeddings")}
+        for q in range(len(queries)):
+            candidates = []
+            for shard, response in enumerate(responses):
+                for i, distance in enumerate(response["distances"][q]):
+                    candidates.append((distance, shard, i))
+            best = sorted(candidates)[:n_results]
+            result["ids"].append([responses[shard]["ids"][q][i] for _, shard, i in best])
+            result["distances"].append([distance for distance, _, _ in best])
+            for key in ("metadatas", "documents"):
+                result[key].append([responses[shard][key][q][i] for _, shard, i in best] if key in include else None)
+            if "embeddings" in include:
+                matrices = [unpack_vectors(response["embeddings"][q]) for response in responses]
+                result["embeddings"].append(np.asarray([matrices[shard][i] for _, shard, i in best], dtype=np.float32))
+
+        for key in ("distances", "metadatas", "documents", "embeddings"):
+            if key not in include:
+                result[key] = None
+        result["included"] = include
+        return result
+
+
+# --- (4) Local launcher ---
+
+class LocalShards:
+    """
+    Starts `num_shards` shard services as subprocesses on consecutive ports of this host
+    (one data folder each) and stops them on exit. Used by `launch` and by the benchmarks.
+    """
+
+    def __init__(self, num_shards: int, data_dir: str = SHARD_DATA_DIR, base_port: int = SHARD_BASE_PORT,
+                 store: str = "mmap", host: str = "127.0.0.1"):
+        self.num_shards = num_shards
+        self.data_dir = data_dir
+        self.base_port = base_port
+        self.store = store
+        self.host = host
+        self.processes: List[subprocess.Popen] = []
+
+    @property
+    def urls(self) -> List[str]:
+        return [f"http://{self.host}:{self.base_port + shard}" for shard in range(self.num_shards)]
+
+    def start(self, timeout: float = 60.0) -> List[str]:
+        for shard in range(self.num_shards):
+            self.processes.append(subprocess.Popen([
+                sys.executable, os.path.abspath(__file__), "serve",
+                "--shard", str(shard), "--shards", str(self.num_shards),
+                "--path", os.path.join(self.data_dir, f"shard-{shard}"), "--store", self.store,
+                "--host", self.host, "--port", str(self.base_port + shard),
+            ]))
+        deadline = time.perf_counter() + timeout
+        for url, process in zip(self.urls, self.processes):
+            while True:
+                if process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError(f"Shard at {url} exited with code {process.returncode} during startup.")
+                try:
+                    if httpx.get(f"{url}/health", timeout=1.0).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.perf_counter() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"Shard at {url} did not start within {timeout:.0f}s.")
+                time.sleep(0.2)
+        return self.urls
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+
+    def __enter__(self) -> "LocalShards":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Vector store shard service and a launcher for local shards.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Serve one shard (run one per shard, on any host).")
+    serve.add_argument("--shard", type=int, required=True, help="Position of this shard in IPLENS_VECTOR_SHARDS.")
+    serve.add_argument("--shards", type=int, required=True, help="Total number of shards.")
+    serve.add_argument("--path", help="Data folder of this shard (default: <data-dir>/shard-<n>).")
+    serve.add_argument("--data-dir", default=SHARD_DATA_DIR)
+    serve.add_argument("--store", default="mmap", choices=("mmap", "chroma"))
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int)
+
+    launch = commands.add_parser("launch", help="Run every shard as a local subprocess until interrupted.")
+    launch.add_argument("--shards", type=int, default=4)
+    launch.add_argument("--data-dir", default=SHARD_DATA_DIR)
+    launch.add_argument("--store", default="mmap", choices=("mmap", "chroma"))
+    launch.add_argument("--host", default="127.0.0.1")
+    launch.add_argument("--base-port", type=int, default=SHARD_BASE_PORT)
+    copy = commands.add_parser("copy", help="Copy the chroma or mmap collection into the shards in IPLENS_VECTOR_SHARDS.")
+    copy.add_argument("--source", default="chroma", choices=("chroma", "mmap"))
+    args = parser.parse_args()
+
+    if args.command == "copy":
+        from model_tools import ACTIVE_INDEX, load_vector_db
+
+        target = ShardedCollection(VECTOR_SHARDS, name=ACTIVE_INDEX.collection, metadata=ACTIVE_INDEX.collection_metadata())
+        copied = copy_collection(load_vector_db(store=args.source, use_ann=False), target)
+        print(f"Copied {copied} vectors into {target.num_shards} shards. They now hold {target.count()}.")
+    elif args.command == "serve":
+        if not 0 <= args.shard < args.shards:
+            parser.error("--shard must be between 0 and --shards - 1.")
+        path = args.path or os.path.join(args.data_dir, f"shard-{args.shard}")
+        print(f"--- Vector shard {args.shard}/{args.shards} serving {path} ({args.store}) ---")
+        shard_app = create_shard_app(lambda name, metadata: open_shard_store(args.store, path, name, metadata),
+                                     args.shard, args.shards)
+        uvicorn.run(shard_app, host=args.host,
+                    port=args.port or SHARD_BASE_PORT + args.shard, log_level="warning")
+    else:
+        shards = LocalShards(args.shards, args.data_dir, args.base_port, args.store, args.host)
+        urls = shards.start()
+        print(f"--- {args.shards} vector shards running. Start the API with: ---")
+        print(f"IPLENS_VECTOR_STORE=sharded IPLENS_VECTOR_SHARDS={','.join(urls)} uvicorn app:app --workers 4")
+        try:
+            while all(process.poll() is None for process in shards.processes):
+                time.sleep(1.0)
+            print("A shard exited; stopping the others.")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shards.stop()
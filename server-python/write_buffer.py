@@ -0,0 +1,190 @@
+import asyncio
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from batching import MicroBatcher
+from model_tools import find_existing_content_hashes, upsert_vectors_to_db
+from phash_index import PerceptualHashIndex
+from vector_service import ShardedCollection
+
+# --- Configuration ---
+# Most rows written by one upsert
+WRITE_BATCH_SIZE = int(os.getenv("IPLENS_WRITE_BATCH_SIZE", "256"))
+# How long the first add of a batch may wait for others to join it (milliseconds)
+WRITE_FLUSH_MS = float(os.getenv("IPLENS_WRITE_FLUSH_MS", "20"))
+# How long shutdown waits for buffered adds to be written
+DRAIN_TIMEOUT_SECONDS = 30.0
+
+
+class PendingWrite:
+    """One row waiting in the write buffer."""
+
+    def __init__(self, item_id: str, vector: np.ndarray, metadata: Optional[dict] = None,
+                 content_hash: Optional[str] = None, perceptual_hash: Optional[int] = None):
+        self.id = item_id
+        self.vector = vector
+        self.metadata = metadata
+        self.content_hash = content_hash
+        self.perceptual_hash = perceptual_hash
+
+
+class WriteBuffer:
+    """
+    Coalesces concurrent adds into batched upserts and keeps a running row count, so an
+    add costs one queue wait plus a share of one write instead of a write and a count().
+
+    Adds are gathered by a MicroBatcher (up to `max_batch_size` rows, or `flush_ms` after
+    the first one) and written by a single flush on `runner`. Flushes run one at a time.
+    Durability: an add returns only after the upsert holding its row has returned, i.e. after
+    Chroma committed it (or the mmap index fsynced it); a failed flush fails every add in it.
+    Adds survive the caller being cancelled, and stop() writes everything still buffered.
+
+    Like add_vector_to_db, rows whose bytes (content hash) are already stored, or that repeat
+    an id or content hash earlier in the same flush, are not written; the add reports the
+    id that holds them instead.
+
+    A ShardedCollection is shared with other API workers, so there the count is re-read
+    (one count per flush, not per add) instead of being kept locally.
+    """
+
+    def __init__(self, collection, phash_index: Optional[PerceptualHashIndex] = None,
+                 max_batch_size: int = WRITE_BATCH_SIZE, flush_ms: float = WRITE_FLUSH_MS,
+                 runner: Optional[Callable[..., Any]] = None):
+        self.collection = collection
+        self.phash_index = phash_index
+        self.runner = runner
+        self.batcher = MicroBatcher(self._flush, max_batch_size=max_batch_size, max_wait_ms=flush_ms,
+                                    runner=runner, name="write", max_queue_size=4 * max_batch_size)
+        self.count: Optional[int] = None
+        self.shared = isinstance(collection, ShardedCollection)
+
+        self._outstanding = 0
+        self._idle: Optional[asyncio.Event] = None
+        # Metrics
+        self._flushes = 0
+        self._rows_written = 0
+        self._duplicates = 0
+
+    # --- (1) Lifecycle ---
+
+    async def start(self):
+        """Reads the collection's count once and starts the flush loop."""
+        loop = asyncio.get_running_loop()
+        if self.runner is not None:
+            self.count = await self.runner(self.collection.count)
+        else:
+            self.count = await loop.run_in_executor(None, self.collection.count)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        await self.batcher.start()
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT_SECONDS):
+        """Waits for every buffered add to be written, then stops the flush loop."""
+        if self._idle is not None:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                print(f"WARNING: {self._outstanding} buffered adds were not written before shutdown.")
+        await self.batcher.stop()
+
+    def refresh_count(self) -> int:
+        """Re-reads the count from the collection (blocking), e.g. after deletes made elsewhere."""
+        self.count = self.collection.count()
+        return self.count
+
+    # --- (2) Adds ---
+
+    async def _submit(self, entry: PendingWrite) -> Tuple[Optional[str], int]:
+        self._outstanding += 1
+        self._idle.clear()
+        try:
+            # Rows whose files are already saved wait for room rather than being refused
+            return await self.batcher.submit(entry, wait_if_full=True)
+        finally:
+            self._outstanding -= 1
+            if not self._outstanding:
+                self._idle.set()
+
+    async def add(self, item_id: str, vector: np.ndarray, metadata: Optional[dict] = None,
+                  content_hash: Optional[str] = None, perceptual_hash: Optional[int] = None) -> Tuple[Optional[str], int]:
+        """
+        Buffers one row and waits until it is written. Returns (duplicate_of, count):
+        duplicate_of is the id already holding the same bytes (the row was not written)
+        or None, and count is the collection size after the flush.
+        """
+        entry = PendingWrite(item_id, vector, metadata, content_hash, perceptual_hash)
+        # Shielded so a client disconnect does not drop a row whose file is already saved
+        return await asyncio.shield(self._submit(entry))
+
+    async def add_many(self, item_ids: List[str], vectors: List[np.ndarray], metadatas: Optional[List[dict]] = None,
+                       content_hashes: Optional[List[str]] = None,
+                       perceptual_hashes: Optional[List[Optional[int]]] = None) -> List[Tuple[Optional[str], int]]:
+        """Buffers many rows at once; they are written in as few flushes as the batch size allows."""
+        count = len(item_ids)
+        metadatas = metadatas or [None] * count
+        content_hashes = content_hashes or [None] * count
+        perceptual_hashes = perceptual_hashes or [None] * count
+        return list(await asyncio.gather(*[
+            self.add(item_id, vector, metadata, image_hash, phash)
+            for item_id, vector, metadata, image_hash, phash
+            in zip(item_ids, vectors, metadatas, content_hashes, perceptual_hashes)
+        ]))
+
+    # --- (3) Flushing ---
+
+    def _flush(self, entries: List[PendingWrite]) -> List[Tuple[Optional[str], int]]:
+        """Writes one batch with a single upsert (runs on `runner`, one flush at a time)."""
+        duplicate_of: List[Optional[str]] = [None] * len(entries)
+        seen_ids, seen_hashes = set(), {}
+        for i, entry in enumerate(entries):
+            if entry.id in seen_ids:
+                duplicate_of[i] = entry.id
+            elif entry.content_hash and entry.content_hash in seen_hashes:
+                duplicate_of[i] = seen_hashes[entry.content_hash]
+            else:
+                seen_ids.add(entry.id)
+                if entry.content_hash:
+                    seen_hashes[entry.content_hash] = entry.id
+
+        # One lookup per flush for bytes already stored under another id
+        stored = find_existing_content_hashes(self.collection, list(seen_hashes))
+        for i, entry in enumerate(entries):
+            holder = stored.get(entry.content_hash) if entry.content_hash else None
+            if duplicate_of[i] is None and holder is not None and holder != entry.id:
+                duplicate_of[i] = holder
+
+        to_write = [entry for entry, duplicate in zip(entries, duplicate_of) if duplicate is None]
+        if to_write:
+            # Upserted ids that already exist replace their row and do not grow the count
+            ids = [entry.id for entry in to_write]
+            existing = set() if self.shared else set(self.collection.get(ids=ids, include=[]).get("ids", []))
+            upsert_vectors_to_db(
+                self.collection,
+                vectors=np.stack([np.asarray(entry.vector, dtype=np.float32) for entry in to_write]),
+                file_names=ids,
+                metadatas=[entry.metadata for entry in to_write],
+                content_hashes=[entry.content_hash for entry in to_write],
+                perceptual_hashes=[entry.perceptual_hash for entry in to_write],
+                phash_index=self.phash_index,
+            )
+            if self.shared:
+                self.count = self.collection.count()
+            else:
+                self.count += len(ids) - len(existing)
+
+        self._flushes += 1
+        self._rows_written += len(to_write)
+        self._duplicates += len(entries) - len(to_write)
+        return [(duplicate, self.count) for duplicate in duplicate_of]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "buffered": self._outstanding,
+            "flushes": self._flushes,
+            "rows_written": self._rows_written,
+            "duplicates": self._duplicates,
+            "avg_rows_per_flush": (self._rows_written / self._flushes) if self._flushes else 0.0,
+        }